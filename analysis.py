@@ -0,0 +1,80 @@
+"""Patient analysis and AI insight generation
+
+These functions only depend on their arguments, so the same code serves
+the single-patient endpoint and batch workers in other processes. Random
+elements are seeded from the patient ID, which makes an analysis
+reproducible wherever it runs.
+"""
+import random
+
+from interactions import SEVERITIES
+from metrics import timed
+
+
+def analyze_patient(patient_id, patient, vitals, engine, timestamp):
+    """Build the /api/analyze result for one patient"""
+    return analyze_patients([(patient_id, patient, vitals)], engine, timestamp)[0]
+
+
+@timed
+def analyze_patients(records, engine, timestamp):
+    """Analyze ``(patient_id, patient, vitals)`` records with one rule-engine pass
+
+    ``vitals`` may carry the anomaly detector's ``trends`` findings, which
+    become insights.
+    """
+    records = list(records)
+    evaluation = engine.evaluate((patient, vitals) for _, patient, vitals in records)
+    results = []
+    for i, (patient_id, patient, vitals) in enumerate(records):
+        rng = random.Random(patient_id)
+        conditions = patient.get('conditions', [])
+        bundle = engine.bundle(conditions)
+        interactions = engine.interactions.check(patient.get('medications', [])) if engine.interactions else []
+
+        results.append({
+            "patient_name": patient["name"],
+            "diagnosis": conditions,
+            "risk_factors": list(bundle.risk_factors),
+            "treatment_recommendations": list(bundle.treatments),
+            "monitoring_recommendations": list(bundle.monitoring),
+            "medication_interactions": interactions,
+            "confidence_score": rng.uniform(0.85, 0.98),
+            "analysis_timestamp": timestamp,
+            "ai_insights": _insights(patient, engine, evaluation, i, rng, vitals.get("trends", ()), interactions)
+        })
+    return results
+
+
+@timed
+def generate_ai_insights(patient, vitals, engine, rng=random):
+    """Generate AI-based insights for the patient from its record and vitals history"""
+    interactions = engine.interactions.check(patient.get('medications', [])) if engine.interactions else []
+    return _insights(patient, engine, engine.evaluate([(patient, vitals)]), 0, rng, vitals.get("trends", ()), interactions)
+
+
+def _insights(patient, engine, evaluation, i, rng, trends=(), interactions=()):
+    # Vitals patterns and lab thresholds
+    insights = evaluation.insights(i)
+
+    # Spikes and drifts found by the streaming anomaly detector
+    for finding in trends:
+        insights.append({"type": "trend", "message": finding["message"], "confidence": finding["confidence"]})
+
+    # Known interactions between the patient's medications, most serious first
+    for interaction in interactions:
+        insights.append({
+            "type": "medication",
+            "message": f"{interaction['severity'].capitalize()} interaction between {' and '.join(interaction['drugs'])}: {interaction['description']}",
+            "severity": interaction["severity"],
+            "confidence": SEVERITIES[interaction["severity"]]
+        })
+
+    # Add an insight for one of the patient's conditions
+    conditions = patient.get('conditions', [])
+    if conditions:
+        insight = engine.condition_insight(rng.choice(conditions))
+        if insight:
+            insights.append(insight)
+
+    return insights
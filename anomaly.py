@@ -0,0 +1,226 @@
+"""Streaming per-patient, per-metric anomaly detection
+
+For every (patient row, metric) the detector keeps an exponentially
+weighted mean and mean square, the z-score of the latest sample against
+them, and two-sided CUSUM sums of those z-scores. State is a handful of
+``(rows, metrics)`` arrays, so each sample costs O(1) time and memory
+whatever the history length, and a whole ward tick is one vectorized step.
+"""
+import os
+import threading
+
+import numpy as np
+
+from vitals_store import METRICS
+
+LABELS = {
+    "heart_rate": "heart rate",
+    "systolic": "systolic blood pressure",
+    "diastolic": "diastolic blood pressure",
+    "temperature": "temperature",
+    "oxygen_saturation": "oxygen saturation",
+}
+
+# Smallest standard deviation assumed per metric, so flat signals don't
+# turn measurement noise into huge z-scores
+MIN_STD = np.array([1.0, 1.0, 1.0, 0.1, 0.5])
+
+ALPHA = float(os.environ.get('MEDNEXUS_ANOMALY_ALPHA', 0.1))
+# Samples seen before z-scores are trusted
+WARMUP = 5
+Z_THRESHOLD = 3.0
+# CUSUM slack and decision threshold, in standard deviations
+CUSUM_K = 0.5
+CUSUM_H = 8.0
+
+# Alert kinds, in flags-matrix order: (kind, alert type, message template)
+KINDS = (
+    ("spike", "warning", "Sudden {label} change detected"),
+    ("rising", "warning", "Rising {label} trend detected"),
+    ("falling", "warning", "Falling {label} trend detected"),
+)
+
+
+def _ewma(x, initial, alpha):
+    """``y_t = (1 - alpha) y_{t-1} + alpha x_t`` along axis 0, from ``y_{-1} = initial``
+
+    Each block is solved in closed form with a cumulative sum, scaled by
+    powers of the decay. Blocks are short enough that those powers stay
+    within six orders of magnitude, so no precision is lost to rounding.
+    """
+    decay = 1.0 - alpha
+    if decay <= 0.0:
+        return x.copy()
+    block = max(1, int(np.log(1e6) / -np.log(decay))) if decay < 1.0 else len(x)
+    out = np.empty_like(x)
+    y = initial
+    for start in range(0, len(x), block):
+        chunk = x[start:start + block]
+        powers = decay ** np.arange(1, len(chunk) + 1)[:, None]
+        out[start:start + len(chunk)] = powers * (y + alpha * np.cumsum(chunk / powers, axis=0))
+        y = out[start + len(chunk) - 1]
+    return out
+
+
+class AnomalyDetector:
+    """EWMA, z-score and CUSUM state for every patient row and metric"""
+
+    def __init__(self, alpha=ALPHA, initial_rows=64):
+        self.alpha = alpha
+        shape = (initial_rows, len(METRICS))
+        self.count = np.zeros(initial_rows, dtype=np.int64)
+        self.mean = np.zeros(shape)
+        self.square = np.zeros(shape)
+        self.z = np.zeros(shape)
+        self.cusum_high = np.zeros(shape)
+        self.cusum_low = np.zeros(shape)
+        self._lock = threading.Lock()
+
+    def attach(self, store):
+        """Replay the samples the store retains, then follow new appends
+
+        A shared store replays them itself, on its first ``sync``.
+        """
+        if not store.shared:
+            store.replay(self.update)
+        store.add_listener(self.update)
+
+    def _grow(self, n_rows):
+        def grown(arr):
+            out = np.zeros((n_rows,) + arr.shape[1:], dtype=arr.dtype)
+            out[:len(arr)] = arr
+            return out
+
+        self.count = grown(self.count)
+        self.mean = grown(self.mean)
+        self.square = grown(self.square)
+        self.z = grown(self.z)
+        self.cusum_high = grown(self.cusum_high)
+        self.cusum_low = grown(self.cusum_low)
+
+    def update(self, rows, timestamps, values):
+        """Fold in samples given in append order; a row may appear several times"""
+        rows = np.asarray(rows, dtype=np.int64)
+        if not len(rows):
+            return
+        x = np.column_stack([np.asarray(values[m], dtype=np.float64) for m in METRICS])
+        with self._lock:
+            if rows.max() >= len(self.count):
+                self._grow(max(2 * len(self.count), int(rows.max()) + 1))
+            if rows[0] == 0 and rows[-1] == len(rows) - 1 and np.array_equal(rows, np.arange(len(rows))):
+                # A whole-ward tick: slicing avoids gathering and scattering by index
+                self._step(slice(0, len(rows)), x)
+                return
+            counts = np.bincount(rows)
+            if counts.max() == 1:
+                self._step(rows, x)
+                return
+            # Group each row's samples, keeping their append order
+            order = np.argsort(rows, kind='stable')
+            rows, x = rows[order], x[order]
+            starts = np.flatnonzero(np.r_[True, rows[1:] != rows[:-1]])
+            lengths = np.diff(np.r_[starts, len(rows)])
+            several = lengths > 1
+            if lengths.max() < several.sum():
+                # Many rows with a few samples each (a replay): step every row's
+                # k-th sample together, for k = 0, 1, ...
+                rank = np.arange(len(rows)) - np.repeat(starts, lengths)
+                by_rank = np.argsort(rank, kind='stable')
+                bounds = np.cumsum(np.bincount(rank))
+                for first, last in zip(np.r_[0, bounds[:-1]], bounds):
+                    picked = by_rank[first:last]
+                    self._step(rows[picked], x[picked])
+                return
+            single = starts[~several]
+            self._step(rows[single], x[single])
+            # A few rows with long runs are filtered a whole run at a time
+            for start, length in zip(starts[several], lengths[several]):
+                self._sequence(rows[start], x[start:start + length])
+
+    def _step(self, rows, x):
+        # ``rows`` is an index array of unique rows or a slice
+        a = self.alpha
+        count = self.count[rows]
+        mean = self.mean[rows]
+        square = self.square[rows]
+        std = np.sqrt(np.maximum(square - mean ** 2, MIN_STD ** 2))
+        z = np.where((count >= WARMUP)[:, None], (x - mean) / std, 0.0)
+        self.z[rows] = z
+        self.cusum_high[rows] = np.maximum(0.0, self.cusum_high[rows] + z - CUSUM_K)
+        self.cusum_low[rows] = np.maximum(0.0, self.cusum_low[rows] - z - CUSUM_K)
+        first = (count == 0)[:, None]
+        self.mean[rows] = np.where(first, x, (1 - a) * mean + a * x)
+        self.square[rows] = np.where(first, x ** 2, (1 - a) * square + a * x ** 2)
+        self.count[rows] = count + 1
+
+    def _sequence(self, row, x):
+        # The same recurrences as _step, run over a row's samples at once:
+        # the EWMAs are linear filters and each CUSUM is a reflected random
+        # walk, S_t = C_t - min(0, min_{s<=t} C_s) for C the running sum
+        a = self.alpha
+        count = int(self.count[row])
+        if count == 0:
+            self._step(np.array([row]), x[:1])
+            x = x[1:]
+            count = 1
+            if not len(x):
+                return
+        mean0, square0 = self.mean[row], self.square[row]
+        means = _ewma(x, mean0, a)
+        squares = _ewma(x ** 2, square0, a)
+        prev_mean = np.vstack([mean0, means[:-1]])
+        prev_square = np.vstack([square0, squares[:-1]])
+        std = np.sqrt(np.maximum(prev_square - prev_mean ** 2, MIN_STD ** 2))
+        warm = (count + np.arange(len(x)) >= WARMUP)[:, None]
+        z = np.where(warm, (x - prev_mean) / std, 0.0)
+
+        for state, steps in ((self.cusum_high, z - CUSUM_K), (self.cusum_low, -z - CUSUM_K)):
+            walk = state[row] + np.cumsum(steps, axis=0)
+            state[row] = walk[-1] - np.minimum(0.0, np.minimum.accumulate(walk, axis=0)[-1])
+
+        self.z[row] = z[-1]
+        self.mean[row] = means[-1]
+        self.square[row] = squares[-1]
+        self.count[row] = count + len(x)
+
+    def flags(self, rows):
+        """Return a ``(rows, metrics, kinds)`` bool matrix of active alerts"""
+        rows = np.asarray(rows, dtype=np.int64)
+        with self._lock:
+            known = rows < len(self.count)
+            flags = np.zeros((len(rows), len(METRICS), len(KINDS)), dtype=bool)
+            r = rows[known]
+            flags[known, :, 0] = np.abs(self.z[r]) > Z_THRESHOLD
+            flags[known, :, 1] = self.cusum_high[r] > CUSUM_H
+            flags[known, :, 2] = self.cusum_low[r] > CUSUM_H
+        return flags
+
+    def findings(self, row):
+        """Describe a row's active anomalies, strongest first, for insights"""
+        with self._lock:
+            if row >= len(self.count):
+                return []
+            z = self.z[row].copy()
+            high = self.cusum_high[row].copy()
+            low = self.cusum_low[row].copy()
+        findings = []
+        for j, metric in enumerate(METRICS):
+            scores = (abs(z[j]) / Z_THRESHOLD, high[j] / CUSUM_H, low[j] / CUSUM_H)
+            for k, (kind, _, template) in enumerate(KINDS):
+                if scores[k] > 1:
+                    findings.append({
+                        "metric": metric,
+                        "kind": kind,
+                        "message": template.format(label=LABELS[metric]),
+                        "confidence": round(min(0.99, 0.75 + 0.1 * scores[k]), 2),
+                    })
+        findings.sort(key=lambda finding: -finding["confidence"])
+        return findings
+
+
+def render_alerts(flags):
+    """Render one row of ``AnomalyDetector.flags`` in the realtime alert shape"""
+    return [
+        {"type": KINDS[k][1], "message": KINDS[k][2].format(label=LABELS[METRICS[j]])}
+        for j, k in zip(*np.nonzero(flags))
+    ]
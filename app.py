@@ -1,18 +1,106 @@
-from flask import Flask, render_template, request, jsonify, send_from_directory
-import pandas as pd
+"""MedNexus AI web application
+
+``create_app`` builds the Flask application around the ``api`` blueprint.
+The services behind it (repository, vitals store, indexes, analysis
+queues) are loaded once per process, by the first ``create_app()`` call;
+importing the module does no I/O. Heavy
+optional dependencies (Pillow, pandas, scikit-learn) are only imported
+when a request first needs them, and demo assets are prepared on a
+background thread, so a new worker answers its first request quickly.
+"""
+from flask import Blueprint, Flask, Request, Response, abort, render_template, request, jsonify, send_file, url_for
+from flask.json.provider import JSONProvider
+from werkzeug.security import safe_join
 import numpy as np
+import collections
 import json
 import os
 import random
-from datetime import datetime, timedelta
+import time
+import threading
+from datetime import datetime
+
+from analysis import analyze_patient
+from anomaly import AnomalyDetector
+from batch import analyze_cohort
+from image_analysis import ImageAnalysisQueue
+from image_catalog import ImageCatalog, validate as validate_image
+from image_derivatives import THUMBNAIL_SIZES, ImageDerivatives, UndecodableImage
+from interactions import InteractionTable, MedicationCensus
+from knowledge_search import KnowledgeIndex
+from ingest import MAX_ERRORS, Backpressure, DirectoryInUse, InvalidReadings, VitalsIngestor, parse_frame, parse_ndjson
+from metrics import ENABLED as METRICS_ENABLED, REGISTRY, ROUTE_KEY, RequestMetrics, SamplingProfiler, timed
+from patient_index import PatientIndex
+from population import PopulationAggregates
+from progression import features as progression_features, get_model as get_progression_model
+from repository import open_repository
+from response_cache import RecordVersions, ResponseCache
+from rollups import VitalsRollups, lttb
+from rules import RuleEngine
+from serialization import FragmentCache, compress, encode, negotiate, parse_fields, project
+import sharding
+from simulator import WardSimulator
+from streaming import VitalsBroadcaster
+from vitals_store import METRICS
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+STATIC_FOLDER = os.path.join(ROOT, 'static')
+STATIC_URL_PATH = '/static'
+INSTANCE_PATH = os.path.join(ROOT, 'instance')
+
+api = Blueprint('api', __name__)
+
+class FastJSONProvider(JSONProvider):
+    """JSON through ``serialization.encode``, so responses may hold NumPy values and fragments"""
+
+    def dumps(self, obj, **kwargs):
+        return encode(obj).decode()
+
+    def loads(self, s, **kwargs):
+        return json.loads(s, **kwargs)
+
+    def response(self, *args, **kwargs):
+        obj = self._prepare_response_obj(args, kwargs)
+        return self._app.response_class(encode(obj) + b"\n", mimetype='application/json')
 
-app = Flask(__name__, static_url_path='/static')
+class InstrumentedRequest(Request):
+    """Flask's request, which also leaves the matched route in the WSGI environ for the request metrics"""
 
-# Configure static folder
-app.static_folder = 'static'
+    _url_rule = None
 
-# Sample patient data
-patients = {
+    @property
+    def url_rule(self):
+        return self._url_rule
+
+    @url_rule.setter
+    def url_rule(self, rule):
+        self._url_rule = rule
+        if rule is not None:
+            self.environ[ROUTE_KEY] = rule.rule
+
+# The services behind the routes, built once per process by ``start_services``
+# when the first app is created; importing this module opens and loads nothing.
+# Documents and recorded vitals live in the repository ('memory' or 'sqlite:///path.db').
+repository = None
+patients = None
+drug_interactions = None
+added_interactions = None
+medication_census = None
+vitals_store = None
+anomaly_detector = None
+ward_simulator = None
+population = None
+vitals_ingestor = None
+vitals_rollups = None
+knowledge_base = None
+knowledge_index = None
+rule_engine = None
+image_catalog = None
+image_derivatives = None
+image_jobs = None
+
+# Sample patient data, used to seed an empty repository
+sample_patients = {
     "P001": {
         "name": "John Doe",
         "age": 45,
@@ -69,8 +157,146 @@ patients = {
     }
 }
 
-# Sample medical knowledge base
-knowledge_base = {
+# Secondary indexes for filtered, paginated patient listing
+patient_index = PatientIndex()
+
+INTERACTION_FIELDS = ("drug_a", "drug_b", "severity", "description")
+
+PATIENT_FIELDS = ("name", "age", "gender")
+VITALS_SERIES = ("heart_rate", "blood_pressure", "temperature", "oxygen_saturation")
+MAX_AGE = 150
+
+def _is_number(value):
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+def _is_finite_number(value):
+    return _is_number(value) and -np.inf < value < np.inf
+
+def _is_string_list(value):
+    return isinstance(value, list) and all(isinstance(item, str) for item in value)
+
+def _is_pressure(reading):
+    parts = reading.split('/') if isinstance(reading, str) else ()
+    try:
+        return len(parts) == 2 and all(np.isfinite(float(part)) for part in parts)
+    except ValueError:
+        return False
+
+def validate_patient(record):
+    """Raise ValueError unless a patient record has the fields and shapes the indexes rely on"""
+    if not isinstance(record, dict):
+        raise ValueError("A patient must be a JSON object")
+    missing = [field for field in PATIENT_FIELDS if field not in record]
+    if missing:
+        raise ValueError(f"Missing fields: {', '.join(missing)}")
+    if not isinstance(record["name"], str) or not isinstance(record["gender"], str):
+        raise ValueError("name and gender must be strings")
+    age = record["age"]
+    if not isinstance(age, int) or isinstance(age, bool) or not 0 <= age <= MAX_AGE:
+        raise ValueError(f"age must be an integer from 0 to {MAX_AGE}")
+    for field in ("conditions", "medications"):
+        if not _is_string_list(record.get(field, [])):
+            raise ValueError(f"{field} must be a list of strings")
+    lab_results = record.get("lab_results", {})
+    if not isinstance(lab_results, dict) or not all(
+        isinstance(values, list) and all(_is_finite_number(value) for value in values) for values in lab_results.values()
+    ):
+        raise ValueError("lab_results must map each test to a list of numeric results")
+    vitals = record.get("vitals")
+    if vitals:
+        if not isinstance(vitals, dict) or any(not isinstance(vitals.get(series), list) for series in VITALS_SERIES):
+            raise ValueError(f"vitals must hold lists of {', '.join(VITALS_SERIES)}")
+        if len({len(vitals[series]) for series in VITALS_SERIES}) != 1:
+            raise ValueError("vitals series must have the same length")
+        numeric = all(_is_number(value) for series in VITALS_SERIES if series != "blood_pressure" for value in vitals[series])
+        if not numeric or not all(_is_pressure(reading) for reading in vitals["blood_pressure"]):
+            raise ValueError("vitals must be numbers, with blood pressure as \"systolic/diastolic\"")
+
+def index_patient(patient_id, patient):
+    index_patients([(patient_id, patient)])
+
+def index_patients(records):
+    """Index ``(patient_id, patient)`` pairs; the population aggregates take them in one batch"""
+    for patient_id, patient in records:
+        patient_index.add(patient_id, patient)
+        medication_census.set_patient(patient_id, patient.get('medications', []))
+        ward_simulator.set_conditions(patient_id, patient['conditions'])
+    population.set_patients(records)
+
+def load_vitals(patient_id, vitals):
+    """Load legacy list-shaped vitals into the store and persist them"""
+    repository.append_vitals(patient_id, vitals_store.load(patient_id, vitals))
+
+def _load_patients():
+    """Seed an empty repository, fill the vitals store from it and index every valid patient"""
+    if not repository.count('patients'):
+        for patient_id, patient in sample_patients.items():
+            patient = dict(patient)
+            load_vitals(patient_id, patient.pop('vitals'))
+            patients[patient_id] = patient
+    elif not (vitals_store.shared and vitals_store.loaded):
+        for patient_id, samples in repository.vitals():
+            vitals_store.extend(patient_id, samples['timestamp'], samples)
+
+    # Build the indexes from the fields they need rather than whole documents
+    records = []
+    for patient_id, fields in repository.project('patients', ('age', 'gender', 'conditions', 'medications')):
+        try:
+            validate_patient(dict(fields, name=patient_id))
+        except ValueError as exc:
+            # Stored before records were validated; leave it out of the indexes
+            print(f"Skipping invalid patient record {patient_id}: {exc}")
+            continue
+        records.append((patient_id, fields))
+    index_patients(records)
+
+# Device readings are write-ahead logged, per shard for the patients it owns
+INGEST_DIR = os.environ.get('MEDNEXUS_INGEST_DIR', os.path.join(INSTANCE_PATH, 'ingest'))
+
+def open_ingestor(store):
+    """The vitals ingestor over a log directory this process holds
+
+    A shard logs to its own subdirectory. Unsharded processes, such as
+    several WSGI workers, each take the first directory no other holds:
+    INGEST_DIR, then worker-1, worker-2 and so on.
+    """
+    if sharding.ENABLED:
+        return VitalsIngestor(store, os.path.join(INGEST_DIR, f'shard-{sharding.SHARD}'), owns=sharding.owns)
+    slot = 0
+    while True:
+        directory = os.path.join(INGEST_DIR, f'worker-{slot}') if slot else INGEST_DIR
+        try:
+            return VitalsIngestor(store, directory)
+        except DirectoryInUse:
+            slot += 1
+
+KNOWLEDGE_FIELDS = ("description", "symptoms", "treatments", "risk_factors")
+
+def validate_condition(entry):
+    """Raise ValueError unless a knowledge base entry has every field, with the expected types"""
+    if not isinstance(entry, dict):
+        raise ValueError("A knowledge base entry must be a JSON object")
+    missing = [field for field in KNOWLEDGE_FIELDS if field not in entry]
+    if missing:
+        raise ValueError(f"Missing fields: {', '.join(missing)}")
+    if not isinstance(entry["description"], str):
+        raise ValueError("description must be a string")
+    for field in KNOWLEDGE_FIELDS[1:]:
+        if not _is_string_list(entry[field]):
+            raise ValueError(f"{field} must be a list of strings")
+
+def _valid_conditions(entries):
+    for condition, entry in entries:
+        try:
+            validate_condition(entry)
+        except ValueError as exc:
+            # Stored before entries were validated; leave it out of the index
+            print(f"Skipping invalid knowledge base entry {condition}: {exc}")
+            continue
+        yield condition, entry
+
+# Sample medical knowledge base, used to seed an empty repository
+sample_knowledge_base = {
     "Hypertension": {
         "description": "High blood pressure condition that can lead to heart disease and stroke.",
         "symptoms": ["Headaches", "Shortness of breath", "Nosebleeds"],
@@ -97,35 +323,372 @@ knowledge_base = {
     }
 }
 
-@app.route('/')
+# Serialized responses are cached against per-record version counters
+record_versions = RecordVersions()
+response_cache = ResponseCache()
+
+def record_version(record):
+    if record[0] == 'vitals':
+        return vitals_store.version_of(record[1])
+    return record_versions.get(record)
+
+def mark_changed(*records):
+    """Bump the version of mutated records and drop responses built from them"""
+    for record in records:
+        record_versions.bump(record)
+        response_cache.invalidate(record)
+
+# Encoded knowledge base entries, reused until an entry changes
+knowledge_fragments = FragmentCache()
+
+def knowledge_fragment(condition):
+    return knowledge_fragments.get(condition, record_version(('knowledge', condition)), lambda: knowledge_base[condition])
+
+def requested_fields():
+    """The ``?fields=`` projection of the current request, or None for every field"""
+    fields = request.args.get('fields')
+    if not fields:
+        return None
+    try:
+        return parse_fields(fields)
+    except ValueError as exc:
+        response = jsonify({"error": str(exc)})
+        response.status_code = 400
+        abort(response)
+
+def projected(obj):
+    fields = requested_fields()
+    return obj if fields is None else project(obj, fields)
+
+def cached_json(key, records, build):
+    """Serve ``build()`` as JSON from the response cache, honouring If-None-Match
+
+    ``?fields=`` projects the body, and it is compressed when the client
+    accepts a content coding; compressed bodies are cached alongside it.
+    """
+    fields = requested_fields()
+    if fields is not None:
+        key = key + (('fields', request.args['fields']),)
+        build = (lambda build: lambda: project(build(), fields))(build)
+    versions = tuple(record_version(record) for record in records)
+    entry = response_cache.get(key, versions)
+    if entry is None:
+        entry = response_cache.put(key, encode(build()) + b"\n", versions, records)
+    coding = negotiate(request.accept_encodings, len(entry.body))
+    # Each content coding is a separate representation with its own ETag
+    etag = entry.etag if coding is None else f"{entry.etag}-{coding}"
+    if request.if_none_match.contains_weak(etag):
+        response = Response(status=304)
+    elif coding is None:
+        response = Response(entry.body, mimetype='application/json')
+    else:
+        response = Response(response_cache.compressed(entry, coding), mimetype='application/json')
+        response.content_encoding = coding
+    response.set_etag(etag)
+    response.vary.add('Accept-Encoding')
+    response.cache_control.no_cache = True
+    return response
+
+@api.after_app_request
+def compress_json(response):
+    """Compress JSON responses not served by ``cached_json`` when the client accepts it"""
+    if (response.mimetype != 'application/json' or response.direct_passthrough
+            or response.content_encoding or not response.is_sequence):
+        return response
+    response.vary.add('Accept-Encoding')
+    body = response.get_data()
+    coding = negotiate(request.accept_encodings, len(body))
+    if coding is not None:
+        response.set_data(compress(body, coding))
+        response.content_encoding = coding
+    return response
+
+DEFAULT_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1000
+
+def save_patient(patient_id, record):
+    """Create or replace a patient record and refresh everything derived from it
+
+    ``record`` must pass ``validate_patient``. The indexes are updated
+    before the record is stored, so a record is never stored unindexed.
+    """
+    record = dict(record)
+    vitals = record.pop('vitals', None)
+    record.setdefault('conditions', [])
+    record.setdefault('medications', [])
+    record.setdefault('lab_results', {})
+    index_patient(patient_id, record)
+    if vitals:
+        load_vitals(patient_id, vitals)
+    patients[patient_id] = record
+    mark_changed(('patient', patient_id), ('patients',))
+
+def save_condition(condition, entry):
+    """Create or replace a knowledge base entry that passes ``validate_condition``"""
+    knowledge_index.put(condition, entry)
+    knowledge_base[condition] = entry
+    rule_engine.invalidate()
+    mark_changed(('knowledge', condition))
+
+def owner_shard(patient_id):
+    """The shard to forward a write of a patient's vitals to, or None to make it here"""
+    if not sharding.ENABLED or sharding.FORWARDED_HEADER in request.headers:
+        return None
+    shard = sharding.shard_of(patient_id)
+    return None if shard == sharding.SHARD else shard
+
+def job_shard(job_id):
+    """The shard to forward a poll of an image analysis job to, or None to answer it here"""
+    if not sharding.ENABLED or sharding.FORWARDED_HEADER in request.headers:
+        return None
+    shard = sharding.shard_of_job(job_id)
+    return None if shard == sharding.SHARD else shard
+
+def forward_request(shard):
+    """Answer the current request with another shard's response to it"""
+    try:
+        status, headers, body = sharding.forward(
+            shard, request.method, request.full_path, request.get_data(), request.headers.items()
+        )
+    except sharding.FORWARD_ERRORS as exc:
+        return jsonify({"error": f"Shard {shard} is unavailable: {exc}"}), 503
+    return Response(body, status=status, headers=headers)
+
+@api.route('/')
 def index():
     return render_template('index.html')
 
-@app.route('/api/patients', methods=['GET'])
+@api.route('/api/patients', methods=['GET'])
 def get_patients():
-    patient_list = []
-    for id, data in patients.items():
-        patient_list.append({
-            "id": id,
-            "name": data["name"],
-            "age": data["age"],
-            "gender": data["gender"]
-        })
-    return jsonify(patient_list)
-
-@app.route('/api/patients/<patient_id>', methods=['GET'])
+    """List patients a page at a time (?limit=&cursor=&min_age=&max_age=&gender=&condition=&medication=)
+
+    The cursor for the next page is returned in the X-Next-Cursor header.
+    """
+    args = request.args
+    try:
+        limit = max(1, min(int(args.get('limit', DEFAULT_PAGE_SIZE)), MAX_PAGE_SIZE))
+        filters = {
+            "gender": args.get('gender'),
+            "conditions": args.getlist('condition'),
+            "medications": args.getlist('medication')
+        }
+        for key in ('min_age', 'max_age'):
+            if key in args:
+                filters[key] = float(args[key])
+        patient_ids, next_cursor = patient_index.query(filters, limit, args.get('cursor'))
+    except ValueError as exc:
+        return jsonify({"error": str(exc)}), 400
+    
+    def build():
+        patient_list = []
+        for id in patient_ids:
+            data = patients[id]
+            patient_list.append({
+                "id": id,
+                "name": data["name"],
+                "age": data["age"],
+                "gender": data["gender"]
+            })
+        return patient_list
+    
+    key = ('patients', tuple(sorted(args.items(multi=True))))
+    response = cached_json(key, [('patients',)], build)
+    if next_cursor:
+        response.headers['X-Next-Cursor'] = next_cursor
+        response.headers['Link'] = f'<{url_for(".get_patients", **dict(args.to_dict(flat=False), cursor=next_cursor))}>; rel="next"'
+    return response
+
+@api.route('/api/patients/<patient_id>', methods=['GET'])
 def get_patient(patient_id):
     if patient_id in patients:
-        return jsonify(patients[patient_id])
+        return cached_json(
+            ('patient', patient_id),
+            [('patient', patient_id), ('vitals', patient_id)],
+            lambda: dict(patients[patient_id], vitals=vitals_store.as_dict(patient_id))
+        )
     return jsonify({"error": "Patient not found"}), 404
 
-@app.route('/api/knowledge/<condition>', methods=['GET'])
+DEFAULT_VITALS_POINTS = 500
+MAX_VITALS_POINTS = 5000
+
+# Latest time a query may name: the end of year 9999
+MAX_TIMESTAMP = 253402300799.0
+
+def _time_arg(value):
+    # Epoch seconds or an ISO 8601 date/time
+    try:
+        timestamp = float(value)
+    except ValueError:
+        timestamp = datetime.fromisoformat(value).timestamp()
+    if not 0 <= timestamp <= MAX_TIMESTAMP:
+        raise ValueError(f"Time out of range: {value}")
+    return timestamp
+
+@api.route('/api/patients/<patient_id>/vitals', methods=['GET'])
+def get_patient_vitals(patient_id):
+    """Vitals over a time range (?from=&to=&resolution=&points=&metric=)
+
+    ``resolution`` is ``raw``, a rollup tier such as ``1m``/``1h``/``1d``, or
+    ``auto`` (default): raw samples when they cover the range, downsampled
+    with LTTB to ``points``, otherwise the finest rollup tier that fits.
+    """
+    if patient_id not in patients:
+        return jsonify({"error": "Patient not found"}), 404
+    args = request.args
+    try:
+        points = max(3, min(int(args.get('points', DEFAULT_VITALS_POINTS)), MAX_VITALS_POINTS))
+        metrics = args.getlist('metric') or list(METRICS)
+        unknown = [metric for metric in metrics if metric not in METRICS]
+        if unknown:
+            raise ValueError(f"Unknown metric: {', '.join(unknown)}")
+        resolution = args.get('resolution', 'auto')
+        tier = vitals_rollups.tier(resolution) if resolution not in ('auto', 'raw') else None
+        end = _time_arg(args['to']) if 'to' in args else None
+        start = _time_arg(args['from']) if 'from' in args else None
+        if start is not None and end is not None and start > end:
+            raise ValueError("from must not be after to")
+    except ValueError as exc:
+        return jsonify({"error": str(exc)}), 400
+    
+    def build():
+        samples = vitals_store.snapshot(patient_id)
+        timestamps = samples["timestamp"]
+        range_end = end if end is not None else (float(timestamps[-1]) if len(timestamps) else datetime.now().timestamp())
+        if start is not None:
+            range_start = start
+        elif tier is not None:
+            range_start = range_end - tier.width * (min(points, tier.buckets) - 1)
+        else:
+            range_start = float(timestamps[0]) if len(timestamps) else range_end - 86400
+        selected = tier
+        if selected is None and resolution == 'auto' and not (len(timestamps) and timestamps[0] <= range_start):
+            selected = vitals_rollups.choose(vitals_store.row(patient_id), range_start, range_end, points)
+        
+        result = {"patient_id": patient_id, "from": range_start, "to": range_end}
+        if selected is not None:
+            result["resolution"] = selected.name
+            result["series"] = vitals_rollups.query(vitals_store.row(patient_id), selected, range_start, range_end, metrics)
+            return result
+        
+        lo, hi = int(np.searchsorted(timestamps, range_start, side='left')), int(np.searchsorted(timestamps, range_end, side='right'))
+        x = timestamps[lo:hi]
+        result["resolution"] = "raw" if hi - lo <= points else "lttb"
+        result["series"] = {}
+        for metric in metrics:
+            y = samples[metric][lo:hi].astype(np.float64)
+            keep = lttb(x, y, points)
+            result["series"][metric] = {"timestamp": x[keep], "value": np.round(y[keep], 1)}
+        return result
+    
+    key = ('vitals', patient_id, tuple(sorted(args.items(multi=True))))
+    return cached_json(key, [('vitals', patient_id)], build)
+
+@api.route('/api/patients/<patient_id>', methods=['PUT'])
+def put_patient(patient_id):
+    """Create or replace a patient record"""
+    shard = owner_shard(patient_id)
+    if shard is not None:
+        return forward_request(shard)
+    record = request.get_json(silent=True)
+    try:
+        validate_patient(record)
+    except ValueError as exc:
+        return jsonify({"error": str(exc)}), 400
+    created = patient_id not in patients
+    save_patient(patient_id, record)
+    return jsonify(dict(patients[patient_id], vitals=vitals_store.as_dict(patient_id))), 201 if created else 200
+
+DEFAULT_SEARCH_LIMIT = 10
+MAX_SEARCH_LIMIT = 100
+
+def _search_limit():
+    return max(1, min(int(request.args.get('limit', DEFAULT_SEARCH_LIMIT)), MAX_SEARCH_LIMIT))
+
+def _search_results(results):
+    # ?include=entry embeds each condition's knowledge base entry
+    if request.args.get('include') == 'entry':
+        for result in results:
+            result["entry"] = knowledge_fragment(result["condition"])
+    return jsonify(projected({"results": results}))
+
+@api.route('/api/knowledge', methods=['GET'])
+def search_knowledge():
+    """Knowledge base entries ranked for free text (?q=&limit=&include=entry), prefix and typo tolerant"""
+    try:
+        limit = _search_limit()
+    except ValueError:
+        return jsonify({"error": "limit must be an integer"}), 400
+    return _search_results(knowledge_index.search(request.args.get('q', ''), limit))
+
+@api.route('/api/knowledge/match', methods=['GET'])
+def match_symptoms():
+    """Conditions ranked by how well they explain a list of symptoms (?symptom=&symptom=&limit=&include=entry)"""
+    symptoms = request.args.getlist('symptom')
+    if not symptoms:
+        return jsonify({"error": "symptom is required"}), 400
+    try:
+        limit = _search_limit()
+    except ValueError:
+        return jsonify({"error": "limit must be an integer"}), 400
+    return _search_results(knowledge_index.match(symptoms, limit))
+
+@api.route('/api/knowledge/<condition>', methods=['GET'])
 def get_condition_info(condition):
-    if condition in knowledge_base:
-        return jsonify(knowledge_base[condition])
+    # Exact names first, then ignoring case and spacing
+    if condition not in knowledge_base:
+        condition = knowledge_index.resolve(condition)
+    if condition is not None and condition in knowledge_base:
+        return cached_json(('knowledge', condition), [('knowledge', condition)], lambda: knowledge_fragment(condition))
     return jsonify({"error": "Condition not found"}), 404
 
-@app.route('/api/analyze', methods=['POST'])
+@api.route('/api/knowledge/<condition>', methods=['PUT'])
+def put_condition_info(condition):
+    """Create or replace a knowledge base entry"""
+    entry = request.get_json(silent=True)
+    try:
+        validate_condition(entry)
+    except ValueError as exc:
+        return jsonify({"error": str(exc)}), 400
+    created = condition not in knowledge_base
+    save_condition(condition, {field: entry[field] for field in KNOWLEDGE_FIELDS})
+    return jsonify(knowledge_base[condition]), 201 if created else 200
+
+@api.route('/api/interactions', methods=['GET'])
+def check_interactions():
+    """Known interactions among a medication list (?medication=&medication=)"""
+    return jsonify({"interactions": drug_interactions.check(request.args.getlist('medication'))})
+
+@api.route('/api/interactions', methods=['POST'])
+def add_interaction():
+    """Add or replace an interaction and list the patients already taking both drugs"""
+    entry = request.get_json(silent=True)
+    if not isinstance(entry, dict):
+        return jsonify({"error": "The body must be a JSON object"}), 400
+    missing = [field for field in INTERACTION_FIELDS if not entry.get(field)]
+    if missing:
+        return jsonify({"error": f"Missing fields: {', '.join(missing)}"}), 400
+    for field in INTERACTION_FIELDS:
+        if not isinstance(entry[field], str) or not entry[field].strip():
+            return jsonify({"error": f"{field} must be a non-empty string"}), 400
+    interaction = {field: entry[field] for field in INTERACTION_FIELDS}
+    try:
+        drug_interactions.add(*interaction.values())
+    except ValueError as exc:
+        return jsonify({"error": str(exc)}), 400
+    pair = sorted(name.casefold() for name in (interaction['drug_a'], interaction['drug_b']))
+    added_interactions['|'.join(pair)] = interaction
+    return jsonify({
+        "interaction": interaction,
+        "patients": medication_census.screen(interaction['drug_a'], interaction['drug_b'])
+    }), 201
+
+def analysis_vitals(patient_id):
+    """A patient's vitals history plus the anomaly detector's current findings"""
+    vitals = vitals_store.snapshot(patient_id)
+    vitals["trends"] = anomaly_detector.findings(vitals_store.row(patient_id))
+    return vitals
+
+@api.route('/api/analyze', methods=['POST'])
 def analyze_data():
     data = request.json
     patient_id = data.get('patient_id')
@@ -133,201 +696,280 @@ def analyze_data():
     if patient_id not in patients:
         return jsonify({"error": "Patient not found"}), 404
     
-    patient = patients[patient_id]
-    conditions = patient.get('conditions', [])
-    
-    # Simple analysis based on conditions
-    analysis = {
-        "patient_name": patient["name"],
-        "diagnosis": conditions,
-        "risk_factors": [],
-        "treatment_recommendations": [],
-        "monitoring_recommendations": [],
-        "confidence_score": random.uniform(0.85, 0.98),
-        "analysis_timestamp": datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-    }
+    analysis = analyze_patient(
+        patient_id,
+        patients[patient_id],
+        analysis_vitals(patient_id),
+        rule_engine,
+        datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    )
     
-    # Add risk factors and treatments based on conditions
-    for condition in conditions:
-        if condition in knowledge_base:
-            analysis["risk_factors"].extend(knowledge_base[condition]["risk_factors"])
-            analysis["treatment_recommendations"].extend(knowledge_base[condition]["treatments"])
+    return jsonify(projected(analysis))
+
+def select_patients(filters):
+    """Return the IDs of patients matching condition/medication/gender/age filters"""
+    patient_ids, _ = patient_index.query(_index_filters(filters))
+    return patient_ids
+
+def _index_filters(filters):
+    index_filters = {key: filters[key] for key in ('min_age', 'max_age', 'gender') if key in filters}
+    for single, plural in (('condition', 'conditions'), ('medication', 'medications')):
+        values = filters.get(plural, [])
+        index_filters[plural] = [filters[single]] + list(values) if single in filters else list(values)
+    return index_filters
+
+def analyze_batch(patient_ids=None, filters=None, workers=None, chunk_size=None):
+    """Analyze many patients, yielding ``(patient_id, analysis)`` in input order
+
+    Unknown patient IDs yield ``(patient_id, None)``. Each analysis matches
+    what /api/analyze returns for the same patient.
+    """
+    if patient_ids is None:
+        patient_ids = select_patients(filters or {})
+    timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    records = (
+        (pid, patients[pid], analysis_vitals(pid))
+        for pid in patient_ids if pid in patients
+    )
+    results = (result for chunk in analyze_cohort(records, rule_engine, timestamp, workers, chunk_size) for result in chunk)
+    for patient_id in patient_ids:
+        if patient_id not in patients:
+            yield patient_id, None
+        else:
+            yield next(results)
+
+def _positive_int(data, key):
+    value = data.get(key)
+    if value is not None and (not isinstance(value, int) or isinstance(value, bool) or value < 1):
+        raise ValueError(f"{key} must be a positive integer")
+    return value
+
+def _batch_filters(filters):
+    # Validates a batch ``filter`` object; ``_index_filters`` reads it
+    if not isinstance(filters, dict):
+        raise ValueError("filter must be an object")
+    for key in ('min_age', 'max_age'):
+        if key in filters and not _is_number(filters[key]):
+            raise ValueError(f"filter.{key} must be a number")
+    for key in ('gender', 'condition', 'medication'):
+        if key in filters and not isinstance(filters[key], str):
+            raise ValueError(f"filter.{key} must be a string")
+    for key in ('conditions', 'medications'):
+        if not _is_string_list(filters.get(key, [])):
+            raise ValueError(f"filter.{key} must be a list of strings")
+    return filters
+
+@api.route('/api/analyze/batch', methods=['POST'])
+def analyze_batch_data():
+    """Analyze a list of patients or a filtered cohort, streamed back as NDJSON
+
+    ``workers`` (at most the server's MEDNEXUS_ANALYZE_WORKERS) and
+    ``chunk_size`` are optional positive integers.
+    """
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict):
+        return jsonify({"error": "The body must be a JSON object"}), 400
+    patient_ids = data.get('patient_ids')
+    filters = data.get('filter')
+    if patient_ids is None and filters is None:
+        return jsonify({"error": "Provide patient_ids or filter"}), 400
+    try:
+        if patient_ids is not None and not _is_string_list(patient_ids):
+            raise ValueError("patient_ids must be a list of strings")
+        if filters is not None:
+            _batch_filters(filters)
+        workers = _positive_int(data, 'workers')
+        chunk_size = _positive_int(data, 'chunk_size')
+    except ValueError as exc:
+        return jsonify({"error": str(exc)}), 400
     
-    # Remove duplicates
-    analysis["risk_factors"] = list(set(analysis["risk_factors"]))
-    analysis["treatment_recommendations"] = list(set(analysis["treatment_recommendations"]))
+    def generate():
+        for patient_id, analysis in analyze_batch(patient_ids, filters, workers, chunk_size):
+            if analysis is None:
+                line = {"patient_id": patient_id, "error": "Patient not found"}
+            else:
+                line = {"patient_id": patient_id, "analysis": analysis}
+            yield json.dumps(line, sort_keys=True) + "\n"
     
-    # Add monitoring recommendations based on conditions
-    if "Hypertension" in conditions:
-        analysis["monitoring_recommendations"].append("Monitor blood pressure daily")
-    if "Type 2 Diabetes" in conditions:
-        analysis["monitoring_recommendations"].append("Check blood glucose levels regularly")
-    if "Asthma" in conditions:
-        analysis["monitoring_recommendations"].append("Track peak flow measurements")
-    if "Coronary Artery Disease" in conditions:
-        analysis["monitoring_recommendations"].append("Regular ECG monitoring")
+    return Response(generate(), mimetype='application/x-ndjson')
+
+@api.route('/api/vitals/ingest', methods=['POST'])
+def ingest_vitals():
+    """Bulk-ingest device readings as NDJSON or a binary frame (application/octet-stream)
+
+    Readings are durable once acknowledged with 202 and applied shortly after.
+    A full apply queue answers 429 with a Retry-After header. Invalid
+    readings, including those older than their patient's latest, answer 400
+    with an error per NDJSON line or frame record.
+    """
+    body = request.get_data(cache=False)
+    frame = request.mimetype == 'application/octet-stream'
+    position = "record" if frame else "line"
+    try:
+        if frame:
+            readings = parse_frame(body)
+            positions = np.arange(1, len(readings) + 1)
+        else:
+            readings, positions = parse_ndjson(body)
+    except InvalidReadings as exc:
+        return _invalid_readings(exc, position)
+    except ValueError as exc:
+        return jsonify({"error": str(exc)}), 400
     
-    # Add AI-generated insights
-    analysis["ai_insights"] = generate_ai_insights(patient)
+    ids, inverse = np.unique(readings["patient_id"], return_inverse=True)
+    patient_ids = [pid.decode() for pid in ids.tolist()]
+    unknown = [pid for pid in patient_ids if pid not in vitals_store]
+    if unknown:
+        return jsonify({"error": "Patient not found", "patient_ids": unknown}), 404
+    late = np.flatnonzero(vitals_ingestor.late(readings))
+    if len(late):
+        message = "Reading is older than the patient's latest"
+        return _invalid_readings(
+            InvalidReadings(f"{len(late)} invalid reading(s)", [(p, message) for p in positions[late[:MAX_ERRORS]].tolist()]),
+            position,
+        )
+    if sharding.ENABLED and sharding.FORWARDED_HEADER not in request.headers:
+        return _ingest_by_shard(readings, patient_ids, inverse.reshape(-1))
     
-    return jsonify(analysis)
+    try:
+        accepted = vitals_ingestor.submit(readings)
+    except Backpressure as exc:
+        response = jsonify({"error": str(exc), "retry_after": exc.retry_after})
+        response.status_code = 429
+        response.headers['Retry-After'] = str(exc.retry_after)
+        return response
+    return jsonify({"accepted": accepted, "pending": vitals_ingestor.pending}), 202
+
+def _invalid_readings(exc, position):
+    errors = [{position: at, "error": message} for at, message in exc.errors]
+    return jsonify({"error": str(exc), "errors": errors}), 400
+
+def _ingest_by_shard(readings, patient_ids, inverse):
+    """Submit each shard's share of the readings to it
 
-@app.route('/api/realtime/<patient_id>', methods=['GET'])
+    Shards that refuse their share are reported with the patients whose
+    readings were not accepted, which clients should send again.
+    """
+    owners = sharding.shards_of(patient_ids)
+    reading_owners = owners[inverse]
+    accepted = pending = 0
+    # Per refusing shard: (status, retry after)
+    refused = {}
+    for shard in np.unique(owners).tolist():
+        share = readings[reading_owners == shard]
+        if shard == sharding.SHARD:
+            try:
+                accepted += vitals_ingestor.submit(share)
+                pending += vitals_ingestor.pending
+            except Backpressure as exc:
+                refused[shard] = (429, exc.retry_after)
+            continue
+        try:
+            status, _, body = sharding.forward(
+                shard, 'POST', request.path, share.tobytes(), [('Content-Type', 'application/octet-stream')]
+            )
+            result = json.loads(body)
+        except (*sharding.FORWARD_ERRORS, ValueError):
+            status, result = 503, {}
+        if status == 202:
+            accepted += result["accepted"]
+            pending += result["pending"]
+        else:
+            refused[shard] = (status, result.get("retry_after", 1))
+    if not refused:
+        return jsonify({"accepted": accepted, "pending": pending}), 202
+    retry_after = max(wait for _, wait in refused.values())
+    response = jsonify({
+        "error": "Readings were not accepted for some patients",
+        "retry_after": retry_after,
+        "accepted": accepted,
+        "patient_ids": [pid for pid, shard in zip(patient_ids, owners.tolist()) if shard in refused],
+    })
+    response.status_code = max(status for status, _ in refused.values())
+    response.headers['Retry-After'] = str(retry_after)
+    return response
+
+@api.route('/api/realtime/<patient_id>', methods=['GET'])
 def get_realtime_data(patient_id):
     """Generate simulated real-time patient data"""
+    shard = owner_shard(patient_id)
+    if shard is not None:
+        return forward_request(shard)
     if patient_id not in patients:
         return jsonify({"error": "Patient not found"}), 404
     
-    patient = patients[patient_id]
-    conditions = patient.get('conditions', [])
-    
-    # Get the last recorded vitals
-    last_hr = patient['vitals']['heart_rate'][-1]
-    last_bp = patient['vitals']['blood_pressure'][-1]
-    last_temp = patient['vitals']['temperature'][-1]
-    last_o2 = patient['vitals']['oxygen_saturation'][-1]
-    
-    # Simulate small changes in vitals
-    new_hr = max(40, min(180, last_hr + random.uniform(-5, 5)))
-    
-    # Parse last BP
-    systolic, diastolic = map(int, last_bp.split('/'))
-    new_systolic = max(80, min(200, systolic + random.uniform(-5, 5)))
-    new_diastolic = max(40, min(120, diastolic + random.uniform(-3, 3)))
-    new_bp = f"{int(new_systolic)}/{int(new_diastolic)}"
-    
-    new_temp = max(95, min(104, last_temp + random.uniform(-0.3, 0.3)))
-    new_o2 = max(80, min(100, last_o2 + random.uniform(-2, 2)))
-    
-    # Add anomalies based on conditions
-    if "Hypertension" in conditions and random.random() < 0.2:
-        new_systolic += random.uniform(5, 15)
-        new_bp = f"{int(new_systolic)}/{int(new_diastolic)}"
-    
-    if "Coronary Artery Disease" in conditions and random.random() < 0.15:
-        new_hr += random.uniform(10, 20)
-    
-    if "Asthma" in conditions and random.random() < 0.1:
-        new_o2 -= random.uniform(3, 8)
-    
-    # Create real-time data object
-    realtime_data = {
-        "timestamp": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
-        "heart_rate": round(new_hr, 1),
-        "blood_pressure": new_bp,
-        "temperature": round(new_temp, 1),
-        "oxygen_saturation": round(new_o2, 1),
-        "alerts": []
-    }
-    
-    # Generate alerts based on abnormal values
-    if new_hr > 100:
-        realtime_data["alerts"].append({
-            "type": "warning",
-            "message": "Elevated heart rate detected"
-        })
-    elif new_hr < 60:
-        realtime_data["alerts"].append({
-            "type": "warning",
-            "message": "Low heart rate detected"
-        })
-    
-    if new_systolic > 140 or new_diastolic > 90:
-        realtime_data["alerts"].append({
-            "type": "warning",
-            "message": "Elevated blood pressure detected"
-        })
-    
-    if new_temp > 99.5:
-        realtime_data["alerts"].append({
-            "type": "warning",
-            "message": "Elevated temperature detected"
-        })
-    
-    if new_o2 < 95:
-        realtime_data["alerts"].append({
-            "type": "danger",
-            "message": "Low oxygen saturation detected"
-        })
-    
-    return jsonify(realtime_data)
+    return jsonify(simulate_realtime(patient_id))
 
-def generate_ai_insights(patient):
-    """Generate AI-based insights for the patient"""
-    insights = []
-    
-    # Check for patterns in vitals
-    hr_values = patient['vitals']['heart_rate']
-    if len(hr_values) >= 3:
-        if all(hr > 85 for hr in hr_values[-3:]):
-            insights.append({
-                "type": "pattern",
-                "message": "Consistently elevated heart rate detected over multiple readings",
-                "confidence": 0.92
-            })
-    
-    # Check lab results
-    if 'lab_results' in patient:
-        if 'glucose' in patient['lab_results']:
-            glucose_values = patient['lab_results']['glucose']
-            if any(g > 125 for g in glucose_values):
-                insights.append({
-                    "type": "lab",
-                    "message": "Elevated glucose levels may indicate poor glycemic control",
-                    "confidence": 0.89
-                })
-        
-        if 'cholesterol' in patient['lab_results']:
-            chol_values = patient['lab_results']['cholesterol']
-            if any(c > 200 for c in chol_values):
-                insights.append({
-                    "type": "lab",
-                    "message": "Elevated cholesterol levels detected; consider lipid management therapy",
-                    "confidence": 0.94
-                })
-    
-    # Check for medication interactions
-    medications = patient.get('medications', [])
-    if len(medications) >= 2:
-        insights.append({
-            "type": "medication",
-            "message": f"Multiple medications detected ({', '.join(medications)}). Monitor for potential interactions.",
-            "confidence": 0.87
-        })
-    
-    # Add a random insight based on conditions
-    conditions = patient.get('conditions', [])
-    if conditions:
-        condition = random.choice(conditions)
-        if condition == "Hypertension":
-            insights.append({
-                "type": "lifestyle",
-                "message": "Consider DASH diet to help manage hypertension",
-                "confidence": 0.91
-            })
-        elif condition == "Type 2 Diabetes":
-            insights.append({
-                "type": "lifestyle",
-                "message": "Regular physical activity may improve insulin sensitivity",
-                "confidence": 0.93
-            })
-        elif condition == "Asthma":
-            insights.append({
-                "type": "environmental",
-                "message": "Monitor air quality index to prevent asthma exacerbations",
-                "confidence": 0.88
-            })
-        elif condition == "Coronary Artery Disease":
-            insights.append({
-                "type": "risk",
-                "message": "Stress management techniques may reduce cardiovascular risk",
-                "confidence": 0.85
-            })
-    
-    return insights
+def simulate_realtime(patient_id):
+    """Simulate and persist the next real-time reading for a patient"""
+    return ward_simulator.tick([vitals_store.row(patient_id)]).payload(0)
+
+@api.route('/api/realtime', methods=['POST'])
+def get_realtime_batch():
+    """Generate simulated real-time data for several patients ({"patient_ids": [...]})"""
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict):
+        return jsonify({"error": "The body must be a JSON object"}), 400
+    patient_ids = data.get('patient_ids') or []
+    if not _is_string_list(patient_ids):
+        return jsonify({"error": "patient_ids must be a list of strings"}), 400
+    if not patient_ids:
+        return jsonify({"error": "patient_ids is required"}), 400
+    unknown = [pid for pid in patient_ids if pid not in patients]
+    if unknown:
+        return jsonify({"error": "Patient not found", "patient_ids": unknown}), 404
+    return jsonify(_realtime_payloads(patient_ids))
+
+def _realtime_payloads(patient_ids):
+    # One batched tick per owning shard for every subscribed patient
+    patient_ids = [pid for pid in patient_ids if pid in patients]
+    local = patient_ids
+    payloads = {}
+    if sharding.ENABLED:
+        owners = sharding.shards_of(patient_ids).tolist()
+        local = [pid for pid, shard in zip(patient_ids, owners) if shard == sharding.SHARD]
+        for shard in sorted(set(owners) - {sharding.SHARD}):
+            body = encode({"patient_ids": [pid for pid, owner in zip(patient_ids, owners) if owner == shard]})
+            try:
+                status, _, result = sharding.forward(shard, 'POST', '/api/realtime', body, [('Content-Type', 'application/json')])
+            except sharding.FORWARD_ERRORS:
+                continue
+            if status == 200:
+                payloads.update(json.loads(result))
+    tick = ward_simulator.tick([vitals_store.row(pid) for pid in local])
+    payloads.update((pid, tick.payload(i)) for i, pid in enumerate(local))
+    return {pid: payloads[pid] for pid in patient_ids if pid in payloads}
+
+vitals_broadcaster = VitalsBroadcaster(_realtime_payloads)
 
-# Sample medical images data
-medical_images = {
+def _event_stream(patient_ids):
+    subscription = vitals_broadcaster.subscribe(patient_ids)
+    return Response(
+        vitals_broadcaster.stream(subscription),
+        mimetype='text/event-stream',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+    )
+
+@api.route('/api/stream/<patient_id>', methods=['GET'])
+def stream_realtime_data(patient_id):
+    """Stream real-time vitals and alerts for a patient as Server-Sent Events"""
+    if patient_id not in patients:
+        return jsonify({"error": "Patient not found"}), 404
+    return _event_stream([patient_id])
+
+@api.route('/api/stream', methods=['GET'])
+def stream_ward_data():
+    """Stream real-time vitals for several patients (?patient_ids=P001,P002) over one connection"""
+    patient_ids = [pid for pid in request.args.get('patient_ids', '').split(',') if pid]
+    if not patient_ids:
+        return jsonify({"error": "patient_ids is required"}), 400
+    unknown = [pid for pid in patient_ids if pid not in patients]
+    if unknown:
+        return jsonify({"error": "Patient not found", "patient_ids": unknown}), 404
+    return _event_stream(patient_ids)
+
+# Sample medical images data, used to seed an empty repository
+sample_medical_images = {
     "P001": [
         {
             "id": "IMG001",
@@ -360,221 +1002,559 @@ medical_images = {
     ]
 }
 
-@app.route('/api/images/<patient_id>', methods=['GET'])
+def _load_images():
+    """Seed an empty repository with the sample studies, or index the stored image metadata"""
+    if not repository.count('images'):
+        for patient_id, images in sample_medical_images.items():
+            for image in images:
+                image_catalog.add(patient_id, image)
+        return
+    for image_id, fields in repository.project('images', ('patient_id', 'image.type', 'image.body_part', 'image.date')):
+        try:
+            validate_image({"id": image_id, "type": fields['image.type'], "body_part": fields['image.body_part'],
+                            "date": fields['image.date']})
+        except ValueError as exc:
+            # Stored before images were validated; leave it out of the indexes
+            print(f"Skipping invalid image record {image_id}: {exc}")
+            continue
+        image_catalog.index(fields['patient_id'], image_id, fields['image.type'], fields['image.body_part'], fields['image.date'])
+
+# Encoded metadata of queried images, reused until the owner's images change
+image_fragments = FragmentCache()
+
+def image_fragment(image_id):
+    owner = image_catalog.patient_of(image_id)
+    return image_fragments.get(
+        ('image', image_id, owner),
+        record_version(('images', owner)),
+        lambda: dict(image_catalog.get(image_id), patient_id=owner)
+    )
+
+# Seconds clients may reuse derivatives before revalidating them
+DERIVATIVE_MAX_AGE = 3600
+
+def image_file(image):
+    """Path of an image's file under the static folder, or None"""
+    url = image.get('url', '')
+    if not url.startswith(STATIC_URL_PATH + '/'):
+        return None
+    path = safe_join(STATIC_FOLDER, url[len(STATIC_URL_PATH) + 1:])
+    return path if path and os.path.isfile(path) else None
+
+
+STORAGE_POLL_INTERVAL = float(os.environ.get('MEDNEXUS_STORAGE_POLL_INTERVAL', 1.0))
+_last_poll = [0.0]
+
+@api.before_app_request
+def apply_repository_changes():
+    """Pick up writes made by other worker processes sharing the repository and vitals store"""
+    now = time.monotonic()
+    if now - _last_poll[0] < STORAGE_POLL_INTERVAL:
+        return
+    _last_poll[0] = now
+    if vitals_store.shared:
+        vitals_store.sync()
+    for table, key in repository.poll_changes():
+        if table == 'patients':
+            patient = patients.get(key)
+            if patient is not None:
+                index_patient(key, patient)
+            mark_changed(('patient', key), ('patients',))
+        elif table == 'vitals' and not vitals_store.shared:
+            latest = vitals_store.latest(key) if key in vitals_store else None
+            since = latest['timestamp'] if latest else float('-inf')
+            for _, samples in repository.vitals(key):
+                newer = samples['timestamp'] > since
+                vitals_store.extend(key, samples['timestamp'][newer], {m: v[newer] for m, v in samples.items()})
+        elif table == 'knowledge':
+            entry = knowledge_base.get(key)
+            if entry is None:
+                knowledge_index.remove(key)
+            else:
+                knowledge_index.put(key, entry)
+            rule_engine.invalidate()
+            mark_changed(('knowledge', key))
+        elif table == 'interactions':
+            interaction = added_interactions.get(key)
+            if interaction is not None:
+                drug_interactions.add(*(interaction[field] for field in INTERACTION_FIELDS))
+        elif table == 'images':
+            previous_owner = image_catalog.patient_of(key)
+            image_catalog.unindex(key)
+            document = repository.get('images', key)
+            if document is not None:
+                image = document['image']
+                image_catalog.index(document['patient_id'], key, image['type'], image['body_part'], image['date'])
+                mark_changed(('images', document['patient_id']))
+            if previous_owner is not None:
+                mark_changed(('images', previous_owner))
+
+@api.route('/api/images/<patient_id>', methods=['GET'])
 def get_patient_images(patient_id):
     """Get medical images for a patient"""
-    if patient_id not in medical_images:
-        return jsonify([])
-    return jsonify(medical_images[patient_id])
+    return cached_json(('images', patient_id), [('images', patient_id)], lambda: image_catalog.for_patient(patient_id))
+
+@api.route('/api/images/<patient_id>', methods=['POST'])
+def add_patient_image(patient_id):
+    """Register image metadata for a patient"""
+    if patient_id not in patients:
+        return jsonify({"error": "Patient not found"}), 404
+    image = request.get_json(silent=True)
+    try:
+        validate_image(image)
+    except ValueError as exc:
+        return jsonify({"error": str(exc)}), 400
+    owner = image_catalog.patient_of(image["id"])
+    if owner is not None and owner != patient_id:
+        return jsonify({"error": "Image ID belongs to another patient"}), 409
+    image_catalog.add(patient_id, image)
+    mark_changed(('images', patient_id))
+    path = image_file(image)
+    if path is not None:
+        image_derivatives.warm(path)
+    return jsonify(image), 201
+
+def _image_source(image_id):
+    image = image_catalog.get(image_id)
+    return image_file(image) if image else None
+
+@api.route('/api/images/<image_id>/original', methods=['GET'])
+def get_image_original(image_id):
+    """Stream the original image file, with Range and conditional request support"""
+    path = _image_source(image_id)
+    if path is None:
+        return jsonify({"error": "Image not found"}), 404
+    return send_file(path, conditional=True)
+
+def _send_derivative(locate, name):
+    """Send the cached derivative at the path ``locate()`` returns (None when there is none)
+
+    Another process may evict the file between the lookup and opening it;
+    the lookup is then repeated once, which rebuilds it.
+    """
+    for _ in range(2):
+        path = locate()
+        if path is None:
+            break
+        try:
+            return send_file(path, mimetype='image/jpeg', conditional=True, max_age=DERIVATIVE_MAX_AGE)
+        except FileNotFoundError:
+            continue
+    return jsonify({"error": f"{name} not found"}), 404
+
+@api.route('/api/images/<image_id>/thumbnail', methods=['GET'])
+def get_image_thumbnail(image_id):
+    """JPEG thumbnail of an image (?size= one of 256, 128, 512)"""
+    path = _image_source(image_id)
+    if path is None:
+        return jsonify({"error": "Image not found"}), 404
+    try:
+        size = int(request.args.get('size', THUMBNAIL_SIZES[0]))
+        return _send_derivative(lambda: image_derivatives.thumbnail(path, size), "Thumbnail")
+    except UndecodableImage as exc:
+        return jsonify({"error": str(exc)}), 422
+    except ValueError as exc:
+        return jsonify({"error": str(exc)}), 400
+
+@api.route('/api/images/<image_id>/pyramid', methods=['GET'])
+def get_image_pyramid(image_id):
+    """Tile pyramid manifest of an image: dimensions, tile size, per-level grids and a tile URL template"""
+    path = _image_source(image_id)
+    if path is None:
+        return jsonify({"error": "Image not found"}), 404
+    try:
+        manifest = dict(image_derivatives.pyramid(path))
+    except UndecodableImage as exc:
+        return jsonify({"error": str(exc)}), 422
+    manifest["tile_url"] = url_for('.get_image_tile', image_id=image_id, level=0, column=0, row=0).replace(
+        '/0/0_0.jpg', '/{level}/{column}_{row}.jpg')
+    return jsonify(manifest)
 
-@app.route('/api/analyze/image', methods=['POST'])
+@api.route('/api/images/<image_id>/tiles/<int:level>/<int:column>_<int:row>.jpg', methods=['GET'])
+def get_image_tile(image_id, level, column, row):
+    """One JPEG tile of an image's pyramid; level 0 is full resolution"""
+    path = _image_source(image_id)
+    if path is None:
+        return jsonify({"error": "Image not found"}), 404
+    try:
+        return _send_derivative(lambda: image_derivatives.tile(path, level, column, row), "Tile")
+    except UndecodableImage as exc:
+        return jsonify({"error": str(exc)}), 422
+
+@api.route('/api/images', methods=['GET'])
+def query_images():
+    """Query images by type, body part and date range (?type=&body_part=&from=&to=&limit=&cursor=)"""
+    try:
+        limit = min(int(request.args.get('limit', 50)), 500)
+        image_ids, next_cursor = image_catalog.query_ids(
+            type=request.args.get('type'),
+            body_part=request.args.get('body_part'),
+            date_from=request.args.get('from'),
+            date_to=request.args.get('to'),
+            limit=max(limit, 1),
+            cursor=request.args.get('cursor')
+        )
+    except ValueError as exc:
+        return jsonify({"error": str(exc)}), 400
+    images = [image_fragment(image_id) for image_id in image_ids]
+    return jsonify(projected({"images": images, "next_cursor": next_cursor}))
+
+MAX_JOB_WAIT = 30.0
+
+def _job_response(job, wait):
+    if wait:
+        job.done.wait(min(wait, MAX_JOB_WAIT))
+    response = jsonify(job.as_dict())
+    response.status_code = 200 if job.done.is_set() else 202
+    response.headers['Location'] = url_for('.get_image_analysis', job_id=job.id)
+    return response
+
+@api.route('/api/analyze/image', methods=['POST'])
 def analyze_medical_image():
-    """Simulate AI analysis of a medical image"""
-    data = request.json
+    """Queue AI analysis of a medical image; returns a job to poll (optionally ``wait`` seconds for it)"""
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict):
+        return jsonify({"error": "The body must be a JSON object"}), 400
     image_id = data.get('image_id')
+    if not isinstance(image_id, str):
+        return jsonify({"error": "image_id must be a string"}), 400
+    try:
+        wait = float(data.get('wait') or 0)
+    except (TypeError, ValueError):
+        return jsonify({"error": "wait must be a number"}), 400
     
     # Find the image
-    image_data = None
-    for patient_id, images in medical_images.items():
-        for image in images:
-            if image['id'] == image_id:
-                image_data = image
-                break
-        if image_data:
-            break
+    image_data = image_catalog.get(image_id)
     
     if not image_data:
         return jsonify({"error": "Image not found"}), 404
     
-    # Simulate AI analysis based on image type
-    analysis_result = {
-        "image_id": image_id,
-        "analysis_timestamp": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
-        "confidence_score": random.uniform(0.82, 0.97),
-        "findings": [],
-        "recommendations": []
-    }
+    path = image_file(image_data)
+    if path is None:
+        return jsonify({"error": "Image file not available"}), 404
     
-    if image_data['type'] == 'X-Ray' and image_data['body_part'] == 'Chest':
-        analysis_result['findings'] = [
-            {
-                "description": "Lung fields appear clear",
-                "confidence": 0.95,
-                "location": "Bilateral lung fields"
-            },
-            {
-                "description": "No evidence of consolidation or effusion",
-                "confidence": 0.93,
-                "location": "Bilateral lung fields"
-            },
-            {
-                "description": "Heart size within normal limits",
-                "confidence": 0.97,
-                "location": "Cardiac silhouette"
-            }
-        ]
-        analysis_result['recommendations'] = [
-            "No further imaging required at this time",
-            "Recommend follow-up X-ray in 12 months"
-        ]
+    job = image_jobs.submit(image_id, path, {"type": image_data['type'], "body_part": image_data['body_part']})
+    return _job_response(job, wait)
+
+@api.route('/api/analyze/image/<job_id>', methods=['GET'])
+def get_image_analysis(job_id):
+    """Status and, once done, result of an image analysis job (?wait= long-polls up to 30s)"""
+    shard = job_shard(job_id)
+    if shard is not None:
+        return forward_request(shard)
+    job = image_jobs.get(job_id)
+    if job is None:
+        return jsonify({"error": "Job not found"}), 404
+    try:
+        wait = float(request.args.get('wait', 0))
+    except ValueError:
+        return jsonify({"error": "wait must be a number"}), 400
+    return _job_response(job, wait)
+
+# Latest progression predictions per patient, with the data versions they
+# were scored from; the least recently used are dropped beyond the cap
+progression_memo = collections.OrderedDict()
+progression_memo_lock = threading.Lock()
+MAX_PROGRESSION_MEMO = int(os.environ.get('MEDNEXUS_PROGRESSION_MEMO_SIZE', 65536))
+
+PROGRESSION_CHUNK_SIZE = 1024
+
+@timed
+def predict_progressions(patient_ids):
+    """Predict progression for every condition of each patient, keyed by patient ID
+
+    Patients whose record and vitals are unchanged since they were last
+    scored are served from ``progression_memo``; the rest are scored
+    together, one model call per condition.
+    """
+    results = {}
+    stale = []
+    for patient_id in patient_ids:
+        versions = (record_version(('patient', patient_id)), vitals_store.version_of(patient_id))
+        with progression_memo_lock:
+            memo = progression_memo.get(patient_id)
+            fresh = memo is not None and memo[0] == versions
+            if fresh:
+                progression_memo.move_to_end(patient_id)
+        if fresh:
+            results[patient_id] = memo[1]
+        else:
+            stale.append((patient_id, versions))
+    if not stale:
+        return results
     
-    elif image_data['type'] == 'MRI' and image_data['body_part'] == 'Brain':
-        analysis_result['findings'] = [
-            {
-                "description": "No evidence of acute infarction",
-                "confidence": 0.94,
-                "location": "Entire brain"
-            },
-            {
-                "description": "No mass effect or midline shift",
-                "confidence": 0.96,
-                "location": "Entire brain"
-            },
-            {
-                "description": "Ventricles normal in size and configuration",
-                "confidence": 0.95,
-                "location": "Ventricular system"
-            }
-        ]
-        analysis_result['recommendations'] = [
-            "No further imaging required at this time",
-            "Clinical correlation recommended"
-        ]
+    records = [(patients[patient_id], vitals_store.snapshot(patient_id)) for patient_id, _ in stale]
+    pairs = [(i, condition) for i, (patient, _) in enumerate(records) for condition in patient.get('conditions', [])]
+    probabilities = iter(get_progression_model().predict(pairs, progression_features(records)) if pairs else [])
+    timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
     
-    elif image_data['type'] == 'CT Scan' and image_data['body_part'] == 'Chest':
-        analysis_result['findings'] = [
-            {
-                "description": "Mild coronary artery calcification",
-                "confidence": 0.91,
-                "location": "Coronary arteries"
-            },
-            {
-                "description": "No pulmonary nodules or masses",
-                "confidence": 0.89,
-                "location": "Lung parenchyma"
-            },
-            {
-                "description": "No pleural effusion",
-                "confidence": 0.94,
-                "location": "Pleural space"
+    for (patient_id, versions), (patient, _) in zip(stale, records):
+        latest_vitals = vitals_store.latest(patient_id) or {}
+        rng = random.Random(patient_id)
+        predictions = []
+        for condition in patient.get('conditions', []):
+            p = next(probabilities)
+            trajectory = max(p, key=p.get)
+            prediction = {
+                "condition": condition,
+                "time_horizon": "6 months",
+                "prediction_timestamp": timestamp,
+                "confidence": p[trajectory],
+                "trajectory": trajectory,
+                "probabilities": p
             }
-        ]
-        analysis_result['recommendations'] = [
-            "Consider cardiac risk assessment",
-            "Follow-up with cardiologist recommended"
-        ]
-    
-    return jsonify(analysis_result)
+            
+            # Add condition-specific predictions
+            prediction.update(rule_engine.progression(condition, patient, latest_vitals, rng, p))
+            predictions.append(prediction)
+        with progression_memo_lock:
+            progression_memo[patient_id] = (versions, predictions)
+            progression_memo.move_to_end(patient_id)
+            while len(progression_memo) > MAX_PROGRESSION_MEMO:
+                progression_memo.popitem(last=False)
+        results[patient_id] = predictions
+    return results
 
-@app.route('/api/predict/progression/<patient_id>', methods=['GET'])
+@api.route('/api/predict/progression/<patient_id>', methods=['GET'])
 def predict_disease_progression(patient_id):
     """Predict disease progression for a patient"""
     if patient_id not in patients:
         return jsonify({"error": "Patient not found"}), 404
     
-    patient = patients[patient_id]
-    conditions = patient.get('conditions', [])
-    
-    if not conditions:
+    if not patients[patient_id].get('conditions', []):
         return jsonify({"error": "No conditions to predict progression for"}), 400
     
-    # Generate predictions for each condition
-    predictions = []
-    
-    for condition in conditions:
-        prediction = {
-            "condition": condition,
-            "time_horizon": "6 months",
-            "prediction_timestamp": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
-            "confidence": random.uniform(0.75, 0.92),
-            "trajectory": random.choice(["stable", "improving", "worsening"]),
-            "risk_factors": [],
-            "recommendations": []
-        }
-        
-        # Add condition-specific predictions
-        if condition == "Hypertension":
-            prediction["risk_factors"] = ["Sodium intake", "Stress levels", "Medication adherence"]
-            prediction["key_metrics"] = {
-                "current_bp": patient['vitals']['blood_pressure'][-1],
-                "target_bp": "120/80",
-                "probability_of_reaching_target": random.uniform(0.6, 0.8)
-            }
-            prediction["recommendations"] = [
-                "Continue current medication regimen",
-                "Reduce sodium intake to <2g per day",
-                "Implement stress reduction techniques"
-            ]
-        
-        elif condition == "Type 2 Diabetes":
-            prediction["risk_factors"] = ["Dietary habits", "Physical activity", "Weight management"]
-            prediction["key_metrics"] = {
-                "current_hba1c": patient['lab_results'].get('hba1c', [6.8])[-1],
-                "target_hba1c": "<6.5%",
-                "probability_of_reaching_target": random.uniform(0.5, 0.75)
-            }
-            prediction["recommendations"] = [
-                "Maintain carbohydrate-controlled diet",
-                "Increase physical activity to 150 minutes per week",
-                "Monitor blood glucose levels daily"
-            ]
-        
-        elif condition == "Asthma":
-            prediction["risk_factors"] = ["Environmental triggers", "Seasonal allergies", "Medication adherence"]
-            prediction["key_metrics"] = {
-                "current_o2": patient['vitals']['oxygen_saturation'][-1],
-                "exacerbation_risk": random.choice(["low", "moderate", "high"]),
-                "probability_of_exacerbation": random.uniform(0.1, 0.4)
-            }
-            prediction["recommendations"] = [
-                "Continue current inhaler regimen",
-                "Avoid known triggers",
-                "Consider allergy testing"
-            ]
-        
-        elif condition == "Coronary Artery Disease":
-            prediction["risk_factors"] = ["Lipid levels", "Blood pressure control", "Physical activity"]
-            prediction["key_metrics"] = {
-                "current_cholesterol": patient['lab_results'].get('cholesterol', [185])[-1],
-                "target_ldl": "<100 mg/dL",
-                "probability_of_cardiac_event": random.uniform(0.05, 0.2)
-            }
-            prediction["recommendations"] = [
-                "Continue statin therapy",
-                "Maintain blood pressure control",
-                "Cardiac rehabilitation program"
-            ]
-        
-        predictions.append(prediction)
-    
-    return jsonify(predictions)
+    return jsonify(predict_progressions([patient_id])[patient_id])
 
-if __name__ == '__main__':
-    # Create directories if they don't exist
-    for directory in ['templates', 'static/images']:
-        if not os.path.exists(directory):
-            os.makedirs(directory)
+@api.route('/api/predict/progression/batch', methods=['POST'])
+def predict_progression_batch():
+    """Predict progression for a list of patients or a filtered cohort, streamed back as NDJSON"""
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict):
+        return jsonify({"error": "The body must be a JSON object"}), 400
+    patient_ids = data.get('patient_ids')
+    filters = data.get('filter')
+    if patient_ids is None and filters is None:
+        return jsonify({"error": "Provide patient_ids or filter"}), 400
+    try:
+        if patient_ids is not None and not _is_string_list(patient_ids):
+            raise ValueError("patient_ids must be a list of strings")
+        if filters is not None:
+            _batch_filters(filters)
+    except ValueError as exc:
+        return jsonify({"error": str(exc)}), 400
+    if patient_ids is None:
+        patient_ids = select_patients(filters)
     
-    # Create placeholder images for demo
-    placeholder_images = {
-        'chest_xray.jpg': (300, 250),
-        'brain_mri.jpg': (300, 250),
-        'chest_ct.jpg': (300, 250)
-    }
+    def generate():
+        for start in range(0, len(patient_ids), PROGRESSION_CHUNK_SIZE):
+            chunk = patient_ids[start:start + PROGRESSION_CHUNK_SIZE]
+            predictions = predict_progressions([pid for pid in chunk if pid in patients])
+            for patient_id in chunk:
+                if patient_id not in predictions:
+                    line = {"patient_id": patient_id, "error": "Patient not found"}
+                else:
+                    line = {"patient_id": patient_id, "predictions": predictions[patient_id]}
+                yield json.dumps(line, sort_keys=True) + "\n"
     
+    return Response(generate(), mimetype='application/x-ndjson')
+
+@api.route('/api/analytics/conditions', methods=['GET'])
+def get_condition_prevalence():
+    """Condition prevalence (?age_band=&gender=)"""
+    try:
+        return jsonify(population.prevalence(request.args.get('age_band'), request.args.get('gender')))
+    except ValueError as exc:
+        return jsonify({"error": str(exc)}), 400
+
+@api.route('/api/analytics/vitals', methods=['GET'])
+def get_vitals_distribution():
+    """Latest-reading distribution of a metric (?metric=&by=age_band&by=gender)"""
+    args = request.args
+    by = args.getlist('by') if 'by' in args else ['age_band', 'gender']
     try:
-        from PIL import Image, ImageDraw, ImageFont
-        for img_name, size in placeholder_images.items():
-            img_path = os.path.join('static/images', img_name)
-            if not os.path.exists(img_path):
-                # Create a placeholder image with text
-                img = Image.new('RGB', size, color=(240, 240, 240))
-                d = ImageDraw.Draw(img)
-                d.rectangle([0, 0, size[0]-1, size[1]-1], outline=(200, 200, 200))
-                d.text((size[0]//2-50, size[1]//2), f"MedNexus AI\n{img_name}", fill=(100, 100, 100))
-                img.save(img_path)
-                print(f"Created placeholder image: {img_path}")
+        return jsonify(population.vitals(args.get('metric', 'heart_rate'), [field for field in by if field]))
+    except ValueError as exc:
+        return jsonify({"error": str(exc)}), 400
+
+@api.route('/api/analytics/alerts', methods=['GET'])
+def get_alert_counts():
+    """Alerts per time bucket (?from=&to=, default the last hour)"""
+    args = request.args
+    try:
+        end = _time_arg(args['to']) if 'to' in args else time.time()
+        start = _time_arg(args['from']) if 'from' in args else max(end - 3600, 0)
+        if start > end:
+            raise ValueError("from must not be after to")
+    except ValueError as exc:
+        return jsonify({"error": str(exc)}), 400
+    return jsonify(population.alerts(start, end))
+
+@api.route('/api/analytics/groupby', methods=['GET'])
+def get_population_groupby():
+    """Ad-hoc aggregate over the population snapshot (?by=&column=&agg=)
+
+    ``by`` may repeat and names ``age_band``, ``gender`` or a condition;
+    ``column`` is age, n_conditions, n_medications or a vitals metric.
+    """
+    args = request.args
+    try:
+        groups = population.group_by(args.getlist('by'), args.get('column', 'age'), args.get('agg', 'mean'))
+    except ValueError as exc:
+        return jsonify({"error": str(exc)}), 400
+    return jsonify({"groups": groups})
+
+@api.route('/metrics', methods=['GET'])
+def get_metrics():
+    """Request and function metrics in the Prometheus text format"""
+    return Response(REGISTRY.render(), mimetype='text/plain; version=0.0.4')
+
+# Stack sampling on demand, for flame graphs; off unless MEDNEXUS_PROFILER=1
+profiler = SamplingProfiler() if os.environ.get('MEDNEXUS_PROFILER') == '1' else None
+
+MAX_PROFILE_SECONDS = 60.0
+
+@api.route('/debug/profile', methods=['GET'])
+def get_profile():
+    """Sample every thread's stack for ``seconds`` (default 10) and return folded stacks"""
+    if profiler is None:
+        return jsonify({"error": "Profiler is disabled"}), 404
+    try:
+        seconds = min(float(request.args.get('seconds', 10)), MAX_PROFILE_SECONDS)
+    except ValueError:
+        return jsonify({"error": "seconds must be a number"}), 400
+    try:
+        stacks = profiler.profile(seconds)
+    except RuntimeError as exc:
+        return jsonify({"error": str(exc)}), 409
+    return Response(stacks, mimetype='text/plain')
+
+PLACEHOLDER_IMAGES = {
+    'chest_xray.jpg': (300, 250),
+    'brain_mri.jpg': (300, 250),
+    'chest_ct.jpg': (300, 250)
+}
+
+def create_placeholder_images():
+    """Draw the demo images the sample studies point at, where they are missing"""
+    directory = os.path.join(STATIC_FOLDER, 'images')
+    missing = [name for name in PLACEHOLDER_IMAGES if not os.path.exists(os.path.join(directory, name))]
+    if not missing:
+        return
+    try:
+        from PIL import Image, ImageDraw
     except ImportError:
         print("PIL not available, skipping image creation")
-    
-    app.run(host='0.0.0.0', port=8080, debug=True)
\ No newline at end of file
+        return
+    os.makedirs(directory, exist_ok=True)
+    for img_name in missing:
+        size = PLACEHOLDER_IMAGES[img_name]
+        img_path = os.path.join(directory, img_name)
+        # Create a placeholder image with text
+        img = Image.new('RGB', size, color=(240, 240, 240))
+        d = ImageDraw.Draw(img)
+        d.rectangle([0, 0, size[0]-1, size[1]-1], outline=(200, 200, 200))
+        d.text((size[0]//2-50, size[1]//2), f"MedNexus AI\n{img_name}", fill=(100, 100, 100))
+        # Written under a temporary name, so a request never sees a partial file;
+        # the name is per process, as several workers may be drawing the same image
+        tmp_path = f"{img_path}.{os.getpid()}.tmp"
+        img.save(tmp_path, format='JPEG')
+        os.replace(tmp_path, img_path)
+        print(f"Created placeholder image: {img_path}")
+
+_services_lock = threading.Lock()
+_services_started = False
+
+def start_services():
+    """Open the repository and build every service from it, once per process
+
+    Derived state (indexes, population aggregates, rollups and anomaly
+    statistics) is built in batches over the whole cohort rather than
+    patient by patient.
+    """
+    global repository, patients, drug_interactions, added_interactions, medication_census, vitals_store
+    global anomaly_detector, ward_simulator, population, vitals_ingestor, vitals_rollups
+    global knowledge_base, knowledge_index, rule_engine, image_catalog, image_derivatives, image_jobs
+    global _services_started
+    with _services_lock:
+        if _services_started:
+            return
+        repository = open_repository(os.environ.get('MEDNEXUS_STORAGE', 'memory'))
+        patients = repository.table('patients')
+
+        # Drug interactions: the bundled table plus those added through the API,
+        # and every patient's medications for screening the census
+        drug_interactions = InteractionTable.load()
+        added_interactions = repository.table('interactions')
+        for interaction in added_interactions.values():
+            drug_interactions.add(*(interaction[field] for field in INTERACTION_FIELDS))
+        medication_census = MedicationCensus(drug_interactions)
+
+        # Vitals are served from the columnar ring-buffer store, kept in shared
+        # memory when serve.py runs several shards
+        vitals_store = sharding.open_vitals_store()
+        anomaly_detector = AnomalyDetector()
+        ward_simulator = WardSimulator(vitals_store, detector=anomaly_detector)
+        # Cohort-level prevalence, vitals distributions and alert counts
+        population = PopulationAggregates(vitals_store, detector=anomaly_detector)
+        _load_patients()
+
+        # Restore the readings logged before a restart
+        vitals_ingestor = open_ingestor(vitals_store)
+        vitals_ingestor.recover(resume=sharding.RESTARTED)
+
+        # Min/max/mean rollups of every sample retained and appended from here on
+        vitals_rollups = VitalsRollups(vitals_store)
+        vitals_rollups.attach()
+        # Rolling statistics for trend-aware alerts and insights
+        anomaly_detector.attach(vitals_store)
+        # Attached after the detector, so alert counts see each append's anomaly state
+        population.attach()
+        # A shared store replays every sample already in it to the listeners
+        if vitals_store.shared:
+            vitals_store.sync()
+
+        knowledge_base = repository.table('knowledge')
+        if not repository.count('knowledge'):
+            knowledge_base.update(sample_knowledge_base)
+        # Full-text, prefix and typo-tolerant search over the knowledge base
+        knowledge_index = KnowledgeIndex(_valid_conditions(knowledge_base.items()))
+        # Compile the clinical rules against the knowledge base once at startup
+        rule_engine = RuleEngine.load(knowledge_base, interactions=drug_interactions)
+
+        # Image metadata is stored per image ID; the catalog indexes it
+        image_catalog = ImageCatalog(repository.table('images'))
+        _load_images()
+        # Thumbnails and tile pyramids, generated on first request and cached on disk
+        image_derivatives = ImageDerivatives()
+        # Image analysis runs as background jobs on a worker pool
+        image_jobs = ImageAnalysisQueue(id_prefix=sharding.job_prefix())
+        _services_started = True
+
+def create_app():
+    """Build the Flask application and start its background work
+
+    The first call in a process also starts the services (see ``start_services``).
+    """
+    start_services()
+    app = Flask(__name__, static_folder=STATIC_FOLDER, static_url_path=STATIC_URL_PATH, instance_path=INSTANCE_PATH)
+    app.json = FastJSONProvider(app)
+    app.register_blueprint(api)
+
+    # Per-route request metrics, measured around the whole WSGI app
+    if METRICS_ENABLED:
+        app.request_class = InstrumentedRequest
+        app.wsgi_app = RequestMetrics(app.wsgi_app)
+
+    # Off the startup path: nothing served needs the placeholders to exist yet
+    threading.Thread(target=create_placeholder_images, name='placeholder-images', daemon=True).start()
+
+    # Optionally advance the whole ward in the background
+    if float(os.environ.get('MEDNEXUS_SIMULATOR_INTERVAL', 0)) > 0:
+        # Each shard advances the patients it owns
+        rows = sharding.OwnedRows(vitals_store) if sharding.ENABLED else None
+        ward_simulator.start(float(os.environ['MEDNEXUS_SIMULATOR_INTERVAL']), rows)
+    return app
+
+if __name__ == '__main__':
+    create_app().run(host='0.0.0.0', port=8080, debug=True)
@@ -0,0 +1,121 @@
+"""Cohort-level batch analysis across a process pool
+
+The pool is started on first use and kept for the life of the process.
+Its workers load the clinical rules from the rules file. Each chunk of
+patients carries the knowledge base entries and drug interactions those
+patients need, so workers never analyze against a stale copy and only
+plain data crosses the process boundary.
+"""
+import collections
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+from analysis import analyze_patients
+from interactions import InteractionTable
+from rules import RuleEngine
+
+# Processes in the pool; a request may use fewer, but never more
+MAX_WORKERS = int(os.environ.get('MEDNEXUS_ANALYZE_WORKERS', 0)) or os.cpu_count() or 1
+DEFAULT_CHUNK_SIZE = int(os.environ.get('MEDNEXUS_ANALYZE_CHUNK_SIZE', 256))
+MAX_CHUNK_SIZE = 4096
+
+# Rule engine installed in each worker process by the pool initializer
+_worker_engine = None
+
+# Long-lived pools, by the rules file their workers load
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+def _init_worker(rules_path):
+    global _worker_engine
+    _worker_engine = RuleEngine.load({}, rules_path)
+
+
+def _chunks(records, size):
+    chunk = []
+    for record in records:
+        chunk.append(record)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def _analyze_chunk(chunk, engine, timestamp):
+    results = analyze_patients(chunk, engine, timestamp)
+    return [(patient_id, analysis) for (patient_id, _, _), analysis in zip(chunk, results)]
+
+
+def _analyze_chunk_in_worker(chunk, timestamp, context):
+    knowledge_base, interactions = context
+    table = None
+    if interactions is not None:
+        drugs, rows = interactions
+        table = InteractionTable()
+        # Interned in the parent's order, so interactions are reported in the same order
+        for drug in drugs:
+            table.intern(drug)
+        for row in rows:
+            table.add(*row)
+    _worker_engine.rebind(knowledge_base, table)
+    return _analyze_chunk(chunk, _worker_engine, timestamp)
+
+
+def _pool(rules_path):
+    with _pools_lock:
+        pool = _pools.get(rules_path)
+        if pool is None:
+            pool = _pools[rules_path] = ProcessPoolExecutor(
+                max_workers=MAX_WORKERS, initializer=_init_worker, initargs=(rules_path,)
+            )
+        return pool
+
+
+def _discard(rules_path, pool):
+    # A worker died and took the pool with it; the next batch starts a new one
+    with _pools_lock:
+        if _pools.get(rules_path) is pool:
+            del _pools[rules_path]
+    pool.shutdown(wait=False, cancel_futures=True)
+
+
+def analyze_cohort(records, engine, timestamp, workers=None, chunk_size=None):
+    """Analyze ``(patient_id, patient, vitals)`` records, yielding results chunk by chunk
+
+    Chunks are yielded in input order as soon as each one (and every chunk
+    before it) has finished, so the output is identical for any number of
+    workers. At most ``2 * workers`` chunks are in flight, which bounds the
+    memory used for large cohorts. ``workers`` is capped at ``MAX_WORKERS``
+    and ``chunk_size`` at ``MAX_CHUNK_SIZE``; ``workers <= 1``, or an engine
+    not loaded from a rules file, runs in-process.
+    """
+    workers = min(MAX_WORKERS if workers is None else workers, MAX_WORKERS)
+    chunk_size = min(chunk_size or DEFAULT_CHUNK_SIZE, MAX_CHUNK_SIZE)
+    chunks = _chunks(records, chunk_size)
+
+    if workers <= 1 or engine.path is None:
+        for chunk in chunks:
+            yield _analyze_chunk(chunk, engine, timestamp)
+        return
+
+    pool = _pool(engine.path)
+    pending = collections.deque()
+    try:
+        for chunk in chunks:
+            context = engine.context([patient for _, patient, _ in chunk])
+            pending.append(pool.submit(_analyze_chunk_in_worker, chunk, timestamp, context))
+            if len(pending) >= 2 * workers:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+    except BrokenProcessPool:
+        _discard(engine.path, pool)
+        raise
+    finally:
+        # The client went away or a chunk failed: drop the rest of this batch
+        for future in pending:
+            future.cancel()
@@ -0,0 +1,8 @@
+"""Benchmark harness and synthetic cohorts
+
+    python -m benchmarks run --patients 100000 --output baseline.json
+    python -m benchmarks startup --runs 10
+    python -m benchmarks compare baseline.json candidate.json
+
+See ``benchmarks.harness`` for the load profiles and report format.
+"""
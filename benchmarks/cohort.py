@@ -0,0 +1,215 @@
+"""Vectorized synthetic patient cohorts
+
+Every attribute of every patient is drawn at once as a NumPy array from a
+seeded generator, so a million patients take seconds and the same
+``(size, seed)`` always yields the same cohort. Condition prevalence rises
+with age, and conditions shift vitals, labs and medications the way they
+do in the sample patients, so the rules and progression models have
+something realistic to work on.
+"""
+import os
+import time
+
+import numpy as np
+
+from vitals_store import METRICS
+
+FIRST_NAMES = (
+    "James", "Mary", "Robert", "Patricia", "John", "Jennifer", "Michael", "Linda", "David", "Elizabeth",
+    "William", "Barbara", "Richard", "Susan", "Joseph", "Jessica", "Thomas", "Sarah", "Charles", "Karen",
+)
+LAST_NAMES = (
+    "Smith", "Johnson", "Williams", "Brown", "Jones", "Garcia", "Miller", "Davis", "Rodriguez", "Martinez",
+    "Hernandez", "Lopez", "Gonzalez", "Wilson", "Anderson", "Thomas", "Taylor", "Moore", "Jackson", "Martin",
+)
+
+# (condition, prevalence at age 50, medications prescribed for it)
+CONDITIONS = (
+    ("Hypertension", 0.30, ("Lisinopril", "Amlodipine", "Hydrochlorothiazide")),
+    ("Type 2 Diabetes", 0.12, ("Metformin", "Glipizide", "Empagliflozin")),
+    ("Asthma", 0.08, ("Albuterol", "Fluticasone", "Montelukast")),
+    ("Coronary Artery Disease", 0.06, ("Aspirin", "Atorvastatin", "Metoprolol")),
+    ("Hyperlipidemia", 0.20, ("Atorvastatin", "Rosuvastatin", "Ezetimibe")),
+    ("Allergic Rhinitis", 0.10, ("Cetirizine", "Fluticasone", "Loratadine")),
+)
+MEDICATIONS = tuple(sorted({med for _, _, meds in CONDITIONS for med in meds}))
+
+# Per-metric baseline mean and spread, and the noise of successive samples
+VITAL_BASELINE = np.array([72.0, 120.0, 78.0, 98.4, 97.5])
+VITAL_SPREAD = np.array([8.0, 10.0, 7.0, 0.3, 1.0])
+VITAL_NOISE = np.array([3.0, 5.0, 3.0, 0.2, 0.6])
+VITAL_DECIMALS = (0, 0, 0, 1, 0)
+
+# Shift of each metric's baseline per condition, in METRICS order
+VITAL_SHIFTS = {
+    "Hypertension": (2, 18, 10, 0, 0),
+    "Type 2 Diabetes": (3, 4, 2, 0, 0),
+    "Asthma": (4, 0, 0, 0, -1.5),
+    "Coronary Artery Disease": (-4, 6, 3, 0, -1),
+}
+
+# (lab, mean, spread, conditions that raise it and by how much, conditions that order it)
+LABS = (
+    ("glucose", 95, 12, {"Type 2 Diabetes": 50}, ("Type 2 Diabetes",)),
+    ("hba1c", 5.4, 0.3, {"Type 2 Diabetes": 1.6}, ("Type 2 Diabetes",)),
+    ("cholesterol", 190, 30, {"Hyperlipidemia": 40, "Coronary Artery Disease": 10}, ("Hyperlipidemia", "Coronary Artery Disease")),
+    ("ldl", 110, 25, {"Hyperlipidemia": 35, "Coronary Artery Disease": 10}, ("Hyperlipidemia", "Coronary Artery Disease")),
+    ("hdl", 52, 12, {"Hyperlipidemia": -6, "Type 2 Diabetes": -4}, ("Hyperlipidemia", "Coronary Artery Disease")),
+    ("triglycerides", 140, 50, {"Hyperlipidemia": 60, "Type 2 Diabetes": 30}, ("Hyperlipidemia", "Type 2 Diabetes")),
+)
+
+# (type, body part, url, findings) of the images patients may have
+IMAGES = (
+    ("X-Ray", "Chest", "/static/images/chest_xray.jpg", "No significant abnormalities detected"),
+    ("MRI", "Brain", "/static/images/brain_mri.jpg", "Normal brain structure, no lesions detected"),
+    ("CT Scan", "Chest", "/static/images/chest_ct.jpg", "Mild coronary calcification"),
+)
+
+SAMPLES = 48
+SAMPLE_INTERVAL = 300.0
+MAX_LAB_DRAWS = 3
+# Patients whose vitals are generated together
+CHUNK_SIZE = 10000
+
+
+class Cohort:
+    """Column arrays describing ``size`` synthetic patients"""
+
+    def __init__(self, size, seed=0, samples=SAMPLES, end=None):
+        rng = np.random.default_rng(seed)
+        self.size = size
+        self.seed = seed
+        self.ids = np.char.add("P", np.char.zfill(np.arange(size).astype(str), 7))
+        self.age = rng.integers(18, 95, size)
+        self.male = rng.random(size) < 0.49
+        self.first = rng.integers(0, len(FIRST_NAMES), size)
+        self.last = rng.integers(0, len(LAST_NAMES), size)
+
+        # Prevalence doubles every 20 years of age
+        scale = 2.0 ** ((self.age - 50) / 20.0)
+        prevalence = np.array([p for _, p, _ in CONDITIONS])
+        self.conditions = rng.random((size, len(CONDITIONS))) < np.minimum(0.9, prevalence[None, :] * scale[:, None])
+
+        self.medications = np.zeros((size, len(MEDICATIONS)), dtype=bool)
+        column = {med: j for j, med in enumerate(MEDICATIONS)}
+        for c, (_, _, meds) in enumerate(CONDITIONS):
+            # First-line drug for most patients, add-ons for fewer
+            for rank, med in enumerate(meds):
+                self.medications[:, column[med]] |= self.conditions[:, c] & (rng.random(size) < 0.85 / (rank + 1))
+
+        index = {name: c for c, (name, _, _) in enumerate(CONDITIONS)}
+        draws = rng.integers(1, MAX_LAB_DRAWS + 1, size)
+        self.lab_draws = {}
+        for lab, mean, spread, effects, ordered_for in LABS:
+            level = mean + spread * rng.standard_normal((size, 1)) + 0.3 * spread * rng.standard_normal((size, MAX_LAB_DRAWS))
+            for condition, shift in effects.items():
+                level += shift * self.conditions[:, index[condition], None]
+            ordered = np.zeros(size, dtype=bool)
+            for condition in ordered_for:
+                ordered |= self.conditions[:, index[condition]]
+            ordered |= rng.random(size) < 0.3
+            self.lab_draws[lab] = (np.round(np.maximum(level, 0.1 * mean), 1), np.where(ordered, draws, 0))
+
+        baseline = VITAL_BASELINE + VITAL_SPREAD * rng.standard_normal((size, len(METRICS)))
+        baseline[:, 1] += 0.4 * (self.age - 45)
+        baseline[:, 2] += 0.15 * (self.age - 45)
+        for condition, shift in VITAL_SHIFTS.items():
+            baseline += np.outer(self.conditions[:, index[condition]], shift)
+        self.baseline = baseline
+        end = np.floor((time.time() if end is None else end) / SAMPLE_INTERVAL) * SAMPLE_INTERVAL
+        self.timestamps = end - SAMPLE_INTERVAL * np.arange(samples - 1, -1, -1)
+
+        self.has_image = rng.random(size) < 0.3
+        self.image_kind = rng.integers(0, len(IMAGES), size)
+        self.image_age = rng.integers(0, 3 * 365, size)
+
+    def __len__(self):
+        return self.size
+
+    def vitals(self, start, stop):
+        """``(patients, samples, metrics)`` vitals of patients ``start:stop``
+
+        Generated on demand, a chunk at a time, from a generator seeded by
+        the chunk bounds, so large cohorts never hold every series at once.
+        """
+        rng = np.random.default_rng([self.seed, start, stop])
+        # AR(1) noise around each baseline, one step of every series at a time
+        noise = rng.standard_normal((stop - start, len(self.timestamps), len(METRICS)))
+        for t in range(1, noise.shape[1]):
+            noise[:, t] += 0.8 * noise[:, t - 1]
+        noise *= 0.6
+        values = self.baseline[start:stop, None, :] + noise * VITAL_NOISE
+        values[:, :, 4] = np.minimum(values[:, :, 4], 100.0)
+        return np.stack([np.round(values[:, :, j], d) for j, d in enumerate(VITAL_DECIMALS)], axis=2)
+
+    def records(self):
+        """Yield ``(patient_id, document, samples)`` with samples as per-column arrays"""
+        ids = self.ids.tolist()
+        age, male = self.age.tolist(), self.male.tolist()
+        first, last = self.first.tolist(), self.last.tolist()
+        labs = {lab: (values.tolist(), counts.tolist()) for lab, (values, counts) in self.lab_draws.items()}
+        names = [name for name, _, _ in CONDITIONS]
+        for i, patient_id in enumerate(ids):
+            if i % CHUNK_SIZE == 0:
+                vitals = self.vitals(i, min(i + CHUNK_SIZE, self.size))
+            document = {
+                "name": f"{FIRST_NAMES[first[i]]} {LAST_NAMES[last[i]]}",
+                "age": age[i],
+                "gender": "Male" if male[i] else "Female",
+                "conditions": [names[c] for c in np.flatnonzero(self.conditions[i])],
+                "medications": [MEDICATIONS[m] for m in np.flatnonzero(self.medications[i])],
+                "lab_results": {lab: values[i][:counts[i]] for lab, (values, counts) in labs.items() if counts[i]},
+            }
+            samples = {"timestamp": self.timestamps}
+            samples.update({metric: vitals[i % CHUNK_SIZE, :, j] for j, metric in enumerate(METRICS)})
+            yield patient_id, document, samples
+
+    def images(self):
+        """Yield ``(patient_id, image)`` for the patients that have an image"""
+        end_date = np.datetime64(int(self.timestamps[-1]), 's').astype('datetime64[D]')
+        for i in np.flatnonzero(self.has_image).tolist():
+            kind, body_part, url, findings = IMAGES[self.image_kind[i]]
+            yield self.ids[i], {
+                "id": f"IMG{i:07d}",
+                "type": kind,
+                "body_part": body_part,
+                "date": str(end_date - int(self.image_age[i])),
+                "findings": findings,
+                "url": url,
+            }
+
+    def patient_ids(self):
+        return self.ids.tolist()
+
+    def image_ids(self):
+        return [f"IMG{i:07d}" for i in np.flatnonzero(self.has_image).tolist()]
+
+
+def write(cohort, repository):
+    """Store a cohort's patients, vitals and images in a repository"""
+    # Not waited for one by one; flush raises if any of them failed
+    for patient_id, document, samples in cohort.records():
+        repository.put('patients', patient_id, document, wait=False)
+        repository.append_vitals(patient_id, samples, wait=False)
+    for patient_id, image in cohort.images():
+        repository.put('images', image["id"], {"patient_id": patient_id, "image": image}, wait=False)
+    # Written last, so a database interrupted mid-build is recognised as incomplete
+    repository.put('cohort', 'meta', {"size": len(cohort), "seed": cohort.seed})
+    repository.flush()
+
+
+def build(path, size, seed=0):
+    """Create the SQLite database of a cohort at ``path`` unless a complete one exists"""
+    from repository import open_repository
+
+    if os.path.exists(path):
+        repository = open_repository(f'sqlite:///{path}')
+        if repository.get('cohort', 'meta') == {"size": size, "seed": seed}:
+            return path
+        repository.close()
+        for suffix in ('', '-wal', '-shm'):
+            if os.path.exists(path + suffix):
+                os.remove(path + suffix)
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    write(Cohort(size, seed), open_repository(f'sqlite:///{path}'))
+    return path
@@ -0,0 +1,495 @@
+"""Load profiles, measurement and baseline reports
+
+Each profile sends a fixed, seeded sequence of requests to one route,
+either in-process through the Flask test client or over HTTP to a local
+server started for the run, and records the latency of every request. The
+report gives p50/p95/p99 latency, throughput and peak RSS per profile as
+JSON, so runs of different versions can be compared with ``compare``.
+
+``startup`` measures how fast a fresh worker comes up: import time,
+``create_app`` time and first-request latency in a new interpreter, and
+the time from spawning a server process to its first response.
+
+The app is pointed at a copy of a cached cohort database (see
+``benchmarks.cohort``), so every run starts from the same data.
+"""
+import argparse
+import contextlib
+import http.client
+import json
+import os
+import platform
+import resource
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+
+import numpy as np
+
+from benchmarks import cohort as cohorts
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+COHORT_DIR = os.path.join(ROOT, 'instance', 'benchmarks')
+
+DEFAULT_REQUESTS = 1000
+DEFAULT_WARMUP = 20
+# Relative changes beyond this fraction count as regressions in ``compare``
+DEFAULT_THRESHOLD = 0.10
+
+
+class Profile:
+    """A route and the seeded requests sent to it
+
+    ``make(rng, ids)`` returns one ``(path, json_body)`` request; ``ids`` holds
+    the cohort's patient IDs, patients with conditions and image IDs.
+    """
+
+    def __init__(self, name, method, route, make, requests=DEFAULT_REQUESTS):
+        self.name = name
+        self.method = method
+        self.route = route
+        self.make = make
+        self.requests = requests
+
+
+def _patient_filter(rng, ids):
+    choice = rng.integers(4)
+    if choice == 0:
+        return '/api/patients?limit=100'
+    if choice == 1:
+        return f'/api/patients?limit=100&gender={rng.choice(["Male", "Female"])}'
+    if choice == 2:
+        condition = cohorts.CONDITIONS[rng.integers(len(cohorts.CONDITIONS))][0]
+        return f'/api/patients?limit=100&condition={condition.replace(" ", "+")}'
+    low = int(rng.integers(18, 80))
+    return f'/api/patients?limit=100&min_age={low}&max_age={low + 10}'
+
+
+def _pick(rng, values):
+    return values[rng.integers(len(values))]
+
+
+PROFILES = (
+    Profile("patients", "GET", "/api/patients", lambda rng, ids: (_patient_filter(rng, ids), None)),
+    Profile("patient", "GET", "/api/patients/<patient_id>",
+            lambda rng, ids: (f'/api/patients/{_pick(rng, ids["patients"])}', None)),
+    Profile("analyze", "POST", "/api/analyze",
+            lambda rng, ids: ('/api/analyze', {"patient_id": _pick(rng, ids["patients"])})),
+    Profile("realtime", "GET", "/api/realtime/<patient_id>",
+            lambda rng, ids: (f'/api/realtime/{_pick(rng, ids["patients"])}', None)),
+    Profile("analyze_image", "POST", "/api/analyze/image",
+            lambda rng, ids: ('/api/analyze/image', {"image_id": _pick(rng, ids["images"]), "wait": 30}),
+            requests=200),
+    Profile("predict_progression", "GET", "/api/predict/progression/<patient_id>",
+            lambda rng, ids: (f'/api/predict/progression/{_pick(rng, ids["conditions"])}', None)),
+    Profile("predict_progression_batch", "POST", "/api/predict/progression/batch",
+            lambda rng, ids: ('/api/predict/progression/batch',
+                              {"patient_ids": [_pick(rng, ids["patients"]) for _ in range(100)]}),
+            requests=100),
+)
+
+
+def peak_rss(pid=None):
+    """Peak resident set size in bytes of this process or of ``pid`` (Linux), or None"""
+    if pid is None:
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # Kilobytes on Linux, bytes on macOS
+        return peak if sys.platform == 'darwin' else peak * 1024
+    try:
+        with open(f'/proc/{pid}/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return None
+
+
+class ClientTarget:
+    """Requests through the Flask test client, one client per worker thread"""
+
+    name = "client"
+
+    def __init__(self, environ):
+        started = time.perf_counter()
+        os.environ.update(environ)
+        sys.path.insert(0, ROOT)
+        import app
+
+        self.app = app.create_app()
+        self.startup_seconds = time.perf_counter() - started
+        self._local = threading.local()
+
+    def send(self, method, path, body):
+        client = getattr(self._local, 'client', None)
+        if client is None:
+            client = self._local.client = self.app.test_client()
+        response = client.open(path, method=method, json=body)
+        response.get_data()
+        return response.status_code
+
+    def peak_rss(self):
+        return peak_rss()
+
+    def close(self):
+        pass
+
+
+class ServerTarget:
+    """Requests over HTTP to a threaded development server in a child process
+
+    With ``workers``, the server is ``serve.py`` running that many sharded workers.
+    """
+
+    name = "server"
+
+    def __init__(self, environ, timeout=600, workers=None):
+        with socket.socket() as s:
+            s.bind(('127.0.0.1', 0))
+            self.port = s.getsockname()[1]
+        self.workers = workers
+        if workers:
+            command = [sys.executable, 'serve.py', '--workers', str(workers), '--host', '127.0.0.1', '--port', str(self.port)]
+        else:
+            command = [sys.executable, '-m', 'flask', '--app', 'app', 'run', '--port', str(self.port), '--with-threads', '--no-reload']
+        started = time.perf_counter()
+        self.process = subprocess.Popen(
+            command,
+            cwd=ROOT, env=dict(os.environ, **environ), stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+        )
+        while True:
+            if self.process.poll() is not None:
+                raise RuntimeError("Server exited during startup")
+            if time.perf_counter() - started > timeout:
+                self.close()
+                raise RuntimeError("Server did not start in time")
+            try:
+                self.send('GET', '/api/patients?limit=1', None)
+                break
+            except OSError:
+                time.sleep(0.01)
+        self.startup_seconds = time.perf_counter() - started
+
+    def send(self, method, path, body):
+        conn = http.client.HTTPConnection('127.0.0.1', self.port, timeout=120)
+        try:
+            headers = {}
+            payload = None
+            if body is not None:
+                payload = json.dumps(body).encode()
+                headers['Content-Type'] = 'application/json'
+            conn.request(method, path, body=payload, headers=headers)
+            response = conn.getresponse()
+            response.read()
+            return response.status
+        finally:
+            conn.close()
+
+    def peak_rss(self):
+        pids = [self.process.pid]
+        if self.workers:
+            # serve.py's workers are its children
+            try:
+                with open(f'/proc/{self.process.pid}/task/{self.process.pid}/children') as f:
+                    pids += [int(pid) for pid in f.read().split()]
+            except OSError:
+                pass
+        peaks = [peak_rss(pid) for pid in pids]
+        return None if peaks[0] is None else sum(peak for peak in peaks if peak is not None)
+
+    def close(self):
+        self.process.terminate()
+        self.process.wait()
+
+
+def run_profile(target, profile, ids, seed=0, requests=None, concurrency=1, warmup=DEFAULT_WARMUP):
+    """Send a profile's requests and summarize latency, throughput and status codes"""
+    rng = np.random.default_rng([seed, PROFILES.index(profile) if profile in PROFILES else 0])
+    n = requests or profile.requests
+    plan = [profile.make(rng, ids) for _ in range(warmup + n)]
+    for path, body in plan[:warmup]:
+        target.send(profile.method, path, body)
+
+    latencies = np.zeros(n)
+    statuses = [None] * n
+
+    def send(k):
+        path, body = plan[warmup + k]
+        started = time.perf_counter()
+        try:
+            statuses[k] = target.send(profile.method, path, body)
+        except Exception:
+            statuses[k] = 'error'
+        latencies[k] = time.perf_counter() - started
+
+    started = time.perf_counter()
+    if concurrency > 1:
+        with ThreadPoolExecutor(max_workers=concurrency) as pool:
+            list(pool.map(send, range(n)))
+    else:
+        for k in range(n):
+            send(k)
+    elapsed = time.perf_counter() - started
+
+    counts = {}
+    for status in statuses:
+        counts[str(status)] = counts.get(str(status), 0) + 1
+    p50, p95, p99 = np.percentile(latencies, [50, 95, 99]) * 1000
+    return {
+        "method": profile.method,
+        "route": profile.route,
+        "requests": n,
+        "concurrency": concurrency,
+        "errors": sum(count for status, count in counts.items() if not status.startswith(('2', '3'))),
+        "status": counts,
+        "latency_ms": {
+            "p50": round(p50, 3),
+            "p95": round(p95, 3),
+            "p99": round(p99, 3),
+            "mean": round(latencies.mean() * 1000, 3),
+            "max": round(latencies.max() * 1000, 3),
+        },
+        "throughput_rps": round(n / elapsed, 1),
+        "peak_rss_bytes": target.peak_rss(),
+    }
+
+
+def _version():
+    try:
+        return subprocess.run(
+            ['git', 'describe', '--always', '--dirty'], cwd=ROOT, capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+@contextlib.contextmanager
+def _workspace(patients, seed):
+    """Yield the environment pointing the app at a fresh copy of a cohort, and the cohort's IDs
+
+    With no patients the app starts on its built-in sample data.
+    """
+    workdir = tempfile.mkdtemp(prefix='mednexus-bench-')
+    try:
+        environ = {
+            'MEDNEXUS_STORAGE': 'memory',
+            'MEDNEXUS_INGEST_DIR': os.path.join(workdir, 'ingest'),
+            'MEDNEXUS_IMAGE_CACHE_DIR': os.path.join(workdir, 'image-cache'),
+        }
+        ids = None
+        if patients:
+            path = cohorts.build(os.path.join(COHORT_DIR, f'cohort-{patients}-{seed}.db'), patients, seed)
+            cohort = cohorts.Cohort(patients, seed)
+            ids = {
+                "patients": cohort.patient_ids(),
+                "conditions": cohort.ids[cohort.conditions.any(axis=1)].tolist(),
+                "images": cohort.image_ids(),
+            }
+            # Profiles write vitals and jobs; work on a copy so every run starts alike
+            database = os.path.join(workdir, 'cohort.db')
+            for suffix in ('', '-wal'):
+                if os.path.exists(path + suffix):
+                    shutil.copyfile(path + suffix, database + suffix)
+            environ['MEDNEXUS_STORAGE'] = f'sqlite:///{database}'
+        yield environ, ids
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+def _environment():
+    return {
+        "version": _version(),
+        "created": datetime.now(timezone.utc).isoformat(timespec='seconds'),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpus": os.cpu_count(),
+    }
+
+
+def run(patients=1000, seed=0, target='client', profiles=None, requests=None, concurrency=None, warmup=DEFAULT_WARMUP,
+        workers=None):
+    """Run profiles against a fresh copy of a cohort and return the report
+
+    ``workers`` serves the ``server`` target from that many sharded worker processes.
+    """
+    if workers and target != 'server':
+        raise ValueError("workers applies to the server target only")
+    selected = [profile for profile in PROFILES if not profiles or profile.name in profiles]
+    with _workspace(patients, seed) as (environ, ids):
+        if workers:
+            # Room for the cohort and the patients the profiles create
+            environ['MEDNEXUS_SHARED_MAX_PATIENTS'] = str(max(65536, 2 * patients))
+            bench = ServerTarget(environ, workers=workers)
+        else:
+            bench = (ServerTarget if target == 'server' else ClientTarget)(environ)
+        try:
+            results = {}
+            for profile in selected:
+                results[profile.name] = run_profile(
+                    bench, profile, ids, seed=seed, requests=requests,
+                    concurrency=concurrency or (8 if target == 'server' else 1), warmup=warmup
+                )
+                print(f"{profile.name}: p50 {results[profile.name]['latency_ms']['p50']} ms, "
+                      f"{results[profile.name]['throughput_rps']} req/s", file=sys.stderr)
+            peak = bench.peak_rss()
+        finally:
+            bench.close()
+
+    return dict(
+        _environment(),
+        cohort={"patients": patients, "seed": seed, "images": len(ids["images"])},
+        target=target,
+        workers=workers,
+        startup_seconds=round(bench.startup_seconds, 3),
+        peak_rss_bytes=peak,
+        profiles=results,
+    )
+
+
+# Run in a fresh interpreter: times the import, the factory and the first request
+STARTUP_SCRIPT = """
+import json, sys, time
+started = time.perf_counter()
+import app
+imported = time.perf_counter()
+application = app.create_app()
+created = time.perf_counter()
+status = application.test_client().get('/api/patients?limit=1').status_code
+answered = time.perf_counter()
+json.dump({"import": imported - started, "create_app": created - imported,
+           "first_request": answered - created, "status": status}, sys.stdout)
+"""
+
+STARTUP_METRICS = ("import_seconds", "create_app_seconds", "first_request_seconds", "ready_seconds")
+
+
+def startup(patients=0, seed=0, runs=5):
+    """Measure worker startup ``runs`` times and report the medians
+
+    ``ready_seconds`` runs from spawning a server process, interpreter
+    start included, to its first successful response.
+    """
+    timings = {metric: [] for metric in STARTUP_METRICS}
+    peaks = []
+    with _workspace(patients, seed) as (environ, _):
+        for _ in range(runs):
+            output = subprocess.run(
+                [sys.executable, '-c', STARTUP_SCRIPT], cwd=ROOT, env=dict(os.environ, **environ),
+                capture_output=True, text=True, check=True
+            ).stdout
+            measured = json.loads(output)
+            if measured["status"] != 200:
+                raise RuntimeError(f"First request answered {measured['status']}")
+            for step in ("import", "create_app", "first_request"):
+                timings[f"{step}_seconds"].append(measured[step])
+            server = ServerTarget(environ)
+            try:
+                timings["ready_seconds"].append(server.startup_seconds)
+                peaks.append(server.peak_rss())
+            finally:
+                server.close()
+            print(f"ready in {server.startup_seconds:.3f} s (import {measured['import']:.3f} s)", file=sys.stderr)
+
+    return dict(
+        _environment(),
+        cohort={"patients": patients, "seed": seed} if patients else None,
+        runs=runs,
+        startup={metric: round(float(np.median(values)), 4) for metric, values in timings.items()},
+        peak_rss_bytes=max(peaks) if all(peaks) else None,
+    )
+
+
+def compare(baseline, candidate, threshold=DEFAULT_THRESHOLD):
+    """Rows of ``(profile, metric, baseline, candidate, change, regressed)`` for two reports"""
+    rows = []
+    if "startup" in baseline and "startup" in candidate:
+        for metric in STARTUP_METRICS:
+            old, new = baseline["startup"][metric], candidate["startup"][metric]
+            change = (new - old) / old if old else 0.0
+            rows.append(("startup", metric, old, new, change, change > threshold))
+    for name, base in baseline.get("profiles", {}).items():
+        other = candidate["profiles"].get(name)
+        if other is None:
+            continue
+        metrics = [(f"{p} ms", base["latency_ms"][p], other["latency_ms"][p], False) for p in ("p50", "p95", "p99")]
+        metrics.append(("req/s", base["throughput_rps"], other["throughput_rps"], True))
+        if base.get("peak_rss_bytes") and other.get("peak_rss_bytes"):
+            metrics.append(("peak MiB", base["peak_rss_bytes"] / 2 ** 20, other["peak_rss_bytes"] / 2 ** 20, False))
+        for metric, old, new, higher_is_better in metrics:
+            change = (new - old) / old if old else 0.0
+            regressed = -change > threshold if higher_is_better else change > threshold
+            rows.append((name, metric, old, new, change, regressed))
+    return rows
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m benchmarks', description=__doc__.splitlines()[0])
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    run_parser = commands.add_parser('run', help='run load profiles and write a JSON report')
+    run_parser.add_argument('--patients', type=int, default=1000)
+    run_parser.add_argument('--seed', type=int, default=0)
+    run_parser.add_argument('--target', choices=('client', 'server'), default='client')
+    run_parser.add_argument('--profile', action='append', choices=[p.name for p in PROFILES],
+                            help='profile to run (repeatable; default all)')
+    run_parser.add_argument('--requests', type=int, help='requests per profile (default per profile)')
+    run_parser.add_argument('--concurrency', type=int, help='concurrent requests (default 1 for client, 8 for server)')
+    run_parser.add_argument('--warmup', type=int, default=DEFAULT_WARMUP)
+    run_parser.add_argument('--workers', type=int, help='serve the server target with serve.py and this many sharded workers')
+    run_parser.add_argument('--output', help='report path (default stdout)')
+
+    cohort_parser = commands.add_parser('cohort', help='build a cohort database')
+    cohort_parser.add_argument('--patients', type=int, default=1000)
+    cohort_parser.add_argument('--seed', type=int, default=0)
+    cohort_parser.add_argument('--path')
+
+    startup_parser = commands.add_parser('startup', help='measure import time and time to first request')
+    startup_parser.add_argument('--patients', type=int, default=0, help='cohort size (default: built-in sample data)')
+    startup_parser.add_argument('--seed', type=int, default=0)
+    startup_parser.add_argument('--runs', type=int, default=5)
+    startup_parser.add_argument('--output', help='report path (default stdout)')
+
+    compare_parser = commands.add_parser('compare', help='compare two reports')
+    compare_parser.add_argument('baseline')
+    compare_parser.add_argument('candidate')
+    compare_parser.add_argument('--threshold', type=float, default=DEFAULT_THRESHOLD)
+
+    args = parser.parse_args(argv)
+    if args.command in ('run', 'startup'):
+        if args.command == 'run':
+            if args.workers and (args.target != 'server' or not args.patients):
+                parser.error("--workers needs --target server and a cohort (--patients)")
+            report = run(args.patients, args.seed, args.target, args.profile, args.requests, args.concurrency, args.warmup,
+                         args.workers)
+        else:
+            report = startup(args.patients, args.seed, args.runs)
+        text = json.dumps(report, indent=2)
+        if args.output:
+            with open(args.output, 'w') as f:
+                f.write(text + '\n')
+        else:
+            print(text)
+    elif args.command == 'cohort':
+        path = args.path or os.path.join(COHORT_DIR, f'cohort-{args.patients}-{args.seed}.db')
+        print(cohorts.build(path, args.patients, args.seed))
+    else:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        with open(args.candidate) as f:
+            candidate = json.load(f)
+        for key in ('target', 'cohort', 'workers'):
+            if baseline.get(key) != candidate.get(key):
+                print(f"Warning: reports differ in {key}: {baseline.get(key)} vs {candidate.get(key)}", file=sys.stderr)
+        regressions = 0
+        for name, metric, old, new, change, regressed in compare(baseline, candidate, args.threshold):
+            regressions += regressed
+            flag = '  REGRESSION' if regressed else ''
+            print(f"{name:28} {metric:21} {old:12.2f} {new:12.2f} {change:+8.1%}{flag}")
+        return 1 if regressions else 0
+    return 0
@@ -0,0 +1,368 @@
+"""Asynchronous medical image analysis jobs
+
+``POST /api/analyze/image`` only registers a job. A dispatcher thread
+hashes the image file, answers repeat studies from a cache keyed by content
+hash, and hands the rest in batches to a process pool. Workers decode the
+images with Pillow into NumPy arrays, extract intensity and region features
+for the whole batch at once, and pass them to the analysis model: the
+built-in one below, or any ``module:function`` named by
+``MEDNEXUS_IMAGE_MODEL``. An image that cannot be decoded fails only its
+own jobs, and a pool that breaks is replaced.
+"""
+import collections
+import hashlib
+import importlib
+import itertools
+import os
+import queue
+import threading
+import time
+import uuid
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+import numpy as np
+
+DEFAULT_WORKERS = int(os.environ.get('MEDNEXUS_IMAGE_WORKERS', 0)) or min(2, os.cpu_count() or 1)
+DEFAULT_BATCH_SIZE = int(os.environ.get('MEDNEXUS_IMAGE_BATCH_SIZE', 8))
+MODEL_HOOK = os.environ.get('MEDNEXUS_IMAGE_MODEL', '')
+
+# Side of the square grid images are resampled to for feature extraction
+FEATURE_SIZE = 256
+HISTOGRAM_BINS = 32
+# Regions per side for region statistics
+GRID = 4
+
+# Finished jobs and cached results kept before the oldest are dropped
+MAX_JOBS = 10000
+MAX_RESULTS = 4096
+# File content hashes remembered, by path, size and modification time
+MAX_HASHES = 4096
+
+# Reading templates per (type, body_part), used by the built-in model
+FINDINGS = {
+    ("X-Ray", "Chest"): (
+        [
+            {"description": "Lung fields appear clear", "confidence": 0.95, "location": "Bilateral lung fields"},
+            {"description": "No evidence of consolidation or effusion", "confidence": 0.93, "location": "Bilateral lung fields"},
+            {"description": "Heart size within normal limits", "confidence": 0.97, "location": "Cardiac silhouette"},
+        ],
+        ["No further imaging required at this time", "Recommend follow-up X-ray in 12 months"],
+    ),
+    ("MRI", "Brain"): (
+        [
+            {"description": "No evidence of acute infarction", "confidence": 0.94, "location": "Entire brain"},
+            {"description": "No mass effect or midline shift", "confidence": 0.96, "location": "Entire brain"},
+            {"description": "Ventricles normal in size and configuration", "confidence": 0.95, "location": "Ventricular system"},
+        ],
+        ["No further imaging required at this time", "Clinical correlation recommended"],
+    ),
+    ("CT Scan", "Chest"): (
+        [
+            {"description": "Mild coronary artery calcification", "confidence": 0.91, "location": "Coronary arteries"},
+            {"description": "No pulmonary nodules or masses", "confidence": 0.89, "location": "Lung parenchyma"},
+            {"description": "No pleural effusion", "confidence": 0.94, "location": "Pleural space"},
+        ],
+        ["Consider cardiac risk assessment", "Follow-up with cardiologist recommended"],
+    ),
+}
+
+
+def load_image(path, size=FEATURE_SIZE):
+    """Decode an image as grayscale, resampled to a ``(size, size)`` float32 array in [0, 1]"""
+    from PIL import Image
+
+    with Image.open(path) as image:
+        # Let the JPEG decoder skip detail the features don't need
+        image.draft('L', (size, size))
+        image = image.convert('L').resize((size, size), Image.BILINEAR)
+        return np.asarray(image, dtype=np.float32) / 255.0
+
+
+def load_images(paths, size=FEATURE_SIZE):
+    """Decode images as grayscale and resample them into a ``(n, size, size)`` float32 batch in [0, 1]"""
+    batch = np.empty((len(paths), size, size), dtype=np.float32)
+    for i, path in enumerate(paths):
+        batch[i] = load_image(path, size)
+    return batch
+
+
+def extract_features(batch):
+    """Intensity and region statistics for every image of a batch, vectorized across it"""
+    n, size, _ = batch.shape
+    flat = batch.reshape(n, -1)
+    bins = np.minimum((flat * HISTOGRAM_BINS).astype(np.int64), HISTOGRAM_BINS - 1)
+    # One bincount over offset bins builds every image's histogram at once
+    offsets = bins + np.arange(n)[:, None] * HISTOGRAM_BINS
+    histograms = np.bincount(offsets.ravel(), minlength=n * HISTOGRAM_BINS).reshape(n, HISTOGRAM_BINS) / flat.shape[1]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        entropy = -np.nansum(np.where(histograms > 0, histograms * np.log2(histograms), 0.0), axis=1)
+    percentiles = np.percentile(flat, [5, 50, 95], axis=1)
+
+    cell = size // GRID
+    regions = batch[:, :cell * GRID, :cell * GRID].reshape(n, GRID, cell, GRID, cell)
+    region_mean = regions.mean(axis=(2, 4))
+    region_std = regions.std(axis=(2, 4))
+    asymmetry = np.abs(batch - batch[:, :, ::-1]).mean(axis=(1, 2))
+    gradient = np.hypot(np.diff(batch, axis=1)[:, :, :-1], np.diff(batch, axis=2)[:, :-1, :])
+
+    return [
+        {
+            "mean": float(flat[i].mean()),
+            "std": float(flat[i].std()),
+            "p5": float(percentiles[0, i]),
+            "median": float(percentiles[1, i]),
+            "p95": float(percentiles[2, i]),
+            "contrast": float(percentiles[2, i] - percentiles[0, i]),
+            "entropy": float(entropy[i]),
+            "asymmetry": float(asymmetry[i]),
+            "edge_density": float((gradient[i] > 0.1).mean()),
+            "histogram": np.round(histograms[i], 4).tolist(),
+            "region_mean": np.round(region_mean[i], 4).tolist(),
+            "region_std": np.round(region_std[i], 4).tolist(),
+        }
+        for i in range(n)
+    ]
+
+
+def default_model(images, features, metadata):
+    """Built-in reading: type/body-part templates adjusted by image quality
+
+    Returns ``(findings, recommendations, confidence_score)`` per image.
+    """
+    results = []
+    for feature, meta in zip(features, metadata):
+        findings, recommendations = FINDINGS.get((meta["type"], meta["body_part"]), ([], []))
+        findings = [dict(finding) for finding in findings]
+        recommendations = list(recommendations)
+        # Washed-out or flat images make every reading less certain
+        quality = min(1.0, feature["contrast"] / 0.5) * min(1.0, feature["entropy"] / 4.0)
+        if quality < 0.5:
+            findings.append({
+                "description": "Low image contrast limits interpretation",
+                "confidence": round(1.0 - quality, 2),
+                "location": "Entire image",
+            })
+            recommendations.append("Consider repeat acquisition with adjusted exposure")
+        if feature["asymmetry"] > 0.15:
+            findings.append({
+                "description": "Marked left-right intensity asymmetry",
+                "confidence": round(min(0.95, 0.5 + feature["asymmetry"]), 2),
+                "location": "Bilateral comparison",
+            })
+        results.append((findings, recommendations, round(0.8 + 0.18 * quality, 3)))
+    return results
+
+
+def _load_model():
+    if not MODEL_HOOK:
+        return default_model
+    module, _, name = MODEL_HOOK.partition(':')
+    return getattr(importlib.import_module(module), name)
+
+
+# Model resolved once per worker process
+_worker_model = None
+
+
+def analyze_batch(items):
+    """Analyze ``(path, metadata)`` items in one batch; runs in a worker process
+
+    Returns an analysis per item, or ``{"error": ...}`` for an image that
+    could not be decoded; the rest of the batch is analyzed regardless.
+    """
+    global _worker_model
+    if _worker_model is None:
+        _worker_model = _load_model()
+    results = [None] * len(items)
+    decoded, images = [], []
+    for i, (path, _) in enumerate(items):
+        try:
+            images.append(load_image(path))
+            decoded.append(i)
+        except Exception as exc:
+            results[i] = {"error": f"Image could not be decoded: {exc}"}
+    if decoded:
+        images = np.stack(images)
+        features = extract_features(images)
+        readings = _worker_model(images, features, [items[i][1] for i in decoded])
+        for i, (findings, recommendations, confidence), feature in zip(decoded, readings, features):
+            results[i] = {
+                "findings": findings, "recommendations": recommendations, "confidence_score": confidence,
+                "features": feature,
+            }
+    return results
+
+
+def content_hash(path, chunk_size=1024 * 1024):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class Job:
+    __slots__ = ("id", "image_id", "path", "metadata", "status", "result", "error", "done")
+
+    def __init__(self, image_id, path, metadata, prefix=''):
+        self.id = prefix + uuid.uuid4().hex
+        self.image_id = image_id
+        self.path = path
+        self.metadata = metadata
+        self.status = "queued"
+        self.result = None
+        self.error = None
+        self.done = threading.Event()
+
+    def as_dict(self):
+        job = {"job_id": self.id, "image_id": self.image_id, "status": self.status}
+        if self.result is not None:
+            job["result"] = self.result
+        if self.error is not None:
+            job["error"] = self.error
+        return job
+
+
+class ImageAnalysisQueue:
+    """Job registry, dispatcher thread and worker pool for image analysis
+
+    Job IDs start with ``id_prefix``, which lets sharded workers tell which
+    of them holds a job.
+    """
+
+    def __init__(self, workers=DEFAULT_WORKERS, batch_size=DEFAULT_BATCH_SIZE, id_prefix=''):
+        self.workers = workers
+        self.id_prefix = id_prefix
+        self.batch_size = batch_size
+        self._jobs = collections.OrderedDict()
+        # (content hash, type, body part) -> analysis
+        self._results = collections.OrderedDict()
+        # (path, size, mtime) -> content hash, so unchanged files are hashed once
+        self._hashes = collections.OrderedDict()
+        self._queue = queue.Queue()
+        self._lock = threading.Lock()
+        self._pool = None
+        self._thread = None
+        self._in_flight = threading.Semaphore(2 * workers)
+
+    def submit(self, image_id, path, metadata):
+        """Queue an analysis of the image file at ``path``; returns the job"""
+        job = Job(image_id, path, metadata, self.id_prefix)
+        with self._lock:
+            self._jobs[job.id] = job
+            while len(self._jobs) > MAX_JOBS:
+                self._jobs.popitem(last=False)
+            if self._thread is None:
+                self._pool = self._new_pool()
+                self._thread = threading.Thread(target=self._dispatch, name='image-analysis', daemon=True)
+                self._thread.start()
+        self._queue.put(job)
+        return job
+
+    def get(self, job_id):
+        return self._jobs.get(job_id)
+
+    def _new_pool(self):
+        return ProcessPoolExecutor(max_workers=self.workers)
+
+    def _replace_pool(self, pool):
+        # A worker died and took the pool with it; later batches use a new one
+        with self._lock:
+            if self._pool is pool:
+                self._pool = self._new_pool()
+        pool.shutdown(wait=False, cancel_futures=True)
+
+    def _hash(self, path):
+        stat = os.stat(path)
+        key = (path, stat.st_size, stat.st_mtime_ns)
+        digest = self._hashes.get(key)
+        if digest is None:
+            digest = self._hashes[key] = content_hash(path)
+            while len(self._hashes) > MAX_HASHES:
+                self._hashes.popitem(last=False)
+        else:
+            self._hashes.move_to_end(key)
+        return digest
+
+    def _dispatch(self):
+        while True:
+            jobs = [self._queue.get()]
+            while len(jobs) < self.batch_size:
+                try:
+                    jobs.append(self._queue.get(timeout=0.01))
+                except queue.Empty:
+                    break
+            try:
+                self._dispatch_batch(jobs)
+            except Exception as exc:
+                # Keep dispatching: only this batch's unfinished jobs fail
+                self._fail([job for job in jobs if not job.done.is_set()], f"Analysis failed: {exc}")
+
+    def _dispatch_batch(self, jobs):
+        pending = {}
+        for job in jobs:
+            try:
+                key = (self._hash(job.path), job.metadata["type"], job.metadata["body_part"])
+            except OSError:
+                self._fail([job], "Image file not found")
+                continue
+            cached = self._results.get(key)
+            if cached is not None:
+                self._finish(job, key, cached)
+            else:
+                # Identical studies in one batch are analyzed once
+                pending.setdefault(key, []).append(job)
+        if not pending:
+            return
+
+        for job in itertools.chain.from_iterable(pending.values()):
+            job.status = "running"
+        keys = list(pending)
+        items = [(pending[key][0].path, pending[key][0].metadata) for key in keys]
+        self._in_flight.acquire()
+        pool = self._pool
+        try:
+            future = pool.submit(analyze_batch, items)
+        except Exception as exc:
+            self._in_flight.release()
+            if isinstance(exc, BrokenProcessPool):
+                self._replace_pool(pool)
+            raise
+        future.add_done_callback(lambda f, pool=pool, keys=keys, pending=pending: self._collect(f, pool, keys, pending))
+
+    def _collect(self, future, pool, keys, pending):
+        self._in_flight.release()
+        try:
+            analyses = future.result()
+        except Exception as exc:
+            if isinstance(exc, BrokenProcessPool):
+                self._replace_pool(pool)
+            self._fail(itertools.chain.from_iterable(pending.values()), f"Analysis failed: {exc}")
+            return
+        for key, analysis in zip(keys, analyses):
+            if "error" in analysis:
+                self._fail(pending[key], analysis["error"])
+                continue
+            with self._lock:
+                self._results[key] = analysis
+                while len(self._results) > MAX_RESULTS:
+                    self._results.popitem(last=False)
+            for job in pending[key]:
+                self._finish(job, key, analysis)
+
+    def _finish(self, job, key, analysis):
+        job.result = dict(
+            analysis,
+            image_id=job.image_id,
+            content_hash=key[0],
+            analysis_timestamp=time.strftime("%Y-%m-%d %H:%M:%S"),
+        )
+        job.status = "done"
+        job.done.set()
+
+    def _fail(self, jobs, error):
+        for job in jobs:
+            job.error = error
+            job.status = "failed"
+            job.done.set()
@@ -0,0 +1,175 @@
+"""Indexed catalog of medical image metadata"""
+import base64
+import bisect
+import datetime
+import threading
+
+# Metadata every image must have, all strings
+REQUIRED_FIELDS = ("id", "type", "body_part", "date")
+
+
+def encode_cursor(*parts):
+    return base64.urlsafe_b64encode("\x1f".join(parts).encode()).decode()
+
+
+def decode_cursor(cursor):
+    try:
+        parts = tuple(base64.urlsafe_b64decode(cursor.encode()).decode().split("\x1f"))
+    except (ValueError, UnicodeDecodeError):
+        raise ValueError("Invalid cursor")
+    if len(parts) != 2:
+        raise ValueError("Invalid cursor")
+    return parts
+
+
+def validate(image):
+    """Raise ValueError unless ``image`` has the fields the indexes sort and filter on
+
+    ``id``, ``type`` and ``body_part`` must be non-empty strings and ``date``
+    an ISO date such as ``2025-04-10``.
+    """
+    if not isinstance(image, dict):
+        raise ValueError("An image must be a JSON object")
+    missing = [field for field in REQUIRED_FIELDS if not image.get(field)]
+    if missing:
+        raise ValueError(f"Missing fields: {', '.join(missing)}")
+    invalid = [field for field in REQUIRED_FIELDS if not isinstance(image[field], str)]
+    if invalid:
+        raise ValueError(f"Fields must be strings: {', '.join(invalid)}")
+    # Dates are compared as strings, so only the extended YYYY-MM-DD form is accepted
+    try:
+        valid = datetime.date.fromisoformat(image["date"]).isoformat() == image["date"]
+    except ValueError:
+        valid = False
+    if not valid:
+        raise ValueError(f"date must be an ISO date (YYYY-MM-DD), not {image['date']!r}")
+    if not isinstance(image.get("url", ""), str):
+        raise ValueError("url must be a string")
+
+
+class ImageCatalog:
+    """Image metadata with a hash index by ID and incremental secondary indexes
+
+    Secondary indexes map ``type`` and ``body_part`` to sets of image IDs and
+    keep a ``(date, id)`` list sorted for range scans. Every index is updated
+    in place when an image is added or removed; nothing is rebuilt.
+
+    Image records live in ``documents`` (a plain dict by default, or a
+    repository table) as ``{"patient_id": ..., "image": {...}}``; the indexes
+    keep only the keys they sort and filter on.
+    """
+
+    def __init__(self, documents=None):
+        self._documents = {} if documents is None else documents
+        self._keys = {}
+        self._owner = {}
+        self._by_patient = {}
+        self._by_type = {}
+        self._by_body_part = {}
+        self._by_date = []
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._keys)
+
+    def __contains__(self, image_id):
+        return image_id in self._keys
+
+    def get(self, image_id):
+        if image_id not in self._keys:
+            return None
+        document = self._documents.get(image_id)
+        return document["image"] if document else None
+
+    def patient_of(self, image_id):
+        return self._owner.get(image_id)
+
+    def for_patient(self, patient_id):
+        return [self.get(image_id) for image_id in self._by_patient.get(patient_id, ())]
+
+    def add(self, patient_id, image):
+        """Store an image, replacing any with the same ID, and update every index
+
+        Raises ValueError, storing nothing, if ``validate`` rejects the image.
+        """
+        validate(image)
+        self.index(patient_id, image["id"], image["type"], image["body_part"], image["date"])
+        self._documents[image["id"]] = {"patient_id": patient_id, "image": image}
+
+    def index(self, patient_id, image_id, type, body_part, date):
+        """Index an image already present in ``documents``"""
+        with self._lock:
+            if image_id in self._keys:
+                self._unindex(image_id)
+            self._keys[image_id] = (type, body_part, date)
+            self._owner[image_id] = patient_id
+            self._by_patient.setdefault(patient_id, []).append(image_id)
+            self._by_type.setdefault(type, set()).add(image_id)
+            self._by_body_part.setdefault(body_part, set()).add(image_id)
+            bisect.insort(self._by_date, (date, image_id))
+
+    def remove(self, image_id):
+        with self._lock:
+            self._unindex(image_id)
+        self._documents.pop(image_id, None)
+
+    def unindex(self, image_id):
+        """Drop an image from the indexes only, leaving ``documents`` untouched"""
+        with self._lock:
+            if image_id in self._keys:
+                self._unindex(image_id)
+
+    def _unindex(self, image_id):
+        type, body_part, date = self._keys.pop(image_id)
+        patient_id = self._owner.pop(image_id)
+        self._by_patient[patient_id].remove(image_id)
+        self._by_type[type].discard(image_id)
+        self._by_body_part[body_part].discard(image_id)
+        del self._by_date[bisect.bisect_left(self._by_date, (date, image_id))]
+
+    def query(self, type=None, body_part=None, date_from=None, date_to=None, limit=50, cursor=None):
+        """Return ``(images, next_cursor)`` ordered by date then ID
+
+        ``date_from``/``date_to`` are inclusive ISO dates; ``cursor`` is the
+        ``next_cursor`` of a previous page.
+        """
+        image_ids, next_cursor = self.query_ids(type, body_part, date_from, date_to, limit, cursor)
+        return [dict(self.get(image_id), patient_id=self._owner[image_id]) for image_id in image_ids], next_cursor
+
+    def query_ids(self, type=None, body_part=None, date_from=None, date_to=None, limit=50, cursor=None):
+        """Like ``query``, but return the matching image IDs rather than their metadata"""
+        by_date = self._by_date
+        lo = bisect.bisect_left(by_date, (date_from,)) if date_from else 0
+        if cursor:
+            lo = max(lo, bisect.bisect_right(by_date, decode_cursor(cursor)))
+        # "\uffff" sorts after any image ID, making date_to inclusive
+        hi = bisect.bisect_right(by_date, (date_to, "\uffff")) if date_to else len(by_date)
+
+        filters = []
+        if type is not None:
+            filters.append(self._by_type.get(type, set()))
+        if body_part is not None:
+            filters.append(self._by_body_part.get(body_part, set()))
+
+        if lo >= hi:
+            return [], None
+
+        filters.sort(key=len)
+        if filters and len(filters[0]) < hi - lo:
+            # The smallest posting set is cheaper to walk than the date range
+            first, rest = filters[0], filters[1:]
+            start, end = by_date[lo], by_date[hi - 1]
+            keys = sorted(
+                key for key in ((self._keys[image_id][2], image_id) for image_id in first)
+                if start <= key <= end and all(key[1] in s for s in rest)
+            )
+        else:
+            keys = (by_date[i] for i in range(lo, hi) if all(by_date[i][1] in s for s in filters))
+
+        page = []
+        for key in keys:
+            if len(page) == limit:
+                last = page[-1]
+                return [image_id for _, image_id in page], encode_cursor(*last)
+            page.append(key)
+        return [image_id for _, image_id in page], None
@@ -0,0 +1,291 @@
+"""Cached image derivatives: thumbnails and tiled multi-resolution pyramids
+
+Derivatives are generated with Pillow the first time they are requested (or
+ahead of time through ``warm``) and written to an on-disk cache, so a
+viewer never has to pull a full study to show a preview. Cache entries are
+keyed by the source file's path, size and modification time; replacing an
+image makes its old derivatives unreachable and they age out. The cache is
+bounded by total size, evicting the least recently used entry first.
+
+A pyramid is laid out like Deep Zoom: level 0 is the full-resolution image,
+each following level halves it, down to the first level that fits in a
+single tile. Every level is cut into ``tile_size`` square JPEG tiles.
+"""
+import collections
+import hashlib
+import json
+import os
+import shutil
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+_ROOT = os.path.dirname(os.path.abspath(__file__))
+DEFAULT_CACHE_DIR = os.environ.get('MEDNEXUS_IMAGE_CACHE_DIR', os.path.join(_ROOT, 'instance', 'image-cache'))
+DEFAULT_CACHE_BYTES = int(os.environ.get('MEDNEXUS_IMAGE_CACHE_BYTES', 1024 * 1024 * 1024))
+
+# Thumbnail edge lengths that may be requested; the first is the default
+THUMBNAIL_SIZES = (256, 128, 512)
+TILE_SIZE = 256
+JPEG_QUALITY = 85
+
+PYRAMID = "pyramid"
+MANIFEST = "manifest.json"
+
+
+class UndecodableImage(ValueError):
+    """The source file is not an image Pillow can decode"""
+
+
+def _decode_error(exc):
+    return UndecodableImage(f"Image could not be decoded: {exc}")
+
+
+def source_key(path):
+    """Cache key of an image file: changes whenever the file is replaced or rewritten"""
+    stat = os.stat(path)
+    key = f"{os.path.abspath(path)}\x1f{stat.st_size}\x1f{stat.st_mtime_ns}"
+    return hashlib.blake2b(key.encode(), digest_size=16).hexdigest()
+
+
+def _displayable(image):
+    """Convert an image to 8-bit grayscale or RGB, windowing high bit-depth scans to their range"""
+    if image.mode in ("L", "RGB"):
+        return image
+    if image.mode in ("I", "I;16", "I;16B", "I;16L", "F"):
+        from PIL import Image
+
+        pixels = np.asarray(image, dtype=np.float64)
+        low, high = np.percentile(pixels, [0.5, 99.5])
+        scaled = np.clip((pixels - low) / max(high - low, 1e-9), 0, 1) * 255
+        return Image.fromarray(scaled.astype(np.uint8), "L")
+    return image.convert("RGB")
+
+
+def _disk_size(path):
+    if os.path.isfile(path):
+        return os.path.getsize(path)
+    return sum(os.path.getsize(os.path.join(root, name)) for root, _, names in os.walk(path) for name in names)
+
+
+def _remove(path):
+    if os.path.isdir(path):
+        shutil.rmtree(path, ignore_errors=True)
+    elif os.path.exists(path):
+        os.remove(path)
+
+
+def build_thumbnail(source, target, size):
+    from PIL import Image
+
+    try:
+        with Image.open(source) as image:
+            # JPEG sources decode straight at a reduced scale
+            image.draft("RGB", (size, size))
+            image = _displayable(image)
+            image.thumbnail((size, size), Image.LANCZOS)
+    except Exception as exc:
+        raise _decode_error(exc) from exc
+    image.save(target, "JPEG", quality=JPEG_QUALITY)
+
+
+def build_pyramid(source, target, tile_size=TILE_SIZE):
+    """Cut every level of the image's pyramid into tiles under ``target``; returns the manifest"""
+    from PIL import Image
+
+    try:
+        with Image.open(source) as image:
+            image = _displayable(image)
+            image.load()
+    except Exception as exc:
+        raise _decode_error(exc) from exc
+    levels = []
+    os.makedirs(target)
+    while True:
+        width, height = image.size
+        columns, rows = -(-width // tile_size), -(-height // tile_size)
+        directory = os.path.join(target, str(len(levels)))
+        os.makedirs(directory)
+        for row in range(rows):
+            for column in range(columns):
+                box = (column * tile_size, row * tile_size,
+                       min(width, (column + 1) * tile_size), min(height, (row + 1) * tile_size))
+                image.crop(box).save(os.path.join(directory, f"{column}_{row}.jpg"), "JPEG", quality=JPEG_QUALITY)
+        levels.append({"width": width, "height": height, "columns": columns, "rows": rows})
+        if columns == 1 and rows == 1:
+            break
+        image = image.reduce(2)
+
+    manifest = {
+        "width": levels[0]["width"],
+        "height": levels[0]["height"],
+        "tile_size": tile_size,
+        "format": "jpeg",
+        "levels": levels,
+    }
+    with open(os.path.join(target, MANIFEST), "w") as f:
+        json.dump(manifest, f)
+    return manifest
+
+
+class ImageDerivatives:
+    """Size-bounded on-disk LRU cache of thumbnails and tile pyramids
+
+    Entries are ``(source key, name)`` pairs stored at
+    ``directory/<source key>/<name>``, a file for a thumbnail and a
+    directory for a pyramid. Concurrent requests for a missing entry wait
+    for one build instead of each starting their own. Entries another
+    worker process evicted are rebuilt on their next request.
+    """
+
+    def __init__(self, directory=DEFAULT_CACHE_DIR, max_bytes=DEFAULT_CACHE_BYTES, tile_size=TILE_SIZE):
+        self.directory = os.path.abspath(directory)
+        self.max_bytes = max_bytes
+        self.tile_size = tile_size
+        self.size = 0
+        self._entries = collections.OrderedDict()
+        self._building = {}
+        self._manifests = {}
+        self._lock = threading.Lock()
+        self._warmer = None
+        # Entries left by earlier runs are indexed in the background; lookups wait for it
+        self._scanned = threading.Event()
+        threading.Thread(target=self._scan, name='image-cache-scan', daemon=True).start()
+
+    def _scan(self):
+        """Index entries left by earlier runs, oldest first"""
+        try:
+            if os.path.isdir(self.directory):
+                self._scan_directory()
+        finally:
+            self._scanned.set()
+
+    def _scan_directory(self):
+        found = []
+        for key in os.listdir(self.directory):
+            base = os.path.join(self.directory, key)
+            if not os.path.isdir(base):
+                continue
+            for name in os.listdir(base):
+                path = os.path.join(base, name)
+                if ".tmp-" in name:
+                    _remove(path)
+                    continue
+                found.append((os.path.getmtime(path), (key, name), _disk_size(path)))
+        for _, entry, nbytes in sorted(found):
+            self._entries[entry] = nbytes
+            self.size += nbytes
+
+    def _path(self, entry):
+        return os.path.join(self.directory, *entry)
+
+    def _get(self, entry, build):
+        self._scanned.wait()
+        path = self._path(entry)
+        with self._lock:
+            if entry in self._entries:
+                if os.path.exists(path):
+                    self._entries.move_to_end(entry)
+                    return path
+                self._forget(entry)
+            building = self._building.setdefault(entry, threading.Lock())
+        with building:
+            with self._lock:
+                if entry in self._entries:
+                    self._entries.move_to_end(entry)
+                    return path
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp = f"{path}.tmp-{os.getpid()}-{threading.get_ident()}"
+            try:
+                build(tmp)
+                if os.path.exists(path):
+                    # Built by another process in the meantime
+                    _remove(tmp)
+                else:
+                    os.rename(tmp, path)
+            except BaseException:
+                _remove(tmp)
+                with self._lock:
+                    self._building.pop(entry, None)
+                raise
+            nbytes = _disk_size(path)
+            with self._lock:
+                self._entries[entry] = nbytes
+                self.size += nbytes
+                self._building.pop(entry, None)
+                self._evict(keep=entry)
+        return path
+
+    def _forget(self, entry):
+        self.size -= self._entries.pop(entry)
+        self._manifests.pop(entry[0], None)
+
+    def _evict(self, keep):
+        while self.size > self.max_bytes and len(self._entries) > 1:
+            entry = next(iter(self._entries))
+            if entry == keep:
+                self._entries.move_to_end(entry)
+                continue
+            self._forget(entry)
+            _remove(self._path(entry))
+
+    def _discard(self, entry):
+        """Drop an entry found damaged, e.g. half removed by another process; the next request rebuilds it"""
+        with self._lock:
+            if entry in self._entries:
+                self._forget(entry)
+        _remove(self._path(entry))
+
+    def thumbnail(self, source, size=THUMBNAIL_SIZES[0]):
+        """Path of a JPEG thumbnail of ``source`` fitting in ``size`` x ``size``"""
+        if size not in THUMBNAIL_SIZES:
+            raise ValueError(f"Thumbnail size must be one of {', '.join(map(str, THUMBNAIL_SIZES))}")
+        return self._get((source_key(source), f"thumb-{size}.jpg"), lambda tmp: build_thumbnail(source, tmp, size))
+
+    def pyramid(self, source):
+        """Manifest of the tile pyramid of ``source``: dimensions, tile size and per-level grids"""
+        key = source_key(source)
+        manifest = self._manifests.get(key)
+        path = self._get((key, PYRAMID), lambda tmp: build_pyramid(source, tmp, self.tile_size))
+        if manifest is None:
+            try:
+                with open(os.path.join(path, MANIFEST)) as f:
+                    manifest = json.load(f)
+            except FileNotFoundError:
+                # Evicted by another process since the lookup
+                self._discard((key, PYRAMID))
+                path = self._get((key, PYRAMID), lambda tmp: build_pyramid(source, tmp, self.tile_size))
+                with open(os.path.join(path, MANIFEST)) as f:
+                    manifest = json.load(f)
+            self._manifests[key] = manifest
+        return manifest
+
+    def tile(self, source, level, column, row):
+        """Path of one pyramid tile, or None when it lies outside the pyramid
+
+        A pyramid whose tile has gone missing, e.g. evicted by another
+        process while its tiles were being served, is rebuilt.
+        """
+        levels = self.pyramid(source)["levels"]
+        if not (0 <= level < len(levels) and 0 <= column < levels[level]["columns"] and 0 <= row < levels[level]["rows"]):
+            return None
+        entry = (source_key(source), PYRAMID)
+        path = os.path.join(self._path(entry), str(level), f"{column}_{row}.jpg")
+        if not os.path.exists(path):
+            self._discard(entry)
+            self.pyramid(source)
+        return path
+
+    def warm(self, source):
+        """Build the default thumbnail of ``source`` in the background"""
+        with self._lock:
+            if self._warmer is None:
+                self._warmer = ThreadPoolExecutor(max_workers=1, thread_name_prefix='image-derivatives')
+        self._warmer.submit(self._warm, source)
+
+    def _warm(self, source):
+        try:
+            self.thumbnail(source)
+        except Exception as exc:
+            print(f"Thumbnail generation failed for {source}: {exc}")
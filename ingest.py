@@ -0,0 +1,431 @@
+"""Durable bulk ingestion of device vitals readings
+
+Readings are ``(patient_id, timestamp, metric, value)`` records. A request's
+readings are appended to a write-ahead log, which a single writer thread
+group-commits with one fsync for every request waiting at that moment.
+A log directory belongs to one process at a time, which holds a lock on it.
+Only then are they queued for the applier thread, which folds them into
+the ``VitalsStore`` in large vectorized batches. On startup the latest
+checkpoint is restored and the log tail replayed.
+"""
+import fcntl
+import json
+import math
+import os
+import queue
+import struct
+import threading
+import time
+import zlib
+
+import numpy as np
+
+from vitals_store import METRICS
+
+# Binary frame layout: the request body is a packed array of these records
+READING_DTYPE = np.dtype([
+    ("patient_id", "S16"),
+    ("timestamp", "<f8"),
+    ("metric", "u1"),
+    ("value", "<f4"),
+])
+
+METRIC_CODES = {metric: code for code, metric in enumerate(METRICS)}
+
+DEFAULT_MAX_PENDING = int(os.environ.get('MEDNEXUS_INGEST_MAX_PENDING', 1_000_000))
+DEFAULT_CHECKPOINT_BYTES = int(os.environ.get('MEDNEXUS_INGEST_CHECKPOINT_BYTES', 64 * 1024 * 1024))
+
+# Log record header: payload length and CRC-32
+_HEADER = struct.Struct("<II")
+
+# Readings folded into the store per applier batch
+_APPLY_BATCH = 262144
+
+
+class Backpressure(Exception):
+    """Raised when the apply queue is full; ``retry_after`` is in seconds"""
+
+    def __init__(self, retry_after):
+        super().__init__("Ingestion queue is full")
+        self.retry_after = retry_after
+
+
+# Largest magnitude a reading's value may have: it is stored as float32
+MAX_VALUE = float(np.finfo(np.float32).max)
+
+# Per-reading errors reported at most, per request
+MAX_ERRORS = 100
+
+
+class DirectoryInUse(RuntimeError):
+    """Raised when another process holds the log directory"""
+
+
+def _lock_directory(directory):
+    # A POSIX lock is released when its process exits and is not inherited
+    # by forked children, so a dead worker's directory is free again
+    os.makedirs(directory, exist_ok=True)
+    lock_file = open(os.path.join(directory, 'lock'), 'a')
+    try:
+        fcntl.lockf(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        lock_file.close()
+        raise DirectoryInUse(f"{directory} is in use by another process")
+    return lock_file
+
+
+class InvalidReadings(ValueError):
+    """Raised for readings that cannot be ingested
+
+    ``errors`` lists ``(position, message)`` for the first ``MAX_ERRORS``
+    offending readings: their line in NDJSON, their record in a frame.
+    """
+
+    def __init__(self, message, errors):
+        super().__init__(message)
+        self.errors = errors
+
+
+def _invalid(positions, messages):
+    errors = list(zip(positions, messages))[:MAX_ERRORS]
+    return InvalidReadings(f"{len(positions)} invalid reading(s)", errors)
+
+
+def parse_frame(body):
+    """Decode a binary frame of packed ``READING_DTYPE`` records"""
+    if len(body) % READING_DTYPE.itemsize:
+        raise ValueError(f"Frame length must be a multiple of {READING_DTYPE.itemsize} bytes")
+    readings = np.frombuffer(body, dtype=READING_DTYPE)
+    bad = (
+        (readings["metric"] >= len(METRICS))
+        | ~np.isfinite(readings["timestamp"])
+        | ~np.isfinite(readings["value"])
+    )
+    if bad.any():
+        records = np.flatnonzero(bad)
+        messages = [
+            "Unknown metric code" if readings["metric"][i] >= len(METRICS)
+            else "Timestamp must be finite" if not np.isfinite(readings["timestamp"][i])
+            else "Value must be finite"
+            for i in records[:MAX_ERRORS].tolist()
+        ]
+        raise _invalid((records + 1).tolist(), messages)
+    return readings
+
+
+def _parse_reading(line):
+    reading = json.loads(line)
+    if not isinstance(reading, dict):
+        raise ValueError("Reading must be an object")
+    try:
+        patient_id, timestamp, metric, value = (reading[key] for key in ("patient_id", "timestamp", "metric", "value"))
+    except KeyError as exc:
+        raise ValueError(f"Missing {exc}")
+    if not isinstance(patient_id, str) or not patient_id:
+        raise ValueError("patient_id must be a non-empty string")
+    patient_id = patient_id.encode()
+    if len(patient_id) > READING_DTYPE["patient_id"].itemsize:
+        raise ValueError(f"Patient ID too long: {reading['patient_id']}")
+    if metric not in METRIC_CODES:
+        raise ValueError(f"Unknown metric: {metric}")
+    for name, number in (("timestamp", timestamp), ("value", value)):
+        if isinstance(number, bool) or not isinstance(number, (int, float)) or not math.isfinite(number):
+            raise ValueError(f"{name} must be a finite number")
+    if abs(value) > MAX_VALUE:
+        raise ValueError("value is out of range")
+    return patient_id, float(timestamp), METRIC_CODES[metric], float(value)
+
+
+def parse_ndjson(body):
+    """Decode NDJSON lines of ``{"patient_id", "timestamp", "metric", "value"}``
+
+    Returns the readings and the line number of each of them.
+    """
+    records, lines, errors = [], [], []
+    for number, line in enumerate(body.splitlines(), 1):
+        if not line.strip():
+            continue
+        try:
+            records.append(_parse_reading(line))
+            lines.append(number)
+        except (ValueError, OverflowError) as exc:
+            errors.append((number, str(exc)))
+    if errors:
+        raise _invalid(*zip(*errors))
+    return np.array(records, dtype=READING_DTYPE), np.array(lines, dtype=np.int64)
+
+
+class WriteAheadLog:
+    """Append-only, checksummed log of reading batches with group commit"""
+
+    def __init__(self, path):
+        self.path = path
+        self._file = None
+        self._queue = queue.Queue()
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def size(self):
+        with self._lock:
+            return self._file.tell() if self._file else (os.path.getsize(self.path) if os.path.exists(self.path) else 0)
+
+    def append(self, payload):
+        """Block until ``payload`` is durably on disk"""
+        done = threading.Event()
+        with self._lock:
+            if self._thread is None:
+                self._open()
+                self._thread = threading.Thread(target=self._run, name='ingest-wal', daemon=True)
+                self._thread.start()
+        self._queue.put((payload, done))
+        done.wait()
+
+    def _open(self):
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        # Unbuffered, so each batch of records reaches the file in one write
+        self._file = open(self.path, 'ab', buffering=0)
+
+    def _run(self):
+        while True:
+            batch = [self._queue.get()]
+            while True:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            with self._lock:
+                self._file.write(b''.join(
+                    _HEADER.pack(len(payload), zlib.crc32(payload)) + payload for payload, _ in batch
+                ))
+                os.fsync(self._file.fileno())
+            for _, done in batch:
+                done.set()
+
+    def records(self):
+        """Yield every intact payload; a torn or corrupt tail is cut off"""
+        if not os.path.exists(self.path):
+            return
+        with open(self.path, 'rb') as f:
+            data = f.read()
+        offset = 0
+        while offset + _HEADER.size <= len(data):
+            length, crc = _HEADER.unpack_from(data, offset)
+            payload = data[offset + _HEADER.size:offset + _HEADER.size + length]
+            if len(payload) < length or zlib.crc32(payload) != crc:
+                break
+            yield payload
+            offset += _HEADER.size + length
+        if offset < len(data):
+            with open(self.path, 'r+b') as f:
+                f.truncate(offset)
+
+    def truncate(self):
+        """Discard the log; the caller holds ``lock`` so nothing is appended meanwhile"""
+        if self._file:
+            self._file.truncate(0)
+            self._file.seek(0)
+            os.fsync(self._file.fileno())
+        elif os.path.exists(self.path):
+            os.truncate(self.path, 0)
+
+    @property
+    def lock(self):
+        return self._lock
+
+
+class VitalsIngestor:
+    """Write-ahead logged, backpressured ingestion into a ``VitalsStore``
+
+    At most ``max_pending`` readings may be accepted but not yet applied;
+    beyond that ``submit`` raises ``Backpressure`` with a retry hint derived
+    from the observed apply rate. A patient's readings must arrive in time
+    order: ``late`` finds those older than the patient's latest sample,
+    stored or accepted, and ``apply`` drops any that still slip through. When the log outgrows
+    ``checkpoint_bytes`` the store is snapshotted and the log truncated.
+    With ``owns``, a predicate on patient IDs, only the rows of the
+    patients it accepts are snapshotted. ``directory`` is locked for the
+    life of the process; ``DirectoryInUse`` is raised if another holds it.
+    """
+
+    def __init__(self, store, directory, max_pending=DEFAULT_MAX_PENDING, checkpoint_bytes=DEFAULT_CHECKPOINT_BYTES,
+                 owns=None):
+        self.store = store
+        self.owns = owns
+        self._directory_lock = _lock_directory(directory)
+        self.log = WriteAheadLog(os.path.join(directory, 'vitals.wal'))
+        self.checkpoint_path = os.path.join(directory, 'vitals-checkpoint.npz')
+        self.max_pending = max_pending
+        self.checkpoint_bytes = checkpoint_bytes
+        self.pending = 0
+        self.applied = 0
+        # Readings applied per second, smoothed
+        self.rate = 0.0
+        # Newest accepted timestamp by patient ID, while readings are pending
+        self._accepted = {}
+        self._queue = queue.Queue()
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def recover(self, resume=False):
+        """Restore the last checkpoint and replay the log; returns readings replayed
+
+        With ``resume`` the store still holds what was applied before, as
+        when a worker restarts over a shared store: the checkpoint is left
+        alone and only readings newer than their patient's latest sample
+        are replayed.
+        """
+        if not resume and os.path.exists(self.checkpoint_path):
+            self.store.restore(self.checkpoint_path)
+        replayed = 0
+        for payload in self.log.records():
+            readings = np.frombuffer(payload, dtype=READING_DTYPE)
+            if resume:
+                readings = self._unapplied(readings)
+            self.apply(readings)
+            replayed += len(readings)
+        return replayed
+
+    def _unapplied(self, readings):
+        ids, inverse = np.unique(readings["patient_id"], return_inverse=True)
+        rows = self.store.rows_of([pid.decode() for pid in ids.tolist()])
+        known = rows >= 0
+        latest = np.full(len(ids), np.inf)
+        latest[known] = self.store.latest_rows(rows[known])["timestamp"]
+        return readings[readings["timestamp"] > latest[inverse.reshape(-1)]]
+
+    def _latest(self, ids):
+        """Latest sample timestamp of each patient ID, -inf for those without samples"""
+        rows = self.store.rows_of([pid.decode() for pid in ids.tolist()])
+        latest = np.full(len(ids), -np.inf)
+        held = rows >= 0
+        held[held] = self.store.count[rows[held]] > 0
+        latest[held] = self.store.latest_rows(rows[held])["timestamp"]
+        return latest
+
+    def late(self, readings):
+        """Mask of the readings older than their patient's latest stored or accepted one"""
+        ids, inverse = np.unique(readings["patient_id"], return_inverse=True)
+        latest = self._latest(ids)
+        with self._lock:
+            accepted = np.array([self._accepted.get(pid, -np.inf) for pid in ids.tolist()])
+        return readings["timestamp"] < np.maximum(latest, accepted)[inverse.reshape(-1)]
+
+    def submit(self, readings):
+        """Durably log ``readings`` and queue them; raises ``Backpressure`` when saturated"""
+        n = len(readings)
+        if not n:
+            return 0
+        with self._lock:
+            if self.pending and self.pending + n > self.max_pending:
+                backlog = self.pending
+                raise Backpressure(min(60, max(1, math.ceil(backlog / max(self.rate, 1.0)))))
+            self.pending += n
+            ids, inverse = np.unique(readings["patient_id"], return_inverse=True)
+            newest = np.full(len(ids), -np.inf)
+            np.maximum.at(newest, inverse.reshape(-1), readings["timestamp"])
+            for pid, timestamp in zip(ids.tolist(), newest.tolist()):
+                self._accepted[pid] = max(timestamp, self._accepted.get(pid, -np.inf))
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='ingest-apply', daemon=True)
+                self._thread.start()
+        try:
+            self.log.append(readings.tobytes())
+        except Exception:
+            with self._lock:
+                self.pending -= n
+            raise
+        self._queue.put(readings)
+        return n
+
+    def _run(self):
+        while True:
+            batch = [self._queue.get()]
+            size = len(batch[0])
+            while size < _APPLY_BATCH:
+                try:
+                    readings = self._queue.get_nowait()
+                except queue.Empty:
+                    break
+                batch.append(readings)
+                size += len(readings)
+            started = time.perf_counter()
+            try:
+                self.apply(np.concatenate(batch))
+            except Exception as exc:
+                print(f"Vitals ingestion failed: {exc}")
+            elapsed = max(time.perf_counter() - started, 1e-6)
+            with self._lock:
+                self.pending -= size
+                self.applied += size
+                self.rate = 0.8 * self.rate + 0.2 * (size / elapsed) if self.rate else size / elapsed
+                idle = self.pending == 0
+                if idle:
+                    # Everything accepted is in the store now
+                    self._accepted.clear()
+            if idle and self.log.size() > self.checkpoint_bytes:
+                self.checkpoint()
+
+    def checkpoint(self):
+        """Snapshot the store and truncate the log once everything logged is applied"""
+        with self.log.lock:
+            with self._lock:
+                if self.pending:
+                    return False
+            tmp = self.checkpoint_path + '.tmp'
+            with open(tmp, 'wb') as f:
+                if self.owns is None:
+                    self.store.save(f)
+                else:
+                    self.store.save(f, [pid for pid in self.store.patient_ids if self.owns(pid)])
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp, self.checkpoint_path)
+            self.log.truncate()
+        return True
+
+    def apply(self, readings):
+        """Fold readings into the store; returns the number of samples appended
+
+        Readings sharing a patient and timestamp form one sample. Metrics a
+        sample does not carry keep the patient's previous value. Readings for
+        patients without a store row, or older than the patient's latest
+        sample, are dropped.
+        """
+        store = self.store
+        ids, inverse = np.unique(readings["patient_id"], return_inverse=True)
+        inverse = inverse.reshape(-1)
+        rows = store.rows_of([pid.decode() for pid in ids.tolist()])[inverse]
+        known = rows >= 0
+        late = known & (readings["timestamp"] < self._latest(ids)[inverse])
+        if late.any():
+            print(f"Vitals ingestion dropped {int(late.sum())} reading(s) older than their patient's latest sample")
+            known &= ~late
+        rows = rows[known]
+        timestamps = readings["timestamp"][known]
+        metrics = readings["metric"][known]
+        values = readings["value"][known]
+        if not len(rows):
+            return 0
+
+        order = np.lexsort((timestamps, rows))
+        rows, timestamps, metrics, values = rows[order], timestamps[order], metrics[order], values[order]
+        boundary = np.r_[True, (rows[1:] != rows[:-1]) | (timestamps[1:] != timestamps[:-1])]
+        starts = np.flatnonzero(boundary)
+        group = np.cumsum(boundary) - 1
+        sample_rows = rows[starts]
+        sample_times = timestamps[starts]
+        grid = np.full((len(starts), len(METRICS)), np.nan)
+        grid[group, metrics] = values
+
+        # Carry each metric forward: the first sample of a patient falls back
+        # to the stored latest value, later ones to the previous sample
+        row_starts = np.flatnonzero(np.r_[True, sample_rows[1:] != sample_rows[:-1]])
+        latest = store.latest_rows(sample_rows[row_starts])
+        positions = np.arange(len(sample_rows))
+        for j, metric in enumerate(METRICS):
+            first = grid[row_starts, j]
+            grid[row_starts, j] = np.where(np.isnan(first), latest[metric], first)
+            filled = np.maximum.accumulate(np.where(np.isnan(grid[:, j]), 0, positions))
+            grid[:, j] = grid[filled, j]
+        store.append_samples(sample_rows, sample_times, {metric: grid[:, j] for j, metric in enumerate(METRICS)})
+        return len(sample_rows)
@@ -0,0 +1,345 @@
+"""Search over the knowledge base with an inverted index
+
+Every entry's name, description, symptoms, treatments and risk factors
+are tokenized into a term -> postings inverted index, with field weights
+favouring names and symptoms. The sorted vocabulary answers prefix
+queries with a bisect. A trigram index over the vocabulary finds
+candidate terms for misspelled words, and a bounded edit distance then
+checks them.
+
+Entries get integer document IDs. Putting an entry retires its old ID and
+appends postings for a new one, so the index follows the knowledge base
+incrementally. Postings are scored as NumPy arrays, which keeps common
+terms cheap when there are tens of thousands of entries. A term's
+retired postings are dropped once they outnumber its live ones.
+
+``search`` ranks entries for free text with BM25. ``match`` ranks
+conditions by how many of a list of symptoms their symptom lists cover.
+"""
+import bisect
+import collections
+import itertools
+import math
+import re
+import threading
+
+import numpy as np
+
+FIELD_WEIGHTS = {"name": 3.0, "symptoms": 2.0, "description": 1.0, "treatments": 1.0, "risk_factors": 1.0}
+
+STOPWORDS = frozenset((
+    "a", "an", "and", "are", "as", "at", "be", "by", "can", "for", "from", "how", "in", "is", "it",
+    "of", "on", "or", "that", "the", "to", "with",
+))
+
+# BM25 parameters
+K1 = 1.2
+B = 0.75
+
+# Score multipliers for terms that only match a query word by prefix or with typos
+PREFIX_WEIGHT = 0.8
+FUZZY_WEIGHT = 0.6
+# Vocabulary terms a query word may expand to
+MAX_EXPANSIONS = 16
+# Words shorter than this are matched exactly or by prefix only
+MIN_FUZZY_LENGTH = 4
+
+_WORD = re.compile(r"[a-z0-9]+")
+
+
+def tokenize(text):
+    return [word for word in _WORD.findall(text.casefold()) if word not in STOPWORDS]
+
+
+def _trigrams(term):
+    padded = f"  {term} "
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+def _max_edits(term):
+    return 1 if len(term) < 8 else 2
+
+
+def _name_key(name):
+    return " ".join(tokenize(name)) or name.casefold()
+
+
+def edit_distance(a, b, limit):
+    """Levenshtein distance between ``a`` and ``b``, or ``limit + 1`` once it exceeds ``limit``"""
+    if abs(len(a) - len(b)) > limit:
+        return limit + 1
+    previous = list(range(len(b) + 1))
+    for i, char in enumerate(a, 1):
+        current = [i]
+        for j, other in enumerate(b, 1):
+            current.append(min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + (char != other)))
+        if min(current) > limit:
+            return limit + 1
+        previous = current
+    return previous[-1]
+
+
+def _top(scores, limit):
+    # Positive scores, best first; a partial sort keeps large result sets cheap
+    hits = np.flatnonzero(scores > 0)
+    if len(hits) > limit:
+        hits = hits[np.argpartition(-scores[hits], limit - 1)[:limit]]
+    return hits[np.lexsort((hits, -scores[hits]))]
+
+
+class _Postings:
+    """Document IDs and weights of one term, appended to and read as arrays"""
+
+    __slots__ = ("docs", "weights", "live", "_arrays")
+
+    def __init__(self):
+        self.docs = []
+        self.weights = []
+        self.live = 0
+        self._arrays = None
+
+    def add(self, doc, weight):
+        self.docs.append(doc)
+        self.weights.append(weight)
+        self.live += 1
+        self._arrays = None
+
+    def arrays(self, alive):
+        """``(docs, weights)`` of the live documents"""
+        if self._arrays is None:
+            docs = np.array(self.docs, dtype=np.int64)
+            weights = np.array(self.weights)
+            if len(docs) > self.live:
+                keep = alive[docs]
+                docs, weights = docs[keep], weights[keep]
+                if len(self.docs) > 2 * self.live:
+                    self.docs, self.weights = docs.tolist(), weights.tolist()
+            self._arrays = docs, weights
+        return self._arrays
+
+
+class KnowledgeIndex:
+    """Inverted, prefix and trigram indexes over knowledge base entries"""
+
+    def __init__(self, entries=()):
+        # Per term: postings over all fields, and over symptoms only
+        self._postings = {}
+        self._symptoms = {}
+        self._terms = []
+        self._trigrams = {}
+        # Per document ID
+        self._conditions = []
+        self._alive = np.zeros(64, dtype=bool)
+        self._lengths = np.zeros(64)
+        self._symptom_counts = np.zeros(64)
+        # Per live condition: (document ID, its terms, its symptom terms)
+        self._documents = {}
+        self._names = {}
+        self._total_length = 0.0
+        self._lock = threading.Lock()
+        for condition, entry in entries:
+            self.put(condition, entry)
+
+    def __len__(self):
+        return len(self._documents)
+
+    def resolve(self, name):
+        """The condition named ``name``, ignoring case and spacing, or None"""
+        return self._names.get(_name_key(name))
+
+    def put(self, condition, entry):
+        """Index a new entry or re-index an updated one"""
+        weights = {}
+        for term in tokenize(condition):
+            weights[term] = weights.get(term, 0.0) + FIELD_WEIGHTS["name"]
+        for field in ("description", "symptoms", "treatments", "risk_factors"):
+            value = entry.get(field, "")
+            for term in tokenize(value if isinstance(value, str) else " ".join(value)):
+                weights[term] = weights.get(term, 0.0) + FIELD_WEIGHTS[field]
+        symptoms = [tokenize(symptom) for symptom in entry.get("symptoms", ())]
+        symptom_terms = {term for symptom in symptoms for term in symptom}
+        with self._lock:
+            self._remove(condition)
+            doc = len(self._conditions)
+            if doc >= len(self._alive):
+                self._grow(2 * len(self._alive))
+            self._conditions.append(condition)
+            self._alive[doc] = True
+            self._lengths[doc] = sum(weights.values())
+            self._symptom_counts[doc] = sum(1 for symptom in symptoms if symptom)
+            self._total_length += self._lengths[doc]
+            self._documents[condition] = (doc, tuple(weights), tuple(symptom_terms))
+            self._names[_name_key(condition)] = condition
+            for term, weight in weights.items():
+                postings = self._postings.get(term)
+                if postings is None:
+                    postings = self._postings[term] = _Postings()
+                    self._add_term(term)
+                postings.add(doc, weight)
+            for term in symptom_terms:
+                self._symptoms.setdefault(term, _Postings()).add(doc, 1.0)
+
+    def remove(self, condition):
+        with self._lock:
+            self._remove(condition)
+
+    def _grow(self, n_docs):
+        for name in ("_alive", "_lengths", "_symptom_counts"):
+            arr = getattr(self, name)
+            grown = np.zeros(n_docs, dtype=arr.dtype)
+            grown[:len(arr)] = arr
+            setattr(self, name, grown)
+
+    def _remove(self, condition):
+        document = self._documents.pop(condition, None)
+        if document is None:
+            return
+        doc, terms, symptom_terms = document
+        self._alive[doc] = False
+        self._conditions[doc] = None
+        self._total_length -= self._lengths[doc]
+        self._names.pop(_name_key(condition), None)
+        for index, term_list in ((self._postings, terms), (self._symptoms, symptom_terms)):
+            for term in term_list:
+                postings = index[term]
+                postings.live -= 1
+                postings._arrays = None
+                if not postings.live:
+                    del index[term]
+                    if index is self._postings:
+                        self._remove_term(term)
+
+    def _add_term(self, term):
+        bisect.insort(self._terms, term)
+        for gram in _trigrams(term):
+            self._trigrams.setdefault(gram, set()).add(term)
+
+    def _remove_term(self, term):
+        del self._terms[bisect.bisect_left(self._terms, term)]
+        for gram in _trigrams(term):
+            terms = self._trigrams[gram]
+            terms.discard(term)
+            if not terms:
+                del self._trigrams[gram]
+
+    def expand(self, word, prefix=True):
+        """Vocabulary terms matching ``word``, as ``{term: weight}``
+
+        An indexed word matches with weight 1. Unless ``prefix`` is false,
+        longer terms starting with the word also match. If neither finds
+        anything, terms within the word's edit-distance budget match.
+        """
+        expansions = {}
+        if word in self._postings:
+            expansions[word] = 1.0
+        if prefix:
+            start = bisect.bisect_left(self._terms, word)
+            for term in self._terms[start:start + MAX_EXPANSIONS]:
+                if not term.startswith(word):
+                    break
+                expansions.setdefault(term, PREFIX_WEIGHT)
+        if expansions or len(word) < MIN_FUZZY_LENGTH:
+            return expansions
+
+        # Terms sharing enough trigrams to be within the edit budget;
+        # each edit destroys at most three of the word's trigrams
+        limit = _max_edits(word)
+        grams = _trigrams(word)
+        needed = len(grams) - 3 * limit
+        shared = collections.Counter(itertools.chain.from_iterable(self._trigrams.get(gram, ()) for gram in grams))
+        for term, count in shared.most_common(4 * MAX_EXPANSIONS):
+            if count < needed:
+                break
+            distance = edit_distance(word, term, limit)
+            if distance <= limit:
+                expansions[term] = FUZZY_WEIGHT * (1 - distance / (len(word) + 1))
+                if len(expansions) >= MAX_EXPANSIONS:
+                    break
+        return expansions
+
+    def search(self, query, limit=10):
+        """Entries ranked for free text; the last word also matches as a prefix
+
+        Returns ``[{"condition", "score", "matched"}]``, best first, where
+        ``matched`` lists the indexed terms each hit was found under.
+        """
+        words = list(dict.fromkeys(tokenize(query)))
+        with self._lock:
+            n = len(self._documents)
+            if not words or not n:
+                return []
+            size = len(self._conditions)
+            norm = K1 * (1 - B + B * self._lengths[:size] / (self._total_length / n))
+            scores = np.zeros(size)
+            matched = []
+            for i, word in enumerate(words):
+                # Per word, an entry scores by its best matching term
+                best = np.zeros(size)
+                best_term = np.full(size, -1)
+                terms = list(self.expand(word, prefix=i == len(words) - 1).items())
+                for t, (term, factor) in enumerate(terms):
+                    docs, weights = self._postings[term].arrays(self._alive)
+                    idf = math.log(1 + (n - len(docs) + 0.5) / (len(docs) + 0.5))
+                    score = factor * idf * weights * (K1 + 1) / (weights + norm[docs])
+                    better = score > best[docs]
+                    best[docs[better]] = score[better]
+                    best_term[docs[better]] = t
+                scores += best
+                matched.append((terms, best_term))
+            top = _top(scores, limit)
+            conditions = [self._conditions[doc] for doc in top.tolist()]
+        return [
+            {
+                "condition": condition,
+                "score": round(float(scores[doc]), 4),
+                "matched": [terms[best_term[doc]][0] for terms, best_term in matched if best_term[doc] >= 0],
+            }
+            for doc, condition in zip(top.tolist(), conditions)
+        ]
+
+    def match(self, symptoms, limit=10):
+        """Conditions ranked by how well their symptom lists cover ``symptoms``
+
+        A query symptom counts for a condition when each of its words
+        matches a word of the condition's symptoms, exactly, as a prefix or
+        with typos. Rarer symptoms count for more. Returns ``[{"condition",
+        "score", "matched", "missing"}]``, best first.
+        """
+        queries = [(symptom, tokenize(symptom)) for symptom in dict.fromkeys(symptoms)]
+        queries = [(symptom, words) for symptom, words in queries if words]
+        with self._lock:
+            n = len(self._documents)
+            if not queries or not n:
+                return []
+            size = len(self._conditions)
+            scores = np.zeros(size)
+            held = np.zeros((len(queries), size), dtype=bool)
+            for q, (_, words) in enumerate(queries):
+                holders = self._alive[:size].copy()
+                for word in words:
+                    found = np.zeros(size, dtype=bool)
+                    for term in self.expand(word):
+                        postings = self._symptoms.get(term)
+                        if postings is not None:
+                            found[postings.arrays(self._alive)[0]] = True
+                    holders &= found
+                count = int(holders.sum())
+                if count:
+                    held[q] = holders
+                    scores += holders * math.log(1 + n / count)
+            matches = held.sum(axis=0)
+            # Unexplained symptoms on either side lower the score
+            coverage = matches / len(queries)
+            precision = matches / np.maximum(self._symptom_counts[:size], 1)
+            scores *= np.sqrt(coverage * precision)
+            top = _top(scores, limit)
+            conditions = [self._conditions[doc] for doc in top.tolist()]
+        return [
+            {
+                "condition": condition,
+                "score": round(float(scores[doc]), 4),
+                "matched": [symptom for q, (symptom, _) in enumerate(queries) if held[q, doc]],
+                "missing": [symptom for q, (symptom, _) in enumerate(queries) if not held[q, doc]],
+            }
+            for doc, condition in zip(top.tolist(), conditions)
+        ]
@@ -0,0 +1,325 @@
+"""Request instrumentation: counters, gauges, latency histograms and a sampling profiler
+
+Metrics are recorded without locks. Every thread writes to its own shard
+of plain lists. A scrape sums the shards. When a thread exits, its shard
+is folded into a shared total, so the threads a development server starts
+per request do not pile up shards. Recording costs a dict lookup, a bisect
+and a few integer additions, and ``render`` writes the Prometheus text
+exposition format.
+
+``RequestMetrics`` instruments a WSGI app and ``timed`` any function. Set
+``MEDNEXUS_METRICS=0`` to disable recording; ``timed`` then returns
+functions undecorated.
+"""
+import bisect
+import collections
+import functools
+import os
+import sys
+import threading
+import time
+import weakref
+
+ENABLED = os.environ.get('MEDNEXUS_METRICS', '1') != '0'
+
+# Upper bounds of the latency histogram buckets, in seconds
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+DEFAULT_PROFILE_INTERVAL = float(os.environ.get('MEDNEXUS_PROFILE_INTERVAL', 0.01))
+
+
+class _Sentinel:
+    # Freed with its thread's locals, which retires the thread's shard
+    pass
+
+
+class Registry:
+    """Metric families and the per-thread shards holding their values"""
+
+    def __init__(self):
+        self.families = []
+        self._local = threading.local()
+        self._shards = []
+        # Values of shards whose threads have exited
+        self._retired = {}
+        self._lock = threading.Lock()
+
+    def shard(self):
+        shard = getattr(self._local, 'shard', None)
+        if shard is None:
+            shard = self._local.shard = {}
+            sentinel = self._local.sentinel = _Sentinel()
+            with self._lock:
+                self._shards.append(shard)
+            weakref.finalize(sentinel, self._retire, shard)
+        return shard
+
+    def _retire(self, shard):
+        with self._lock:
+            self._shards.remove(shard)
+            _merge(self._retired, shard)
+
+    def counter(self, name, help, labelnames=()):
+        return self._add(Counter(self, name, help, labelnames))
+
+    def gauge(self, name, help, labelnames=()):
+        return self._add(Gauge(self, name, help, labelnames))
+
+    def histogram(self, name, help, labelnames=(), buckets=LATENCY_BUCKETS):
+        return self._add(Histogram(self, name, help, labelnames, buckets))
+
+    def _add(self, family):
+        self.families.append(family)
+        return family
+
+    def collect(self):
+        """Sum every shard into ``{(family, labels): values}``"""
+        totals = {}
+        with self._lock:
+            _merge(totals, self._retired)
+            for shard in self._shards:
+                _merge(totals, shard)
+        return totals
+
+    def render(self):
+        """All metrics in the Prometheus text exposition format"""
+        totals = self.collect()
+        by_family = collections.defaultdict(list)
+        for (family, labels), values in totals.items():
+            by_family[family].append((labels, values))
+        lines = []
+        for family in self.families:
+            lines.append(f"# HELP {family.name} {family.help}")
+            lines.append(f"# TYPE {family.name} {family.type}")
+            for labels, values in sorted(by_family.get(family, ()), key=lambda item: item[0]):
+                lines.extend(family.render(labels, values))
+        return "\n".join(lines) + "\n"
+
+
+def _merge(into, shard):
+    # Another thread may add series to ``shard`` meanwhile; copying the
+    # items first keeps the iteration safe
+    for key, values in list(shard.items()):
+        total = into.get(key)
+        if total is None:
+            into[key] = list(values)
+        else:
+            for i, value in enumerate(values):
+                total[i] += value
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(names, values, extra=()):
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    pairs.extend(f'{name}="{value}"' for name, value in extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _format_value(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    type = "counter"
+
+    def __init__(self, registry, name, help, labelnames):
+        self.registry = registry
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+
+    def inc(self, labels=(), amount=1):
+        shard = self.registry.shard()
+        key = (self, labels)
+        values = shard.get(key)
+        if values is None:
+            values = shard[key] = [0]
+        values[0] += amount
+
+    def series(self, labels=()):
+        """The calling thread's one-element value list for ``labels``, to update in place"""
+        shard = self.registry.shard()
+        values = shard.get((self, labels))
+        if values is None:
+            values = shard[(self, labels)] = [0]
+        return values
+
+    def render(self, labels, values):
+        return [f"{self.name}{_format_labels(self.labelnames, labels)} {_format_value(values[0])}"]
+
+
+class Gauge(Counter):
+    type = "gauge"
+
+    def dec(self, labels=(), amount=1):
+        self.inc(labels, -amount)
+
+
+class Histogram:
+    """Cumulative-bucket histogram; each series is per-bucket counts followed by the sum"""
+
+    type = "histogram"
+
+    def __init__(self, registry, name, help, labelnames, buckets):
+        self.registry = registry
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, labels=()):
+        shard = self.registry.shard()
+        key = (self, labels)
+        values = shard.get(key)
+        if values is None:
+            values = shard[key] = [0] * (len(self.buckets) + 2)
+        values[bisect.bisect_left(self.buckets, value)] += 1
+        values[-1] += value
+
+    def render(self, labels, values):
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.buckets + (float('inf'),), values):
+            cumulative += count
+            le = "+Inf" if bound == float('inf') else repr(bound)
+            lines.append(f"{self.name}_bucket{_format_labels(self.labelnames, labels, [('le', le)])} {cumulative}")
+        lines.append(f"{self.name}_sum{_format_labels(self.labelnames, labels)} {_format_value(values[-1])}")
+        lines.append(f"{self.name}_count{_format_labels(self.labelnames, labels)} {cumulative}")
+        return lines
+
+
+REGISTRY = Registry()
+
+REQUESTS = REGISTRY.counter(
+    "mednexus_http_requests_total", "HTTP requests handled.", ("method", "route", "status"))
+REQUEST_SECONDS = REGISTRY.histogram(
+    "mednexus_http_request_duration_seconds", "Time to produce a response, in seconds.", ("method", "route"))
+REQUEST_BYTES = REGISTRY.counter(
+    "mednexus_http_request_bytes_total", "Request body bytes received.", ("method", "route"))
+RESPONSE_BYTES = REGISTRY.counter(
+    "mednexus_http_response_bytes_total", "Response body bytes sent.", ("method", "route"))
+IN_FLIGHT = REGISTRY.gauge(
+    "mednexus_http_requests_in_flight", "HTTP requests being handled.")
+FUNCTION_SECONDS = REGISTRY.histogram(
+    "mednexus_function_duration_seconds", "Time spent in instrumented functions, in seconds.", ("function",))
+
+
+def timed(func):
+    """Record every call's duration in ``mednexus_function_duration_seconds``"""
+    if not ENABLED:
+        return func
+    labels = (f"{func.__module__}.{func.__qualname__}",)
+    clock = time.perf_counter
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        started = clock()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            FUNCTION_SECONDS.observe(clock() - started, labels)
+
+    return wrapper
+
+
+# WSGI environ key the app stores the matched route template under
+ROUTE_KEY = 'mednexus.route'
+
+
+class RequestMetrics:
+    """WSGI middleware recording latency, counts, bytes and in-flight requests per route
+
+    Latency runs until the application returns its response. Bodies with a
+    Content-Length are passed through untouched, keeping zero-copy file
+    responses intact. Other bodies are counted as they stream.
+    """
+
+    def __init__(self, wsgi_app):
+        self.wsgi_app = wsgi_app
+
+    def __call__(self, environ, start_response):
+        started = time.perf_counter()
+        in_flight = IN_FLIGHT.series()
+        in_flight[0] += 1
+        response = []
+
+        def start(status, headers, exc_info=None):
+            response.append((status, headers))
+            return start_response(status, headers, exc_info)
+
+        try:
+            body = self.wsgi_app(environ, start)
+        finally:
+            in_flight[0] -= 1
+        labels = (environ['REQUEST_METHOD'], environ.get(ROUTE_KEY, 'unmatched'))
+        REQUEST_SECONDS.observe(time.perf_counter() - started, labels)
+        status, headers = response[-1] if response else ('500', ())
+        REQUESTS.inc(labels + (status[:3],))
+        received = environ.get('CONTENT_LENGTH')
+        if received and received != '0':
+            REQUEST_BYTES.inc(labels, int(received))
+        for name, value in headers:
+            if name.lower() == 'content-length':
+                RESPONSE_BYTES.inc(labels, int(value))
+                return body
+        return _counting(body, labels)
+
+
+def _counting(chunks, labels):
+    try:
+        for chunk in chunks:
+            RESPONSE_BYTES.inc(labels, len(chunk))
+            yield chunk
+    finally:
+        close = getattr(chunks, 'close', None)
+        if close is not None:
+            close()
+
+
+class SamplingProfiler:
+    """Sample every thread's Python stack at a fixed interval
+
+    Stacks are counted in the folded format (``frame;frame;frame count``
+    per line, root first) that flamegraph.pl, speedscope and inferno read.
+    Only one profile runs at a time; nothing runs between profiles.
+    """
+
+    def __init__(self, interval=DEFAULT_PROFILE_INTERVAL):
+        self.interval = interval
+        self._lock = threading.Lock()
+        self._labels = {}
+
+    def _label(self, code):
+        label = self._labels.get(code)
+        if label is None:
+            label = self._labels[code] = f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+        return label
+
+    def profile(self, seconds):
+        """Sample for ``seconds`` and return folded stacks; raises RuntimeError if one is running"""
+        if not self._lock.acquire(blocking=False):
+            raise RuntimeError("A profile is already running")
+        try:
+            counts = collections.Counter()
+            me = threading.get_ident()
+            names = {}
+            deadline = time.monotonic() + seconds
+            while time.monotonic() < deadline:
+                for thread in threading.enumerate():
+                    names[thread.ident] = thread.name
+                for ident, frame in sys._current_frames().items():
+                    if ident == me:
+                        continue
+                    stack = []
+                    while frame is not None:
+                        stack.append(self._label(frame.f_code))
+                        frame = frame.f_back
+                    stack.append(names.get(ident, str(ident)))
+                    counts[";".join(reversed(stack))] += 1
+                time.sleep(self.interval)
+            return "".join(f"{stack} {count}\n" for stack, count in counts.most_common())
+        finally:
+            self._lock.release()
@@ -0,0 +1,128 @@
+"""Secondary indexes over patient demographics, conditions and medications"""
+import base64
+import bisect
+import heapq
+import threading
+
+
+def encode_cursor(ordinal):
+    return base64.urlsafe_b64encode(f"p:{ordinal}".encode()).decode()
+
+
+def decode_cursor(cursor):
+    try:
+        prefix, ordinal = base64.urlsafe_b64decode(cursor.encode()).decode().split(":")
+        if prefix != "p":
+            raise ValueError
+        return int(ordinal)
+    except (ValueError, UnicodeDecodeError):
+        raise ValueError("Invalid cursor")
+
+
+class PatientIndex:
+    """Incrementally maintained indexes for filtered, cursor-paginated listing
+
+    Each patient gets a stable ordinal in insertion order, which is the
+    listing order and what cursors point at. The indexes are sorted ordinal
+    posting lists per age, gender, condition and medication. A query walks
+    the most selective index from the cursor position, merging the posting
+    lists of every age in range, and checks the remaining filters per
+    candidate.
+    """
+
+    def __init__(self):
+        self._ordinals = {}
+        self._ids = []
+        self._attrs = []
+        self._ages = {}
+        self._postings = {"gender": {}, "condition": {}, "medication": {}}
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._ordinals)
+
+    def add(self, patient_id, patient):
+        """Index a new patient or re-index an updated one"""
+        attrs = {
+            "age": patient["age"],
+            "gender": {patient["gender"]},
+            "condition": set(patient.get("conditions", [])),
+            "medication": set(patient.get("medications", [])),
+        }
+        with self._lock:
+            ordinal = self._ordinals.get(patient_id)
+            if ordinal is None:
+                ordinal = len(self._ids)
+                self._ordinals[patient_id] = ordinal
+                self._ids.append(patient_id)
+                self._attrs.append(None)
+            else:
+                self._unindex(ordinal)
+            self._attrs[ordinal] = attrs
+            bisect.insort(self._ages.setdefault(attrs["age"], []), ordinal)
+            for field, postings in self._postings.items():
+                for value in attrs[field]:
+                    bisect.insort(postings.setdefault(value, []), ordinal)
+
+    def remove(self, patient_id):
+        with self._lock:
+            ordinal = self._ordinals.pop(patient_id)
+            self._unindex(ordinal)
+            self._ids[ordinal] = None
+            self._attrs[ordinal] = None
+
+    def _unindex(self, ordinal):
+        attrs = self._attrs[ordinal]
+        posting = self._ages[attrs["age"]]
+        del posting[bisect.bisect_left(posting, ordinal)]
+        for field, postings in self._postings.items():
+            for value in attrs[field]:
+                posting = postings[value]
+                del posting[bisect.bisect_left(posting, ordinal)]
+
+    @staticmethod
+    def _after(posting, ordinal):
+        return (posting[i] for i in range(bisect.bisect_right(posting, ordinal), len(posting)))
+
+    def query(self, filters, limit=None, cursor=None):
+        """Return ``(patient_ids, next_cursor)`` for the filters, in listing order
+
+        ``filters`` may contain ``min_age``, ``max_age``, ``gender`` and lists
+        of ``conditions``/``medications`` that must all be present.
+        """
+        after = decode_cursor(cursor) if cursor else -1
+        min_age = filters.get("min_age")
+        max_age = filters.get("max_age")
+        required = [("gender", filters["gender"])] if filters.get("gender") else []
+        required += [("condition", c) for c in filters.get("conditions", ())]
+        required += [("medication", m) for m in filters.get("medications", ())]
+
+        # Each index that bounds the result, as the posting lists it merges;
+        # the smallest drives the walk
+        drivers = [[self._postings[field].get(value, [])] for field, value in required]
+        if min_age is not None or max_age is not None:
+            drivers.append([
+                posting for age, posting in list(self._ages.items())
+                if (min_age is None or age >= min_age) and (max_age is None or age <= max_age)
+            ])
+        if drivers:
+            driver = min(drivers, key=lambda postings: sum(map(len, postings)))
+            candidates = heapq.merge(*(self._after(posting, after) for posting in driver))
+        else:
+            candidates = range(after + 1, len(self._ids))
+
+        matches = []
+        for ordinal in candidates:
+            attrs = self._attrs[ordinal]
+            if attrs is None:
+                continue
+            if min_age is not None and attrs["age"] < min_age:
+                continue
+            if max_age is not None and attrs["age"] > max_age:
+                continue
+            if not all(value in attrs[field] for field, value in required):
+                continue
+            if limit is not None and len(matches) == limit:
+                return [self._ids[o] for o in matches], encode_cursor(matches[-1])
+            matches.append(ordinal)
+        return [self._ids[o] for o in matches], None
@@ -0,0 +1,407 @@
+"""Population analytics from incrementally maintained aggregates
+
+Patients are grouped by age band and gender. For every group the
+aggregates hold the patient count, the patients with each condition, and
+the count, sum, sum of squares and histogram of every metric's latest
+reading. A patient update moves one patient's contribution between groups.
+A vitals append swaps the affected patients' old latest readings for the
+new ones with a few ``bincount`` calls. Alert counts are kept per time
+bucket in a ring. Serving a dashboard therefore only reads small arrays,
+whatever the size of the population.
+
+Ad-hoc group-bys run on a pandas snapshot built from the same columnar
+state. It is rebuilt only when the data changed, and at most once every
+``MEDNEXUS_ANALYTICS_SNAPSHOT_TTL`` seconds.
+"""
+import os
+import threading
+import time
+
+import numpy as np
+
+from anomaly import KINDS, LABELS
+from simulator import ALERT_RULES, evaluate_alerts
+from vitals_store import METRICS
+
+# Lower bounds of the age bands; the last band is open-ended
+AGE_BANDS = (0, 18, 30, 40, 50, 60, 70, 80)
+AGE_BAND_LABELS = tuple(
+    f"{low}-{high - 1}" for low, high in zip(AGE_BANDS, AGE_BANDS[1:])
+) + (f"{AGE_BANDS[-1]}+",)
+GENDERS = ("Male", "Female", "Other")
+N_GROUPS = len(AGE_BANDS) * len(GENDERS)
+
+# Histogram of each metric's latest reading: (lowest edge, bin width, bins);
+# readings outside the range fall into the first or last bin
+HISTOGRAMS = {
+    "heart_rate": (30.0, 5.0, 34),
+    "systolic": (70.0, 5.0, 30),
+    "diastolic": (40.0, 5.0, 20),
+    "temperature": (94.0, 0.2, 60),
+    "oxygen_saturation": (80.0, 1.0, 21),
+}
+
+# Alert series: the simulator's threshold rules, then the anomaly detector's kinds per metric
+ALERTS = tuple(message for _, message, _ in ALERT_RULES) + tuple(
+    template.format(label=LABELS[metric]) for metric in METRICS for _, _, template in KINDS
+)
+
+ALERT_BUCKET_SECONDS = int(os.environ.get('MEDNEXUS_ALERT_BUCKET_SECONDS', 60))
+ALERT_BUCKETS = int(os.environ.get('MEDNEXUS_ALERT_BUCKETS', 1440))
+SNAPSHOT_TTL = float(os.environ.get('MEDNEXUS_ANALYTICS_SNAPSHOT_TTL', 5.0))
+
+# Columns of the snapshot besides metrics and conditions
+NUMERIC_COLUMNS = ("age", "n_conditions", "n_medications")
+AGGREGATES = ("count", "mean", "median", "min", "max", "std", "p90", "p95", "p99")
+
+
+def groups_of(ages, genders):
+    """Group of each patient, by age band and gender, as an array"""
+    bands = np.maximum(np.searchsorted(AGE_BANDS, ages, side='right') - 1, 0)
+    sexes = {gender: i for i, gender in enumerate(GENDERS[:-1])}
+    return bands * len(GENDERS) + np.array([sexes.get(gender, len(GENDERS) - 1) for gender in genders], dtype=np.int64)
+
+
+def _bins(metric, values):
+    low, width, bins = HISTOGRAMS[metric]
+    return np.clip(((values - low) // width).astype(np.int64), 0, bins - 1)
+
+
+class PopulationAggregates:
+    """Per-group prevalence, vitals statistics and alert counts, kept current by updates"""
+
+    def __init__(self, store, detector=None, initial_rows=64):
+        self.store = store
+        self.detector = detector
+        self.conditions = []
+        self._condition_columns = {}
+
+        # Per store row
+        self.group = np.full(initial_rows, -1, dtype=np.int64)
+        self.age = np.full(initial_rows, np.nan)
+        self.n_medications = np.zeros(initial_rows, dtype=np.int64)
+        self.has_condition = np.zeros((initial_rows, 0), dtype=bool)
+        self.latest = np.full((initial_rows, len(METRICS)), np.nan)
+
+        # Per group
+        self.group_size = np.zeros(N_GROUPS, dtype=np.int64)
+        self.condition_counts = np.zeros((N_GROUPS, 0), dtype=np.int64)
+        self.vital_count = np.zeros((N_GROUPS, len(METRICS)))
+        self.vital_total = np.zeros((N_GROUPS, len(METRICS)))
+        self.vital_squares = np.zeros((N_GROUPS, len(METRICS)))
+        self.vital_histogram = {m: np.zeros((N_GROUPS, HISTOGRAMS[m][2])) for m in METRICS}
+
+        # Ring of alert buckets
+        self.alert_index = np.full(ALERT_BUCKETS, -1, dtype=np.int64)
+        self.alert_counts = np.zeros((ALERT_BUCKETS, len(ALERTS)), dtype=np.int64)
+
+        self.version = 0
+        self._snapshot = None
+        self._snapshot_version = -1
+        self._snapshot_time = 0.0
+        self._lock = threading.Lock()
+
+    def attach(self):
+        """Fold in the latest readings and alert history the store retains, then follow appends
+
+        A shared store replays them itself, on its first ``sync``.
+        """
+        store = self.store
+        if store.shared:
+            store.add_listener(self.update)
+            return
+        rows, timestamps, values = store.retained()
+        with self._lock:
+            self._grow(len(store))
+            self._count_alerts(timestamps, evaluate_alerts(values))
+            held = np.flatnonzero(store.count[:len(store)] > 0)
+            latest = store.latest_rows(held)
+            self._apply(held, -1)
+            self.latest[held] = np.column_stack([latest[m] for m in METRICS])
+            self._apply(held, 1)
+            self.version += 1
+        store.add_listener(self.update)
+
+    def _grow(self, n_rows):
+        if n_rows <= len(self.group):
+            return
+        n_rows = max(n_rows, 2 * len(self.group))
+
+        def grown(arr, fill):
+            out = np.full((n_rows,) + arr.shape[1:], fill, dtype=arr.dtype)
+            out[:len(arr)] = arr
+            return out
+
+        self.group = grown(self.group, -1)
+        self.age = grown(self.age, np.nan)
+        self.n_medications = grown(self.n_medications, 0)
+        self.has_condition = grown(self.has_condition, False)
+        self.latest = grown(self.latest, np.nan)
+
+    def _condition_column(self, condition):
+        column = self._condition_columns.get(condition)
+        if column is None:
+            column = self._condition_columns[condition] = len(self.conditions)
+            self.conditions.append(condition)
+            self.has_condition = np.hstack([self.has_condition, np.zeros((len(self.has_condition), 1), dtype=bool)])
+            self.condition_counts = np.hstack([self.condition_counts, np.zeros((N_GROUPS, 1), dtype=np.int64)])
+        return column
+
+    def set_patient(self, patient_id, patient):
+        """Add a patient or move an updated one to its new group and conditions"""
+        self.set_patients([(patient_id, patient)])
+
+    def set_patients(self, patients):
+        """``set_patient`` for many ``(patient_id, patient)`` pairs, in one pass over the aggregates"""
+        patients = dict(patients)
+        if not patients:
+            return
+        rows = np.array([self.store.add_patient(patient_id) for patient_id in patients], dtype=np.int64)
+        records = list(patients.values())
+        ages = np.array([patient["age"] for patient in records], dtype=np.float64)
+        groups = groups_of(ages, [patient["gender"] for patient in records])
+        with self._lock:
+            self._grow(int(rows.max()) + 1)
+            marked = [
+                (i, self._condition_column(condition))
+                for i, patient in enumerate(records) for condition in set(patient.get("conditions", ()))
+            ]
+            old = self.group[rows]
+            moved = old >= 0
+            if moved.any():
+                self.group_size -= np.bincount(old[moved], minlength=N_GROUPS)
+                np.subtract.at(self.condition_counts, old[moved], self.has_condition[rows[moved]])
+                self._apply(rows[moved], -1)
+            self.group[rows] = groups
+            self.age[rows] = ages
+            self.n_medications[rows] = [len(patient.get("medications", ())) for patient in records]
+            self.has_condition[rows] = False
+            if marked:
+                index, columns = np.array(marked, dtype=np.int64).T
+                self.has_condition[rows[index], columns] = True
+            self.group_size += np.bincount(groups, minlength=N_GROUPS)
+            np.add.at(self.condition_counts, groups, self.has_condition[rows])
+            self._apply(rows, 1)
+            self.version += 1
+
+    def _apply(self, rows, sign):
+        # Add (sign 1) or remove (sign -1) the latest readings of ``rows``
+        rows = rows[self.group[rows] >= 0]
+        if not len(rows):
+            return
+        groups = self.group[rows]
+        values = self.latest[rows]
+        for j, metric in enumerate(METRICS):
+            present = ~np.isnan(values[:, j])
+            g, v = groups[present], values[present, j]
+            self.vital_count[:, j] += sign * np.bincount(g, minlength=N_GROUPS)
+            self.vital_total[:, j] += sign * np.bincount(g, weights=v, minlength=N_GROUPS)
+            self.vital_squares[:, j] += sign * np.bincount(g, weights=v * v, minlength=N_GROUPS)
+            bins = HISTOGRAMS[metric][2]
+            self.vital_histogram[metric] += sign * np.bincount(
+                g * bins + _bins(metric, v), minlength=N_GROUPS * bins
+            ).reshape(N_GROUPS, bins)
+
+    def update(self, rows, timestamps, values):
+        """Store listener: swap in the newest reading per row and count alerts"""
+        if not len(rows):
+            return
+        matrix = np.column_stack([values[m] for m in METRICS])
+        with self._lock:
+            self._grow(int(rows.max()) + 1)
+            if rows[0] == 0 and rows[-1] == len(rows) - 1 and np.array_equal(rows, np.arange(len(rows))):
+                # A whole-ward tick: every row once, in order
+                latest_rows, newest = rows, matrix
+            else:
+                # Last occurrence of each row
+                reversed_rows = rows[::-1]
+                latest_rows, first = np.unique(reversed_rows, return_index=True)
+                newest = matrix[len(rows) - 1 - first]
+            self._apply(latest_rows, -1)
+            self.latest[latest_rows] = newest
+            self._apply(latest_rows, 1)
+
+            fired = np.zeros((len(rows), len(ALERTS)), dtype=bool)
+            fired[:, :len(ALERT_RULES)] = evaluate_alerts(values)
+            if self.detector is not None:
+                # Anomaly state reflects each row's newest sample
+                flags = self.detector.flags(latest_rows).reshape(len(latest_rows), -1)
+                fired = np.vstack([fired, np.hstack([np.zeros((len(latest_rows), len(ALERT_RULES)), dtype=bool), flags])])
+                timestamps = np.concatenate([timestamps, np.full(len(latest_rows), timestamps[-1])])
+            self._count_alerts(timestamps, fired)
+            self.version += 1
+
+    def _count_alerts(self, timestamps, fired):
+        if not len(timestamps):
+            return
+        width = fired.shape[1]
+        if width < len(ALERTS):
+            fired = np.hstack([fired, np.zeros((len(fired), len(ALERTS) - width), dtype=bool)])
+        bucket = np.floor(np.asarray(timestamps) / ALERT_BUCKET_SECONDS).astype(np.int64)
+        slot = bucket % ALERT_BUCKETS
+        # Samples older than the bucket their slot now holds have aged out
+        live = bucket >= self.alert_index[slot]
+        bucket, slot, fired = bucket[live], slot[live], fired[live]
+        newer = bucket > self.alert_index[slot]
+        if newer.any():
+            before = self.alert_index.copy()
+            np.maximum.at(self.alert_index, slot[newer], bucket[newer])
+            self.alert_counts[self.alert_index != before] = 0
+            live = bucket == self.alert_index[slot]
+            slot, fired = slot[live], fired[live]
+        for k in np.flatnonzero(fired.any(axis=0)):
+            self.alert_counts[:, k] += np.bincount(slot, weights=fired[:, k], minlength=ALERT_BUCKETS).astype(np.int64)
+
+    def _groups(self, age_band=None, gender=None):
+        mask = np.ones((len(AGE_BANDS), len(GENDERS)), dtype=bool)
+        if age_band is not None:
+            if age_band not in AGE_BAND_LABELS:
+                raise ValueError(f"Unknown age band: {age_band}")
+            mask[[i for i, label in enumerate(AGE_BAND_LABELS) if label != age_band]] = False
+        if gender is not None:
+            if gender not in GENDERS:
+                raise ValueError(f"Unknown gender: {gender}")
+            mask[:, [j for j, g in enumerate(GENDERS) if g != gender]] = False
+        return mask.ravel()
+
+    def prevalence(self, age_band=None, gender=None):
+        """Patients with each condition, most common first, optionally within one age band and gender"""
+        groups = self._groups(age_band, gender)
+        with self._lock:
+            total = int(self.group_size[groups].sum())
+            counts = self.condition_counts[groups].sum(axis=0)
+            conditions = list(self.conditions)
+        order = np.argsort(-counts, kind='stable')
+        return {
+            "patients": total,
+            "conditions": [
+                {
+                    "condition": conditions[k],
+                    "patients": int(counts[k]),
+                    "prevalence": round(float(counts[k]) / total, 4) if total else 0.0,
+                }
+                for k in order if counts[k]
+            ],
+        }
+
+    def vitals(self, metric, by=("age_band", "gender")):
+        """Distribution of a metric's latest readings per age band and/or gender"""
+        if metric not in METRICS:
+            raise ValueError(f"Unknown metric: {metric}")
+        unknown = [field for field in by if field not in ("age_band", "gender")]
+        if unknown:
+            raise ValueError(f"Cannot group by: {', '.join(unknown)}")
+        j = METRICS.index(metric)
+        shape = (len(AGE_BANDS), len(GENDERS))
+        with self._lock:
+            stats = [
+                self.vital_count[:, j].reshape(shape),
+                self.vital_total[:, j].reshape(shape),
+                self.vital_squares[:, j].reshape(shape),
+                self.vital_histogram[metric].reshape(shape + (-1,)),
+            ]
+        # Sum out the dimensions not grouped by
+        axes = tuple(axis for axis, field in enumerate(("age_band", "gender")) if field not in by)
+        if axes:
+            stats = [s.sum(axis=axes, keepdims=True) for s in stats]
+        count, total, squares, histogram = stats
+        labels = [AGE_BAND_LABELS if "age_band" in by else (None,), GENDERS if "gender" in by else (None,)]
+        low, width, bins = HISTOGRAMS[metric]
+        groups = []
+        for a, band in enumerate(labels[0]):
+            for g, gender in enumerate(labels[1]):
+                n = count[a, g]
+                if n < 0.5:
+                    continue
+                mean = total[a, g] / n
+                group = {"patients": int(round(n))}
+                if band is not None:
+                    group["age_band"] = band
+                if gender is not None:
+                    group["gender"] = gender
+                group["mean"] = round(float(mean), 2)
+                group["std"] = round(float(np.sqrt(max(squares[a, g] / n - mean * mean, 0.0))), 2)
+                group["histogram"] = np.rint(histogram[a, g]).astype(np.int64)
+                groups.append(group)
+        return {"metric": metric, "bins": {"low": low, "width": width, "count": bins}, "groups": groups}
+
+    def alerts(self, start, end):
+        """Alert counts per bucket over ``[start, end]``, one series per alert that fired"""
+        first = int(np.floor(start / ALERT_BUCKET_SECONDS))
+        last = int(np.floor(end / ALERT_BUCKET_SECONDS))
+        first = max(first, last - ALERT_BUCKETS + 1)
+        buckets = np.arange(first, last + 1) if last >= first else np.zeros(0, dtype=np.int64)
+        slots = buckets % ALERT_BUCKETS
+        with self._lock:
+            counts = np.where((self.alert_index[slots] == buckets)[:, None], self.alert_counts[slots], 0)
+        return {
+            "bucket_seconds": ALERT_BUCKET_SECONDS,
+            "timestamp": (buckets * ALERT_BUCKET_SECONDS).astype(float),
+            "alerts": {ALERTS[k]: np.ascontiguousarray(counts[:, k]) for k in np.flatnonzero(counts.any(axis=0))},
+        }
+
+    def snapshot(self):
+        """Columnar pandas snapshot of every patient, one row each, rebuilt only when stale"""
+        now = time.monotonic()
+        if self._snapshot is not None and (
+            self._snapshot_version == self.version or now - self._snapshot_time < SNAPSHOT_TTL
+        ):
+            return self._snapshot
+        import pandas as pd
+
+        with self._lock:
+            n = len(self.store)
+            rows = np.flatnonzero(self.group[:n] >= 0)
+            ids = self.store.patient_ids
+            groups = self.group[rows]
+            columns = {
+                "patient_id": [ids[row] for row in rows.tolist()],
+                "age": self.age[rows],
+                "age_band": pd.Categorical.from_codes(groups // len(GENDERS), AGE_BAND_LABELS),
+                "gender": pd.Categorical.from_codes(groups % len(GENDERS), GENDERS),
+                "n_conditions": self.has_condition[rows].sum(axis=1),
+                "n_medications": self.n_medications[rows],
+            }
+            latest = self.latest[rows]
+            has_condition = self.has_condition[rows]
+            conditions = list(self.conditions)
+            version = self.version
+        for j, metric in enumerate(METRICS):
+            columns[metric] = latest[:, j]
+        for k, condition in enumerate(conditions):
+            columns[condition] = has_condition[:, k]
+        self._snapshot = pd.DataFrame(columns)
+        self._snapshot_version = version
+        self._snapshot_time = now
+        return self._snapshot
+
+    def group_by(self, by, column, agg):
+        """Aggregate a snapshot column per group; ``by`` holds age_band, gender or condition names"""
+        frame = self.snapshot()
+        unknown = [
+            field for field in by
+            if field not in ("age_band", "gender") and (field not in frame.columns or frame[field].dtype != bool)
+        ]
+        if unknown:
+            raise ValueError(f"Cannot group by: {', '.join(unknown)}")
+        if column not in NUMERIC_COLUMNS + METRICS:
+            raise ValueError(f"Unknown column: {column}")
+        if agg not in AGGREGATES:
+            raise ValueError(f"Unknown aggregate: {agg}")
+        grouped = frame.groupby(list(by), observed=True)[column] if by else frame[column]
+        if agg.startswith("p"):
+            result = grouped.quantile(int(agg[1:]) / 100)
+        else:
+            result = grouped.agg(agg)
+        sizes = frame.groupby(list(by), observed=True).size() if by else len(frame)
+        if not by:
+            return [{"patients": int(sizes), "value": _number(result)}]
+        return [
+            dict(zip(by, key if isinstance(key, tuple) else (key,)), patients=int(sizes[key]), value=_number(value))
+            for key, value in result.items()
+        ]
+
+
+def _number(value):
+    value = float(value)
+    return None if np.isnan(value) else round(value, 4)
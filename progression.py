@@ -0,0 +1,156 @@
+"""Disease progression models
+
+One classifier per condition predicts the six-month trajectory
+(improving, stable or worsening) from features of a patient's record,
+recent vitals and lab results. Models are trained offline from
+``data/progression_train.csv``::
+
+    python progression.py data/progression_train.csv models/progression.joblib
+
+and saved with joblib. Serving processes load them lazily, once, on first
+use (training them on the spot if no saved models exist) and score whole
+cohorts with one ``predict_proba`` call per condition.
+"""
+import os
+import sys
+import threading
+
+import numpy as np
+
+LABS = ("glucose", "hba1c", "cholesterol", "ldl", "hdl", "triglycerides")
+
+FEATURES = (
+    "age", "male", "n_conditions", "n_medications",
+    "heart_rate_mean", "systolic_mean", "diastolic_mean", "temperature_mean", "oxygen_saturation_mean",
+    "heart_rate_slope", "systolic_slope", "diastolic_slope", "oxygen_saturation_slope",
+) + LABS
+
+_VITAL_MEANS = ("heart_rate", "systolic", "diastolic", "temperature", "oxygen_saturation")
+_VITAL_SLOPES = ("heart_rate", "systolic", "diastolic", "oxygen_saturation")
+
+# Most recent samples the vitals features are computed over
+WINDOW = 32
+
+# Model used for conditions without one of their own
+GENERAL = "*"
+
+_ROOT = os.path.dirname(os.path.abspath(__file__))
+DATASET_PATH = os.environ.get('MEDNEXUS_PROGRESSION_DATA', os.path.join(_ROOT, 'data', 'progression_train.csv'))
+MODEL_PATH = os.environ.get('MEDNEXUS_PROGRESSION_MODEL', os.path.join(_ROOT, 'models', 'progression.joblib'))
+
+
+def features(records):
+    """Build the ``(n, FEATURES)`` matrix for ``(patient, vitals)`` records
+
+    Missing labs and vitals are NaN; the models impute them with the
+    training medians.
+    """
+    records = list(records)
+    matrix = np.full((len(records), len(FEATURES)), np.nan)
+    column = {name: j for j, name in enumerate(FEATURES)}
+    steps = np.arange(WINDOW, dtype=np.float64)
+    for i, (patient, vitals) in enumerate(records):
+        row = matrix[i]
+        row[column["age"]] = patient.get("age", np.nan)
+        row[column["male"]] = patient.get("gender") == "Male"
+        row[column["n_conditions"]] = len(patient.get("conditions", ()))
+        row[column["n_medications"]] = len(patient.get("medications", ()))
+        for metric in _VITAL_MEANS:
+            recent = np.asarray(vitals.get(metric, ())[-WINDOW:], dtype=np.float64)
+            if len(recent):
+                row[column[f"{metric}_mean"]] = recent.mean()
+            if metric in _VITAL_SLOPES and len(recent) >= 2:
+                # Least-squares slope per sample
+                x = steps[:len(recent)] - steps[:len(recent)].mean()
+                row[column[f"{metric}_slope"]] = (x * (recent - recent.mean())).sum() / (x * x).sum()
+        labs = patient.get("lab_results", {})
+        for lab in LABS:
+            if labs.get(lab):
+                row[column[lab]] = labs[lab][-1]
+    return matrix
+
+
+def train(dataset_path=DATASET_PATH):
+    """Fit one classifier per condition (plus a general one) from a training CSV"""
+    import pandas as pd
+    from sklearn.impute import SimpleImputer
+    from sklearn.linear_model import LogisticRegression
+    from sklearn.pipeline import make_pipeline
+    from sklearn.preprocessing import StandardScaler
+
+    frame = pd.read_csv(dataset_path)
+    models = {}
+    for condition, group in list(frame.groupby("condition")) + [(GENERAL, frame)]:
+        model = make_pipeline(SimpleImputer(strategy="median"), StandardScaler(), LogisticRegression(C=0.5, max_iter=1000))
+        model.fit(group[list(FEATURES)].to_numpy(dtype=np.float64), group["trajectory"].to_numpy())
+        models[condition] = model
+    return ProgressionModel(models)
+
+
+class ProgressionModel:
+    """Per-condition trajectory classifiers"""
+
+    def __init__(self, models):
+        self.models = models
+
+    def save(self, path=MODEL_PATH):
+        import joblib
+
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        # Written under a per-process temporary name and renamed into place,
+        # so a worker loading the models never reads a partial file
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        joblib.dump({"features": FEATURES, "models": self.models}, tmp_path)
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path=MODEL_PATH):
+        import joblib
+
+        saved = joblib.load(path)
+        if tuple(saved["features"]) != FEATURES:
+            raise ValueError(f"{path} was trained on different features; retrain it")
+        return cls(saved["models"])
+
+    def predict(self, conditions, matrix):
+        """Score ``(row, condition)`` pairs against a feature matrix in one pass per condition
+
+        Returns ``{trajectory: probability}`` dicts in the order of ``conditions``.
+        """
+        results = [None] * len(conditions)
+        by_model = {}
+        for k, (row, condition) in enumerate(conditions):
+            name = condition if condition in self.models else GENERAL
+            by_model.setdefault(name, []).append((k, row))
+        for name, items in by_model.items():
+            model = self.models[name]
+            probabilities = model.predict_proba(matrix[[row for _, row in items]])
+            for (k, _), p in zip(items, probabilities):
+                results[k] = {str(c): float(v) for c, v in zip(model.classes_, p)}
+        return results
+
+
+_model = None
+_lock = threading.Lock()
+
+
+def get_model():
+    """Load the saved models once per process, training and saving them if missing"""
+    global _model
+    if _model is None:
+        with _lock:
+            if _model is None:
+                if os.path.exists(MODEL_PATH):
+                    _model = ProgressionModel.load(MODEL_PATH)
+                else:
+                    model = train()
+                    model.save(MODEL_PATH)
+                    _model = model
+    return _model
+
+
+if __name__ == '__main__':
+    dataset = sys.argv[1] if len(sys.argv) > 1 else DATASET_PATH
+    output = sys.argv[2] if len(sys.argv) > 2 else MODEL_PATH
+    train(dataset).save(output)
+    print(f"Saved progression models to {output}")
@@ -0,0 +1,529 @@
+"""Patient repository with pluggable storage backends
+
+``open_repository('memory')`` keeps documents in process dictionaries,
+exactly like the original module-level dicts. ``open_repository('sqlite:///path.db')``
+stores them in an embedded SQLite database in WAL mode so several worker
+processes can share one dataset: reads go through per-thread pooled
+connections, writes are group-committed in batches by a single writer
+thread, and a change feed lets each process pick up the others' writes.
+"""
+import collections
+import json
+import os
+import queue
+import sqlite3
+import threading
+import time
+from collections.abc import MutableMapping
+
+import numpy as np
+
+from vitals_store import METRICS
+
+VITALS_COLUMNS = ("timestamp",) + METRICS
+
+# Vitals rows fetched from SQLite at a time while streaming them
+VITALS_FETCH_ROWS = 65536
+# Seconds between a process's reports of the changes it has seen, and
+# after which a process that stopped reporting no longer holds changes back
+READER_HEARTBEAT = 30.0
+READER_TIMEOUT = 300.0
+
+
+class RepositoryError(Exception):
+    """Raised to a writer whose write could not be committed"""
+
+
+class Table(MutableMapping):
+    """Dict-like view of one document table"""
+
+    def __init__(self, backend, name):
+        self._backend = backend
+        self.name = name
+
+    def __getitem__(self, key):
+        value = self._backend.get(self.name, key)
+        if value is None:
+            raise KeyError(key)
+        return value
+
+    def __setitem__(self, key, value):
+        self._backend.put(self.name, key, value)
+
+    def __delitem__(self, key):
+        if key not in self:
+            raise KeyError(key)
+        self._backend.delete(self.name, key)
+
+    def __contains__(self, key):
+        return self._backend.contains(self.name, key)
+
+    def __iter__(self):
+        return iter(self._backend.keys(self.name))
+
+    def __len__(self):
+        return self._backend.count(self.name)
+
+
+class Repository:
+    """Documents (patients, knowledge, images) and persisted vitals samples"""
+
+    def __init__(self, backend):
+        self.backend = backend
+        self._tables = {}
+
+    def table(self, name):
+        if name not in self._tables:
+            self._tables[name] = Table(self.backend, name)
+        return self._tables[name]
+
+    def count(self, table):
+        return self.backend.count(table)
+
+    def get(self, table, key):
+        return self.backend.get(table, key)
+
+    def put(self, table, key, value, wait=True):
+        """Store a document; with ``wait=False`` a failed commit is raised by ``flush`` instead"""
+        self.backend.put(table, key, value, wait)
+
+    def project(self, table, fields):
+        """Yield ``(key, {field: value})`` for dotted ``fields`` without loading whole documents"""
+        return self.backend.project(table, tuple(fields))
+
+    def append_vitals(self, patient_id, samples, wait=True):
+        """Persist vitals samples given as per-column arrays (see ``VITALS_COLUMNS``)"""
+        if len(samples["timestamp"]):
+            self.backend.append_vitals(patient_id, samples, wait)
+
+    def vitals(self, patient_id=None):
+        """Yield ``(patient_id, samples)`` with per-column arrays ordered by time"""
+        return self.backend.vitals(patient_id)
+
+    def poll_changes(self):
+        """Return ``(table, key)`` pairs written by other processes since the last poll"""
+        return self.backend.poll_changes()
+
+    def flush(self):
+        """Block until every write is committed; raises ``RepositoryError`` for those that were not"""
+        self.backend.flush()
+
+    def close(self):
+        self.backend.close()
+
+
+class MemoryBackend:
+    """Process-local storage that keeps documents as live objects"""
+
+    def __init__(self):
+        self._tables = collections.defaultdict(dict)
+        self._vitals = {}
+
+    def get(self, table, key):
+        return self._tables[table].get(key)
+
+    def put(self, table, key, value, wait=True):
+        self._tables[table][key] = value
+
+    def delete(self, table, key):
+        self._tables[table].pop(key, None)
+
+    def contains(self, table, key):
+        return key in self._tables[table]
+
+    def keys(self, table):
+        return list(self._tables[table])
+
+    def count(self, table):
+        return len(self._tables[table])
+
+    def project(self, table, fields):
+        for key, doc in list(self._tables[table].items()):
+            yield key, {field: _lookup(doc, field) for field in fields}
+
+    def append_vitals(self, patient_id, samples, wait=True):
+        chunk = {c: np.asarray(samples[c], dtype=np.float64) for c in VITALS_COLUMNS}
+        previous = self._vitals.get(patient_id)
+        if previous is not None:
+            chunk = {c: np.concatenate([previous[c], chunk[c]]) for c in VITALS_COLUMNS}
+        self._vitals[patient_id] = chunk
+
+    def vitals(self, patient_id=None):
+        ids = list(self._vitals) if patient_id is None else [patient_id]
+        for pid in ids:
+            if pid in self._vitals:
+                yield pid, self._vitals[pid]
+
+    def poll_changes(self):
+        return []
+
+    def flush(self):
+        pass
+
+    def close(self):
+        pass
+
+
+def _lookup(doc, field):
+    for part in field.split('.'):
+        if not isinstance(doc, dict):
+            return None
+        doc = doc.get(part)
+    return doc
+
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS documents (
+    tbl TEXT NOT NULL,
+    key TEXT NOT NULL,
+    doc TEXT NOT NULL,
+    PRIMARY KEY (tbl, key)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS vitals (
+    patient_id TEXT NOT NULL,
+    timestamp REAL NOT NULL,
+    heart_rate REAL,
+    systolic REAL,
+    diastolic REAL,
+    temperature REAL,
+    oxygen_saturation REAL
+);
+CREATE INDEX IF NOT EXISTS vitals_by_patient ON vitals (patient_id, timestamp);
+CREATE TABLE IF NOT EXISTS changes (
+    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+    tbl TEXT NOT NULL,
+    key TEXT NOT NULL,
+    origin TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS readers (
+    origin TEXT PRIMARY KEY,
+    seq INTEGER NOT NULL,
+    seen REAL NOT NULL
+) WITHOUT ROWID;
+"""
+
+
+class _Write:
+    """A queued write, done once it is committed or has failed"""
+
+    __slots__ = ("wait", "done", "error")
+
+    def __init__(self, wait):
+        self.wait = wait
+        self.done = threading.Event()
+        self.error = None
+
+
+class SQLiteBackend:
+    """Embedded on-disk storage in SQLite WAL mode
+
+    Writes are visible to the writing process immediately through a pending
+    overlay and reach the database in batched transactions. A writer waits
+    for the transaction holding its write and gets a ``RepositoryError`` if
+    it failed; bulk loaders may skip the wait and check with ``flush``.
+    Decoded documents are kept in a small LRU.
+
+    Every process registers as a reader of the change feed, and its writer
+    thread reports the changes it has seen every ``READER_HEARTBEAT``
+    seconds. Changes every live reader has seen are deleted.
+    """
+
+    def __init__(self, path, batch_size=1024, cache_size=4096):
+        self.path = path
+        self.batch_size = batch_size
+        self.cache_size = cache_size
+        self._origin = os.urandom(8).hex()
+        self._local = threading.local()
+        self._pending = {}
+        self._pending_lock = threading.Lock()
+        self._cache = collections.OrderedDict()
+        self._cache_lock = threading.Lock()
+        self._queue = queue.Queue()
+        # Failures of writes nobody waited for, raised by the next flush
+        self._errors = []
+
+        conn = self._connect()
+        conn.executescript(_SCHEMA)
+        # Changes are pruned, so the highest sequence ever issued is kept by AUTOINCREMENT
+        self._last_seq = conn.execute(
+            "SELECT COALESCE((SELECT seq FROM sqlite_sequence WHERE name = 'changes'), 0)"
+        ).fetchone()[0]
+        self._write_conn = conn
+        self._heartbeat = 0.0
+        self._report_seen(conn)
+        self._writer = threading.Thread(target=self._write_loop, name='repository-writer', daemon=True)
+        self._writer.start()
+        # SQLite connections must not cross fork(); forked analysis workers
+        # only read, so they simply open their own
+        os.register_at_fork(after_in_child=self._after_fork)
+
+    def _after_fork(self):
+        self._local = threading.local()
+
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=30, check_same_thread=False, isolation_level=None)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        return conn
+
+    def _reader(self):
+        # One read connection per thread, reused across requests
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = self._local.conn = self._connect()
+        return conn
+
+    def _cache_get(self, key):
+        with self._cache_lock:
+            value = self._cache.get(key)
+            if value is not None:
+                self._cache.move_to_end(key)
+            return value
+
+    def _cache_put(self, key, value):
+        with self._cache_lock:
+            self._cache[key] = value
+            self._cache.move_to_end(key)
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+
+    def _cache_drop(self, key):
+        with self._cache_lock:
+            self._cache.pop(key, None)
+
+    def get(self, table, key):
+        with self._pending_lock:
+            if (table, key) in self._pending:
+                text = self._pending[(table, key)]
+                return None if text is None else json.loads(text)
+        value = self._cache_get((table, key))
+        if value is not None:
+            return value
+        row = self._reader().execute("SELECT doc FROM documents WHERE tbl = ? AND key = ?", (table, key)).fetchone()
+        if row is None:
+            return None
+        value = json.loads(row[0])
+        self._cache_put((table, key), value)
+        return value
+
+    def _enqueue(self, op, table, key, payload, wait):
+        write = _Write(wait)
+        self._queue.put((op, table, key, payload, write))
+        if wait:
+            write.done.wait()
+            if write.error is not None:
+                raise RepositoryError(f"Write to {table} failed: {write.error}") from write.error
+
+    def put(self, table, key, value, wait=True):
+        text = json.dumps(value)
+        with self._pending_lock:
+            self._pending[(table, key)] = text
+        self._cache_put((table, key), value)
+        self._enqueue('put', table, key, text, wait)
+
+    def delete(self, table, key):
+        with self._pending_lock:
+            self._pending[(table, key)] = None
+        self._cache_drop((table, key))
+        self._enqueue('delete', table, key, None, True)
+
+    def contains(self, table, key):
+        with self._pending_lock:
+            if (table, key) in self._pending:
+                return self._pending[(table, key)] is not None
+        if self._cache_get((table, key)) is not None:
+            return True
+        row = self._reader().execute("SELECT 1 FROM documents WHERE tbl = ? AND key = ?", (table, key)).fetchone()
+        return row is not None
+
+    def keys(self, table):
+        self._drain()
+        return [row[0] for row in self._reader().execute("SELECT key FROM documents WHERE tbl = ?", (table,))]
+
+    def count(self, table):
+        self._drain()
+        return self._reader().execute("SELECT COUNT(*) FROM documents WHERE tbl = ?", (table,)).fetchone()[0]
+
+    def project(self, table, fields):
+        self._drain()
+        # JSON1 extracts fields inside SQLite; text values are re-quoted so
+        # every column decodes uniformly
+        columns = ", ".join(
+            "CASE json_type(doc, ?) WHEN 'text' THEN json_quote(json_extract(doc, ?)) ELSE json_extract(doc, ?) END"
+            for _ in fields
+        )
+        params = [p for field in fields for p in ("$." + field,) * 3]
+        cursor = self._reader().execute(f"SELECT key, {columns} FROM documents WHERE tbl = ?", params + [table])
+        for row in cursor:
+            yield row[0], {
+                field: json.loads(value) if isinstance(value, str) else value
+                for field, value in zip(fields, row[1:])
+            }
+
+    def append_vitals(self, patient_id, samples, wait=True):
+        rows = list(zip(
+            [patient_id] * len(samples["timestamp"]),
+            *(np.asarray(samples[c], dtype=np.float64).tolist() for c in VITALS_COLUMNS)
+        ))
+        self._enqueue('vitals', 'vitals', patient_id, rows, wait)
+
+    def vitals(self, patient_id=None):
+        """Stream the rows in chunks, holding at most one chunk and one patient's samples"""
+        self._drain()
+        sql = f"SELECT patient_id, {', '.join(VITALS_COLUMNS)} FROM vitals"
+        params = ()
+        if patient_id is not None:
+            sql += " WHERE patient_id = ?"
+            params = (patient_id,)
+        cursor = self._reader().execute(sql + " ORDER BY patient_id, timestamp", params)
+        # Samples of the patient whose rows may continue in the next chunk
+        current, parts = None, []
+        while True:
+            rows = cursor.fetchmany(VITALS_FETCH_ROWS)
+            if not rows:
+                break
+            ids = np.array([row[0] for row in rows], dtype=object)
+            values = np.array([row[1:] for row in rows], dtype=np.float64)
+            starts = np.flatnonzero(np.r_[True, ids[1:] != ids[:-1]])
+            ends = np.r_[starts[1:], len(rows)]
+            for start, end in zip(starts, ends):
+                if ids[start] != current:
+                    if parts:
+                        yield current, _columns(parts)
+                    current, parts = ids[start], []
+                parts.append(values[start:end])
+        if parts:
+            yield current, _columns(parts)
+
+    def poll_changes(self):
+        rows = self._reader().execute(
+            "SELECT seq, tbl, key, origin FROM changes WHERE seq > ? ORDER BY seq", (self._last_seq,)
+        ).fetchall()
+        if not rows:
+            return []
+        # Our own changes count as seen too, so they can be pruned
+        self._last_seq = max(self._last_seq, rows[-1][0])
+        changed = list(dict.fromkeys((tbl, key) for _, tbl, key, origin in rows if origin != self._origin))
+        for change in changed:
+            self._cache_drop(change)
+        return changed
+
+    def _drain(self):
+        # Our own queued writes become visible to SQL reads
+        self._queue.join()
+
+    def flush(self):
+        """Block until every queued write is done; raises ``RepositoryError`` for failed unwaited writes"""
+        self._drain()
+        with self._pending_lock:
+            errors, self._errors = self._errors, []
+        if errors:
+            raise RepositoryError(f"{len(errors)} write(s) failed, first: {errors[0]}")
+
+    def close(self):
+        self.flush()
+
+    def _write_loop(self):
+        while True:
+            try:
+                batch = [self._queue.get(timeout=READER_HEARTBEAT)]
+            except queue.Empty:
+                batch = []
+            while batch and len(batch) < self.batch_size:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            if batch:
+                try:
+                    self._commit_each(batch)
+                finally:
+                    for *_, write in batch:
+                        write.done.set()
+                        self._queue.task_done()
+            if time.monotonic() - self._heartbeat >= READER_HEARTBEAT:
+                try:
+                    self._report_seen(self._write_conn)
+                except Exception as exc:
+                    print(f"Repository heartbeat failed: {exc}")
+
+    def _commit_each(self, batch):
+        try:
+            self._commit(batch)
+        except Exception:
+            # Retry the writes one at a time, so only the ones that fail are reported
+            for item in batch:
+                try:
+                    self._commit([item])
+                except Exception as exc:
+                    self._failed(item, exc)
+
+    def _failed(self, item, exc):
+        op, table, key, payload, write = item
+        with self._pending_lock:
+            # The database still holds the previous value; reads must see it again
+            if op != 'vitals' and self._pending.get((table, key), False) == payload:
+                del self._pending[(table, key)]
+            if not write.wait:
+                self._errors.append(f"{table}/{key}: {exc}")
+        self._cache_drop((table, key))
+        write.error = exc
+        if not write.wait:
+            print(f"Repository write failed: {table}/{key}: {exc}")
+
+    def _report_seen(self, conn):
+        """Record the changes this process has seen, then delete those every live reader has seen"""
+        now = time.time()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            conn.execute(
+                "INSERT INTO readers (origin, seq, seen) VALUES (?, ?, ?) "
+                "ON CONFLICT (origin) DO UPDATE SET seq = excluded.seq, seen = excluded.seen",
+                (self._origin, self._last_seq, now)
+            )
+            conn.execute("DELETE FROM readers WHERE seen < ?", (now - READER_TIMEOUT,))
+            conn.execute("DELETE FROM changes WHERE seq <= (SELECT MIN(seq) FROM readers)")
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        self._heartbeat = time.monotonic()
+
+    def _commit(self, batch):
+        conn = self._write_conn
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            for op, table, key, payload, _ in batch:
+                if op == 'put':
+                    conn.execute(
+                        "INSERT INTO documents (tbl, key, doc) VALUES (?, ?, ?) "
+                        "ON CONFLICT (tbl, key) DO UPDATE SET doc = excluded.doc",
+                        (table, key, payload)
+                    )
+                elif op == 'delete':
+                    conn.execute("DELETE FROM documents WHERE tbl = ? AND key = ?", (table, key))
+                else:
+                    conn.executemany(f"INSERT INTO vitals VALUES ({', '.join('?' * 7)})", payload)
+                conn.execute("INSERT INTO changes (tbl, key, origin) VALUES (?, ?, ?)", (table, key, self._origin))
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        with self._pending_lock:
+            for op, table, key, payload, _ in batch:
+                if op != 'vitals' and self._pending.get((table, key), False) == payload:
+                    del self._pending[(table, key)]
+
+
+def _columns(parts):
+    values = np.concatenate(parts) if len(parts) > 1 else parts[0]
+    return {c: values[:, i] for i, c in enumerate(VITALS_COLUMNS)}
+
+
+def open_repository(url):
+    """Open ``memory`` or ``sqlite:///path/to/file.db`` storage"""
+    if url == 'memory':
+        return Repository(MemoryBackend())
+    if url.startswith('sqlite:///'):
+        return Repository(SQLiteBackend(url[len('sqlite:///'):]))
+    raise ValueError(f"Unsupported storage URL: {url}")
@@ -0,0 +1,137 @@
+"""Pre-serialized JSON response cache with strong ETags"""
+import collections
+import hashlib
+import os
+import threading
+
+from serialization import compress
+
+DEFAULT_MAX_BYTES = int(os.environ.get('MEDNEXUS_RESPONSE_CACHE_BYTES', 64 * 1024 * 1024))
+
+# Distinguishes ETags issued by this process from those of a previous run,
+# whose version counters started from the same values
+_EPOCH = os.urandom(8).hex()
+
+
+class RecordVersions:
+    """Monotonic version counters for mutable records such as ``('patient', 'P001')``"""
+
+    def __init__(self):
+        self._versions = {}
+        self._lock = threading.Lock()
+
+    def get(self, record):
+        return self._versions.get(record, 0)
+
+    def bump(self, record):
+        with self._lock:
+            version = self._versions.get(record, 0) + 1
+            self._versions[record] = version
+            return version
+
+
+class CacheEntry:
+    __slots__ = ("key", "body", "etag", "versions", "records", "encoded")
+
+    def __init__(self, key, body, etag, versions, records):
+        self.key = key
+        self.body = body
+        self.etag = etag
+        self.versions = versions
+        self.records = records
+        # Compressed bodies by content coding
+        self.encoded = {}
+
+    @property
+    def size(self):
+        return len(self.body) + sum(len(body) for body in self.encoded.values())
+
+
+def make_etag(key, versions):
+    digest = hashlib.blake2b(repr((_EPOCH, key, versions)).encode(), digest_size=12)
+    return digest.hexdigest()
+
+
+class ResponseCache:
+    """LRU cache of serialized response bodies bounded by total size
+
+    Entries are keyed by ``(endpoint, args)`` and remember the versions of the
+    records they were built from. A lookup with different versions is a
+    miss, and ``invalidate(record)`` drops every entry built from a record as
+    soon as it is mutated. Compressed bodies are kept with their entry and
+    count towards its size.
+    """
+
+    def __init__(self, max_bytes=DEFAULT_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self._entries = collections.OrderedDict()
+        self._keys_by_record = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key, versions):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry.versions == versions:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry
+            if entry is not None:
+                self._drop(key)
+            self.misses += 1
+            return None
+
+    def put(self, key, body, versions, records):
+        entry = CacheEntry(key, body, make_etag(key, versions), versions, tuple(records))
+        if len(body) > self.max_bytes:
+            return entry
+        with self._lock:
+            if key in self._entries:
+                self._drop(key)
+            self._entries[key] = entry
+            self.size += len(body)
+            for record in entry.records:
+                self._keys_by_record.setdefault(record, set()).add(key)
+            while self.size > self.max_bytes:
+                self._drop(next(iter(self._entries)))
+        return entry
+
+    def compressed(self, entry, coding):
+        """``entry``'s body in a content coding, compressed on first use"""
+        body = entry.encoded.get(coding)
+        if body is None:
+            body = compress(entry.body, coding)
+            with self._lock:
+                if coding not in entry.encoded:
+                    entry.encoded[coding] = body
+                    if self._entries.get(entry.key) is entry:
+                        self.size += len(body)
+                        while self.size > self.max_bytes:
+                            self._drop(next(iter(self._entries)))
+        return body
+
+    def invalidate(self, record):
+        with self._lock:
+            for key in list(self._keys_by_record.get(record, ())):
+                self._drop(key)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._keys_by_record.clear()
+            self.size = 0
+
+    def _drop(self, key):
+        entry = self._entries.pop(key)
+        self.size -= entry.size
+        for record in entry.records:
+            keys = self._keys_by_record.get(record)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self._keys_by_record[record]
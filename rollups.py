@@ -0,0 +1,253 @@
+"""Multi-resolution vitals rollups and LTTB downsampling
+
+Each tier keeps, per patient row, a ring of fixed-width time buckets holding
+the min, max, sum and count of every metric. Bucket storage is allocated in
+small blocks as samples reach them, so memory follows the data held rather
+than the number of patients times the buckets retained. Samples are folded in as they
+are appended to the ``VitalsStore``, so serving a time range at a tier's
+resolution only slices a bounded ring, however long the history is.
+"""
+import os
+import threading
+
+import numpy as np
+
+from vitals_store import METRICS
+
+# Tiers as "bucket seconds:buckets kept", e.g. 1-minute buckets for 6 hours
+DEFAULT_TIERS = os.environ.get('MEDNEXUS_ROLLUP_TIERS', '60:360,3600:336,86400:365')
+
+# Consecutive buckets allocated together
+BLOCK = 2
+
+
+def parse_tiers(spec):
+    tiers = []
+    for part in spec.split(','):
+        width, buckets = part.split(':')
+        tiers.append((int(width), int(buckets)))
+    return sorted(tiers)
+
+
+def tier_name(width):
+    for unit, seconds in (("d", 86400), ("h", 3600), ("m", 60)):
+        if width % seconds == 0:
+            return f"{width // seconds}{unit}"
+    return f"{width}s"
+
+
+class RollupTier:
+    """Ring of at least ``buckets`` time buckets of ``width`` seconds per row
+
+    Each row's ring is split into blocks of ``BLOCK`` consecutive buckets,
+    and a block's storage is allocated the first time a sample falls in it.
+    Rows without samples, and the stretches of a ring no sample reached,
+    take no bucket storage.
+    """
+
+    def __init__(self, width, buckets, initial_rows=64, initial_blocks=256):
+        self.width = width
+        self.buckets = buckets
+        self.name = tier_name(width)
+        # Enough blocks that the newest ``buckets`` buckets are always retained
+        self.ring = -(-(buckets - 1) // BLOCK) + 1
+        # Block of each row's ring slots, -1 until allocated
+        self.table = np.full((initial_rows, self.ring), -1, dtype=np.int32)
+        # Newest bucket of each row, -1 while empty
+        self.latest = np.full(initial_rows, -1, dtype=np.int64)
+        # Block number held by each block, then its buckets' aggregates
+        self.index = np.full(initial_blocks, -1, dtype=np.int64)
+        self.minimum = np.zeros((initial_blocks, BLOCK, len(METRICS)), dtype=np.float32)
+        self.maximum = np.zeros((initial_blocks, BLOCK, len(METRICS)), dtype=np.float32)
+        self.total = np.zeros((initial_blocks, BLOCK, len(METRICS)), dtype=np.float64)
+        self.count = np.zeros((initial_blocks, BLOCK), dtype=np.int32)
+        self.blocks = 0
+
+    def _grow_rows(self, n_rows):
+        table = np.full((n_rows, self.ring), -1, dtype=np.int32)
+        table[:len(self.table)] = self.table
+        latest = np.full(n_rows, -1, dtype=np.int64)
+        latest[:len(self.latest)] = self.latest
+        self.table, self.latest = table, latest
+
+    def _allocate(self, n):
+        """Ids of ``n`` new blocks"""
+        if self.blocks + n > len(self.index):
+            size = max(2 * len(self.index), self.blocks + n)
+
+            def grown(arr):
+                out = np.zeros((size,) + arr.shape[1:], dtype=arr.dtype)
+                out[:len(arr)] = arr
+                return out
+
+            self.index = grown(self.index)
+            self.minimum = grown(self.minimum)
+            self.maximum = grown(self.maximum)
+            self.total = grown(self.total)
+            self.count = grown(self.count)
+        ids = np.arange(self.blocks, self.blocks + n, dtype=np.int32)
+        self.blocks += n
+        return ids
+
+    def _held(self, rows, slots):
+        """Block id and block number held by each ring slot; -1 for both when unallocated"""
+        ids = self.table[rows, slots]
+        return ids, np.where(ids >= 0, self.index[ids], -1)
+
+    def update(self, rows, timestamps, values):
+        """Fold samples (``values`` shaped ``(n, metrics)``) into their buckets"""
+        if len(rows) and rows.max() >= len(self.table):
+            self._grow_rows(max(2 * len(self.table), int(rows.max()) + 1))
+        bucket = np.floor(timestamps / self.width).astype(np.int64)
+        block = bucket // BLOCK
+        slot = block % self.ring
+        _, held = self._held(rows, slot)
+        # Samples older than the block their slot now holds have aged out
+        live = block >= held
+        rows, bucket, block, slot, values = rows[live], bucket[live], block[live], slot[live], values[live]
+
+        _, held = self._held(rows, slot)
+        fresh = block > held
+        if fresh.any():
+            # The newest block wins a slot when several map onto it
+            r, s, b = rows[fresh], slot[fresh], block[fresh]
+            order = np.lexsort((b, s, r))
+            r, s, b = r[order], s[order], b[order]
+            last = np.r_[(r[1:] != r[:-1]) | (s[1:] != s[:-1]), True]
+            r, s, b = r[last], s[last], b[last]
+            ids = self.table[r, s]
+            unallocated = ids < 0
+            ids[unallocated] = self._allocate(int(unallocated.sum()))
+            self.table[r, s] = ids
+            self.index[ids] = b
+            self.minimum[ids] = np.inf
+            self.maximum[ids] = -np.inf
+            self.total[ids] = 0
+            self.count[ids] = 0
+            _, held = self._held(rows, slot)
+            live = block == held
+            rows, bucket, slot, values = rows[live], bucket[live], slot[live], values[live]
+
+        if not len(rows):
+            return
+        # Reduce the samples of each bucket, then fold them into it at once
+        at = self.table[rows, slot].astype(np.int64) * BLOCK + bucket % BLOCK
+        order = np.argsort(at, kind='stable')
+        at, values = at[order], values[order]
+        starts = np.flatnonzero(np.r_[True, at[1:] != at[:-1]])
+        at = at[starts]
+        minimum = self.minimum.reshape(-1, len(METRICS))
+        maximum = self.maximum.reshape(-1, len(METRICS))
+        total = self.total.reshape(-1, len(METRICS))
+        minimum[at] = np.minimum(minimum[at], np.minimum.reduceat(values, starts))
+        maximum[at] = np.maximum(maximum[at], np.maximum.reduceat(values, starts))
+        total[at] += np.add.reduceat(values, starts)
+        self.count.reshape(-1)[at] += np.diff(np.r_[starts, len(order)]).astype(np.int32)
+        np.maximum.at(self.latest, rows, bucket)
+
+    def latest_bucket(self, row):
+        if row >= len(self.latest):
+            return -1
+        return int(self.latest[row])
+
+    def query(self, row, start, end):
+        """Return bucket starts and per-metric min/max/mean arrays for ``[start, end]``"""
+        first = int(np.floor(start / self.width))
+        last = int(np.floor(end / self.width))
+        first = max(first, last - self.buckets + 1)
+        if row >= len(self.table) or last < first:
+            empty = np.zeros((0, len(METRICS)))
+            return np.zeros(0), empty, empty, empty
+        buckets = np.arange(first, last + 1)
+        block = buckets // BLOCK
+        ids, held = self._held(np.full(len(buckets), row), block % self.ring)
+        present = held == block
+        buckets, ids, offsets = buckets[present], ids[present], buckets[present] % BLOCK
+        present = self.count[ids, offsets] > 0
+        buckets, ids, offsets = buckets[present], ids[present], offsets[present]
+        count = self.count[ids, offsets][:, None]
+        return (
+            buckets * float(self.width),
+            self.minimum[ids, offsets].astype(np.float64),
+            self.maximum[ids, offsets].astype(np.float64),
+            self.total[ids, offsets] / count,
+        )
+
+
+class VitalsRollups:
+    """Rollup tiers for every patient, fed by ``VitalsStore`` appends"""
+
+    def __init__(self, store, tiers=DEFAULT_TIERS):
+        self.store = store
+        self.tiers = [RollupTier(width, buckets) for width, buckets in parse_tiers(tiers)]
+        self._lock = threading.Lock()
+
+    def attach(self):
+        """Fold in the samples already retained by the store, then follow new appends
+
+        A shared store replays them itself, on its first ``sync``.
+        """
+        store = self.store
+        if not store.shared:
+            store.replay(self.update)
+        store.add_listener(self.update)
+
+    def update(self, rows, timestamps, values):
+        matrix = np.column_stack([np.asarray(values[m], dtype=np.float64) for m in METRICS])
+        rows = np.asarray(rows, dtype=np.int64)
+        timestamps = np.asarray(timestamps, dtype=np.float64)
+        with self._lock:
+            for tier in self.tiers:
+                tier.update(rows, timestamps, matrix)
+
+    def tier(self, name):
+        for tier in self.tiers:
+            if tier.name == name:
+                return tier
+        raise ValueError(f"Unknown resolution: {name}")
+
+    def choose(self, row, start, end, points):
+        """Pick the finest tier that covers ``[start, end]`` in at most ``points`` buckets"""
+        for tier in self.tiers:
+            first = int(np.floor(start / tier.width))
+            last = int(np.floor(end / tier.width))
+            oldest = tier.latest_bucket(row) - tier.buckets + 1
+            if last - first + 1 <= points and first >= oldest:
+                return tier
+        return self.tiers[-1]
+
+    def query(self, row, tier, start, end, metrics=METRICS):
+        with self._lock:
+            starts, low, high, mean = tier.query(row, start, end)
+        # Arrays, which the response encoder writes directly
+        timestamps = starts
+        return {
+            metric: {
+                "timestamp": timestamps,
+                "min": np.round(low[:, METRICS.index(metric)], 1),
+                "max": np.round(high[:, METRICS.index(metric)], 1),
+                "mean": np.round(mean[:, METRICS.index(metric)], 1),
+            }
+            for metric in metrics
+        }
+
+
+def lttb(x, y, threshold):
+    """Largest-Triangle-Three-Buckets: indices of ``threshold`` points that keep the shape of ``y``"""
+    n = len(x)
+    if threshold >= n or threshold < 3:
+        return np.arange(n)
+    selected = np.zeros(threshold, dtype=np.int64)
+    # Interior buckets split points 1..n-2 evenly
+    edges = np.floor(np.linspace(1, n - 1, threshold - 1)).astype(np.int64)
+    a = 0
+    for i in range(threshold - 2):
+        lo, hi = edges[i], edges[i + 1]
+        nxt_lo, nxt_hi = edges[i + 1], (edges[i + 2] if i + 2 < len(edges) else n)
+        avg_x = x[nxt_lo:nxt_hi].mean()
+        avg_y = y[nxt_lo:nxt_hi].mean()
+        area = np.abs((x[a] - avg_x) * (y[lo:hi] - y[a]) - (x[a] - x[lo:hi]) * (avg_y - y[a]))
+        a = lo + int(np.argmax(area))
+        selected[i + 1] = a
+    selected[-1] = n - 1
+    return selected
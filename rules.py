@@ -0,0 +1,266 @@
+"""Table-driven clinical rules compiled once into lookup tables
+
+Rules are loaded from ``data/clinical_rules.json``: per-condition
+monitoring advice, insights and progression templates, plus threshold
+tables over lab results and recent vitals. Compilation turns them into
+per-condition bundles and NumPy threshold vectors, so evaluating a
+patient, or a whole cohort at once, never walks a chain of branches.
+"""
+import itertools
+import json
+import os
+import threading
+
+import numpy as np
+
+from metrics import timed
+
+RULES_PATH = os.environ.get(
+    'MEDNEXUS_RULES_PATH',
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data', 'clinical_rules.json')
+)
+
+_OPS = {">": np.greater, "<": np.less, ">=": np.greater_equal, "<=": np.less_equal}
+
+# Memoized condition-combination bundles kept before the memo is reset
+MAX_BUNDLES = 65536
+
+# Upper probability bounds of the "low" and "moderate" risk levels
+RISK_LEVELS = ((0.33, "low"), (0.66, "moderate"))
+
+
+def _risk_level(probability):
+    for bound, level in RISK_LEVELS:
+        if probability < bound:
+            return level
+    return "high"
+
+
+def _numeric(sequences, count=-1):
+    """Concatenate sequences into one float64 array, with NaN for anything that is not a finite number"""
+    try:
+        if sequences and isinstance(sequences[0], np.ndarray):
+            # Store snapshots: slices of float arrays
+            array = np.concatenate(sequences).astype(np.float64)
+        else:
+            array = np.fromiter(itertools.chain.from_iterable(sequences), dtype=np.float64, count=count)
+    except (TypeError, ValueError, OverflowError):
+        array = np.array([
+            value if isinstance(value, (int, float, np.number)) and not isinstance(value, bool) and abs(value) < np.inf else np.nan
+            for values in sequences for value in values
+        ], dtype=np.float64)
+    array[~np.isfinite(array)] = np.nan
+    return array
+
+
+def _right_aligned(series, width):
+    """Stack sequences of at most ``width`` numbers into rows, right-aligned and padded with NaN"""
+    lengths = np.fromiter((len(values) for values in series), dtype=np.int64, count=len(series))
+    matrix = np.full((len(series), width), np.nan)
+    if lengths.any():
+        values = _numeric(series, int(lengths.sum()))
+        rows = np.repeat(np.arange(len(series)), lengths)
+        # Column of each value: its position within its sequence, shifted right
+        cols = np.arange(len(values)) - np.repeat(np.cumsum(lengths) - width, lengths)
+        matrix[rows, cols] = values
+    return matrix
+
+
+class Bundle:
+    """Deduplicated recommendations for one combination of conditions"""
+
+    __slots__ = ("risk_factors", "treatments", "monitoring")
+
+    def __init__(self, risk_factors, treatments, monitoring):
+        self.risk_factors = risk_factors
+        self.treatments = treatments
+        self.monitoring = monitoring
+
+
+class Evaluation:
+    """Outcome of the threshold rules for a cohort, one row per record"""
+
+    def __init__(self, engine, vital_flags, lab_flags):
+        self._engine = engine
+        self.vital_flags = vital_flags
+        self.lab_flags = lab_flags
+
+    def insights(self, i):
+        """Insights fired for the i-th record, vitals patterns first, then labs"""
+        engine = self._engine
+        fired = [dict(engine.vital_rules[j]["insight"]) for j in np.flatnonzero(self.vital_flags[i])]
+        fired.extend(dict(engine.lab_rules[j]["insight"]) for j in np.flatnonzero(self.lab_flags[i]))
+        return fired
+
+
+class RuleEngine:
+    """Compiled clinical rules"""
+
+    def __init__(self, rules, knowledge_base, interactions=None):
+        self._monitoring = rules.get("monitoring", {})
+        self._condition_insights = rules.get("condition_insights", {})
+        self._progression = rules.get("progression", {})
+        self._knowledge_base = knowledge_base
+        # Drug interaction table checked against medication lists
+        self.interactions = interactions
+        # Where the rules were loaded from, so other processes can load them too
+        self.path = None
+
+        self.vital_rules = tuple(rules.get("vital_patterns", ()))
+        self.lab_rules = tuple(rules.get("lab_thresholds", ()))
+
+        # Threshold table: one column per lab, one entry per rule
+        self.lab_names = sorted({rule["lab"] for rule in self.lab_rules})
+        self._lab_index = {lab: j for j, lab in enumerate(self.lab_names)}
+        self._lab_cols = np.array([self._lab_index[rule["lab"]] for rule in self.lab_rules], dtype=np.int64)
+        self._lab_thresholds = np.array([rule["value"] for rule in self.lab_rules], dtype=np.float64)
+        # "Any value above" compares the maximum; "any value below" the minimum
+        self._lab_use_max = np.array([rule["op"] in (">", ">=") for rule in self.lab_rules], dtype=bool)
+        self._lab_ops = {
+            op: np.array([j for j, rule in enumerate(self.lab_rules) if rule["op"] == op], dtype=np.int64)
+            for op in {rule["op"] for rule in self.lab_rules}
+        }
+
+        self._bundles = {}
+        self._lock = threading.Lock()
+
+    @classmethod
+    def load(cls, knowledge_base, path=RULES_PATH, interactions=None):
+        with open(path) as f:
+            engine = cls(json.load(f), knowledge_base, interactions)
+        engine.path = path
+        return engine
+
+    def context(self, patients):
+        """The knowledge base entries and interactions that analyzing ``patients`` consults
+
+        Returns them as plain data, ``(knowledge_base, (drugs, interactions))``
+        (see ``InteractionTable.among``), for ``rebind`` in another process.
+        """
+        conditions = {c for patient in patients for c in patient.get('conditions', ())}
+        knowledge = {c: self._knowledge_base[c] for c in conditions if c in self._knowledge_base}
+        if self.interactions is None:
+            return knowledge, None
+        return knowledge, self.interactions.among({m for patient in patients for m in patient.get('medications', ())})
+
+    def rebind(self, knowledge_base, interactions):
+        """Consult another knowledge base and interaction table from now on"""
+        with self._lock:
+            self._knowledge_base = knowledge_base
+            self.interactions = interactions
+            self._bundles.clear()
+
+    def bundle(self, conditions):
+        """Return the memoized recommendations for a list of conditions"""
+        key = tuple(conditions)
+        bundle = self._bundles.get(key)
+        if bundle is None:
+            knowledge = [self._knowledge_base[c] for c in key if c in self._knowledge_base]
+            bundle = Bundle(
+                list(dict.fromkeys(r for entry in knowledge for r in entry["risk_factors"])),
+                list(dict.fromkeys(t for entry in knowledge for t in entry["treatments"])),
+                [m for c, advice in self._monitoring.items() if c in key for m in advice],
+            )
+            with self._lock:
+                if len(self._bundles) >= MAX_BUNDLES:
+                    self._bundles.clear()
+                self._bundles[key] = bundle
+        return bundle
+
+    def invalidate(self):
+        """Drop memoized bundles after the knowledge base changes"""
+        with self._lock:
+            self._bundles.clear()
+
+    @timed
+    def evaluate(self, records):
+        """Evaluate every threshold rule for ``(patient, vitals)`` records in one pass
+
+        Lab results that are not numbers count as missing.
+        """
+        records = list(records)
+        n = len(records)
+
+        vital_flags = np.zeros((n, len(self.vital_rules)), dtype=bool)
+        windows = {}
+        for rule in self.vital_rules:
+            windows[rule["metric"]] = max(windows.get(rule["metric"], 0), rule["window"])
+        # The last `window` readings of each metric, right-aligned; patients
+        # with fewer readings keep NaN, which never fires
+        recent = {
+            metric: _right_aligned([vitals[metric][-window:] for _, vitals in records], window)
+            for metric, window in windows.items()
+        }
+        for j, rule in enumerate(self.vital_rules):
+            window = recent[rule["metric"]][:, -rule["window"]:]
+            with np.errstate(invalid='ignore'):
+                vital_flags[:, j] = _OPS[rule["op"]](window, rule["value"]).all(axis=1)
+
+        lab_flags = np.zeros((n, len(self.lab_rules)), dtype=bool)
+        if self.lab_rules:
+            index = self._lab_index
+            # One entry per (record, known lab) with results
+            entries = [
+                (i, index[lab], values)
+                for i, (patient, _) in enumerate(records)
+                for lab, values in patient.get('lab_results', {}).items()
+                if lab in index and values
+            ]
+            highs = np.full((n, len(self.lab_names)), np.nan)
+            lows = np.full((n, len(self.lab_names)), np.nan)
+            if entries:
+                rows, cols, lengths = (np.array(column, dtype=np.int64) for column in zip(*(
+                    (i, j, len(values)) for i, j, values in entries
+                )))
+                values = _numeric([values for _, _, values in entries], int(lengths.sum()))
+                starts = np.r_[0, np.cumsum(lengths)[:-1]]
+                # fmax/fmin skip the NaN of non-numeric results
+                highs[rows, cols] = np.fmax.reduceat(values, starts)
+                lows[rows, cols] = np.fmin.reduceat(values, starts)
+            observed = np.where(self._lab_use_max, highs[:, self._lab_cols], lows[:, self._lab_cols])
+            with np.errstate(invalid='ignore'):
+                for op, cols in self._lab_ops.items():
+                    lab_flags[:, cols] = _OPS[op](observed[:, cols], self._lab_thresholds[cols])
+
+        return Evaluation(self, vital_flags, lab_flags)
+
+    def condition_insight(self, condition):
+        insight = self._condition_insights.get(condition)
+        return dict(insight) if insight else None
+
+    def progression(self, condition, patient, latest_vitals, rng, probabilities=None):
+        """Fill a condition's progression template for a patient
+
+        ``probabilities`` maps trajectories to the progression model's
+        probabilities, which ``model`` and ``risk_level`` metrics report.
+        """
+        template = self._progression.get(condition)
+        if template is None:
+            return {"risk_factors": [], "key_metrics": {}, "recommendations": []}
+        key_metrics = {}
+        for metric in template["key_metrics"]:
+            if "vital" in metric:
+                if metric["vital"] != "blood_pressure":
+                    value = latest_vitals.get(metric["vital"])
+                elif "systolic" in latest_vitals:
+                    value = f"{int(latest_vitals['systolic'])}/{int(latest_vitals['diastolic'])}"
+                else:
+                    value = None
+            elif "lab" in metric:
+                value = patient.get('lab_results', {}).get(metric["lab"], [metric.get("default")])[-1]
+            elif "model" in metric:
+                value = round(probabilities[metric["model"]], 2) if probabilities else None
+            elif "risk_level" in metric:
+                value = _risk_level(probabilities[metric["risk_level"]]) if probabilities else None
+            elif "uniform" in metric:
+                value = rng.uniform(*metric["uniform"])
+            elif "choice" in metric:
+                value = rng.choice(metric["choice"])
+            else:
+                value = metric["value"]
+            key_metrics[metric["name"]] = value
+        return {
+            "risk_factors": list(template["risk_factors"]),
+            "key_metrics": key_metrics,
+            "recommendations": list(template["recommendations"]),
+        }
@@ -0,0 +1,203 @@
+"""JSON encoding, pre-encoded fragments, field projection and compression
+
+``encode`` turns a response object into JSON bytes. When orjson is
+installed it writes NumPy arrays and scalars straight from their buffers;
+otherwise the standard library encoder is used. Either way, responses can
+carry NumPy values as they are, without converting them to lists first.
+
+A ``Fragment`` is JSON encoded ahead of time. Wherever it sits in a
+response object, its bytes are spliced into the output as they are, so
+records that rarely change are encoded once and copied after that.
+``FragmentCache`` keeps fragments against the version of the record they
+were encoded from.
+
+``project`` keeps only the fields a client asked for. ``negotiate`` picks
+a content coding for a body from the request's Accept-Encoding and the
+body's size.
+"""
+import collections
+import gzip
+import json
+import os
+import secrets
+import threading
+
+import numpy as np
+
+from metrics import timed
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# Bodies smaller than this are sent uncompressed
+MIN_COMPRESS_BYTES = int(os.environ.get('MEDNEXUS_COMPRESS_MIN_BYTES', 1024))
+# Bodies larger than this are compressed at a fast level
+LARGE_BODY_BYTES = 1024 * 1024
+DEFAULT_FRAGMENT_CACHE_BYTES = int(os.environ.get('MEDNEXUS_FRAGMENT_CACHE_BYTES', 64 * 1024 * 1024))
+
+# Content codings the server can produce, in order of preference
+CODINGS = ('br', 'gzip') if brotli is not None else ('gzip',)
+
+# orjson 3.9+ writes pre-encoded JSON itself
+_OrjsonFragment = getattr(orjson, 'Fragment', None)
+
+
+class Fragment:
+    """A value and its JSON encoding, spliced verbatim into encoded responses"""
+
+    __slots__ = ("value", "json")
+
+    def __init__(self, value):
+        self.value = value
+        self.json = encode(value)
+
+
+def _default(obj, fragments=None, marker=None):
+    if isinstance(obj, Fragment):
+        if _OrjsonFragment is not None:
+            return _OrjsonFragment(obj.json)
+        if fragments is None:
+            return obj.value
+        fragments.append(obj.json)
+        return marker
+    if isinstance(obj, np.ndarray):
+        # orjson encodes contiguous arrays of plain dtypes itself
+        if orjson is not None and not obj.flags.c_contiguous and obj.dtype.kind in 'biuf':
+            return np.ascontiguousarray(obj)
+        return obj.tolist()
+    if isinstance(obj, np.generic):
+        return obj.item()
+    if isinstance(obj, (set, frozenset, tuple)):
+        return list(obj)
+    raise TypeError(f"Object of type {type(obj).__name__} is not JSON serializable")
+
+
+def _dumps(obj, default):
+    if orjson is not None:
+        return orjson.dumps(obj, default=default, option=orjson.OPT_SERIALIZE_NUMPY | orjson.OPT_NON_STR_KEYS)
+    return json.dumps(obj, default=default, separators=(',', ':')).encode()
+
+
+@timed
+def encode(obj):
+    """Compact JSON bytes for ``obj``, with NumPy values and fragments"""
+    if _OrjsonFragment is not None:
+        return _dumps(obj, _default)
+    # Each fragment is encoded as a marker string, then the markers are
+    # replaced by the fragments' bytes. The marker is random per call, so
+    # no client text can forge one.
+    fragments = []
+    marker = f"\x00fragment-{secrets.token_hex(16)}\x00"
+    body = _dumps(obj, lambda value: _default(value, fragments, marker))
+    if not fragments:
+        return body
+    encoded_marker = json.dumps(marker).encode()
+    parts = body.split(encoded_marker)
+    if len(parts) != len(fragments) + 1:
+        # Should the marker appear anywhere else, encode the fragments' values instead
+        return _dumps(obj, _default)
+    # Encoders visit values in document order, so the markers line up with
+    # the fragments collected for them
+    out = [parts[0]]
+    for fragment, part in zip(fragments, parts[1:]):
+        out.append(fragment)
+        out.append(part)
+    return b"".join(out)
+
+
+class FragmentCache:
+    """LRU cache of fragments keyed by record, bounded by their encoded size
+
+    A fragment is reused while the version it was encoded at is current.
+    """
+
+    def __init__(self, max_bytes=DEFAULT_FRAGMENT_CACHE_BYTES):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key, version, build):
+        """The fragment for ``key`` at ``version``, encoding ``build()`` on a miss"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] == version:
+                self._entries.move_to_end(key)
+                return entry[1]
+        fragment = Fragment(build())
+        with self._lock:
+            previous = self._entries.pop(key, None)
+            if previous is not None:
+                self.size -= len(previous[1].json)
+            self._entries[key] = (version, fragment)
+            self.size += len(fragment.json)
+            while self.size > self.max_bytes:
+                _, (_, evicted) = self._entries.popitem(last=False)
+                self.size -= len(evicted.json)
+        return fragment
+
+
+def parse_fields(text):
+    """Parse ``vitals.heart_rate,lab_results`` into ``{"vitals": {"heart_rate": True}, "lab_results": True}``"""
+    tree = {}
+    for path in text.split(','):
+        names = path.strip().split('.')
+        if not all(names):
+            raise ValueError(f"Invalid field: {path!r}")
+        node = tree
+        for name in names[:-1]:
+            child = node.get(name)
+            if child is True:
+                break
+            node = node.setdefault(name, {})
+        else:
+            node[names[-1]] = True
+    return tree
+
+
+def project(obj, fields):
+    """Keep only ``fields`` (from ``parse_fields``) of ``obj``
+
+    Lists are projected item by item. Fields an object lacks are left out.
+    """
+    if fields is True:
+        return obj
+    if isinstance(obj, Fragment):
+        obj = obj.value
+    if isinstance(obj, dict):
+        return {name: project(obj[name], sub) for name, sub in fields.items() if name in obj}
+    if isinstance(obj, (list, tuple)):
+        return [project(item, fields) for item in obj]
+    return obj
+
+
+def negotiate(accept_encodings, size):
+    """The content coding to send a body of ``size`` bytes in, or None
+
+    ``accept_encodings`` is the request's parsed Accept-Encoding header.
+    Small bodies are not worth the compression time.
+    """
+    if size < MIN_COMPRESS_BYTES:
+        return None
+    return accept_encodings.best_match(CODINGS)
+
+
+@timed
+def compress(body, coding):
+    """``body`` in a content coding from ``negotiate``; large bodies get a fast level"""
+    large = len(body) > LARGE_BODY_BYTES
+    if coding == 'br':
+        return brotli.compress(body, quality=1 if large else 5)
+    if coding == 'gzip':
+        return gzip.compress(body, compresslevel=1 if large else 6, mtime=0)
+    raise ValueError(f"Unsupported content coding: {coding}")
@@ -0,0 +1,133 @@
+"""Serve MedNexus AI from several sharded worker processes
+
+    MEDNEXUS_STORAGE=sqlite:///instance/mednexus.db python serve.py --workers 4
+
+Every worker accepts connections on the same listening socket and serves
+the whole API. Patients are partitioned across the workers (see
+``sharding``); their vitals live in one shared memory store that every
+worker reads in place, and each patient's vitals are written only by the
+worker that owns it. Workers forward those writes to the owner over a
+loopback port of their own. The repository must be SQLite, which every
+worker opens.
+
+The first worker loads the repository into the shared store, and the
+others start once it has. A worker that exits is started again. Linux
+and other POSIX systems only.
+"""
+import argparse
+import logging
+import os
+import signal
+import socket
+import subprocess
+import sys
+import threading
+import time
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+DEFAULT_STORAGE = f"sqlite:///{os.path.join(ROOT, 'instance', 'mednexus.db')}"
+
+
+def _worker(host, port, public_fd, internal_fd):
+    # Imported here: the supervisor itself never loads the app
+    from werkzeug.serving import make_server
+
+    import app as mednexus
+    import sharding
+
+    logging.getLogger('werkzeug').setLevel(logging.WARNING)
+    application = mednexus.create_app()
+    store = mednexus.vitals_store
+    if not store.loaded:
+        # Seeded documents must be committed before other workers read them
+        mednexus.repository.flush()
+        store.mark_loaded()
+
+    internal = make_server('127.0.0.1', sharding.PORTS[sharding.SHARD], application, threaded=True, fd=internal_fd)
+    threading.Thread(target=internal.serve_forever, name='shard-internal', daemon=True).start()
+    make_server(host, port, application, threaded=True, fd=public_fd).serve_forever()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n', 1)[0])
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1)
+    parser.add_argument('--host', default='0.0.0.0')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--worker', nargs=2, type=int, metavar=('PUBLIC_FD', 'INTERNAL_FD'), help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    if args.worker:
+        _worker(args.host, args.port, *args.worker)
+        return
+
+    from vitals_store import DEFAULT_CAPACITY, DEFAULT_SHARED_ROWS, SharedVitalsStore
+
+    storage = os.environ.get('MEDNEXUS_STORAGE', DEFAULT_STORAGE)
+    if not storage.startswith('sqlite:///'):
+        parser.error("sharded workers share a SQLite repository; set MEDNEXUS_STORAGE=sqlite:///path/to/mednexus.db")
+    os.makedirs(os.path.dirname(os.path.abspath(storage[len('sqlite:///'):])), exist_ok=True)
+    n = max(1, args.workers)
+
+    public = socket.create_server((args.host, args.port), family=socket.AF_INET6 if ':' in args.host else socket.AF_INET,
+                                  backlog=1024)
+    internal = [socket.create_server(('127.0.0.1', 0)) for _ in range(n)]
+    for sock in (public, *internal):
+        sock.set_inheritable(True)
+    store = SharedVitalsStore.create(max_rows=DEFAULT_SHARED_ROWS, capacity=DEFAULT_CAPACITY)
+
+    env = dict(
+        os.environ,
+        MEDNEXUS_STORAGE=storage,
+        MEDNEXUS_SHARDS=str(n),
+        MEDNEXUS_SHARD_PORTS=','.join(str(sock.getsockname()[1]) for sock in internal),
+        MEDNEXUS_SHARED_VITALS=store.name,
+    )
+    # Workers already run one per CPU
+    env.setdefault('MEDNEXUS_ANALYZE_WORKERS', '1')
+    env.setdefault('MEDNEXUS_IMAGE_WORKERS', '1')
+
+    def spawn(shard, restarted=False):
+        fds = (public.fileno(), internal[shard].fileno())
+        return subprocess.Popen(
+            [sys.executable, os.path.abspath(__file__), '--host', args.host, '--port', str(args.port),
+             '--worker', *map(str, fds)],
+            env=dict(env, MEDNEXUS_SHARD=str(shard), MEDNEXUS_SHARD_RESTARTED='1' if restarted else '0'),
+            pass_fds=fds,
+        )
+
+    def stop(signum, frame):
+        raise KeyboardInterrupt
+    signal.signal(signal.SIGTERM, stop)
+
+    workers = []
+    try:
+        # The first worker loads the repository into the shared store
+        workers.append(spawn(0))
+        while not store.loaded:
+            if workers[0].poll() is not None:
+                sys.exit(f"Worker 0 exited with status {workers[0].returncode} during startup")
+            time.sleep(0.05)
+        workers.extend(spawn(shard) for shard in range(1, n))
+        print(f"Serving on http://{args.host}:{args.port} with {n} workers", flush=True)
+        while True:
+            time.sleep(1)
+            for shard, worker in enumerate(workers):
+                if worker.poll() is not None:
+                    print(f"Worker {shard} exited with status {worker.returncode}; restarting", file=sys.stderr, flush=True)
+                    workers[shard] = spawn(shard, restarted=True)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for worker in workers:
+            worker.terminate()
+        for worker in workers:
+            try:
+                worker.wait(10)
+            except subprocess.TimeoutExpired:
+                worker.kill()
+        store.close()
+        store.unlink()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,136 @@
+"""Partitioning patients across the worker processes started by ``serve.py``
+
+``serve.py`` runs one worker per shard and describes the layout to each
+of them through environment variables:
+
+- ``MEDNEXUS_SHARDS``: the number of shards
+- ``MEDNEXUS_SHARD``: this worker's shard
+- ``MEDNEXUS_SHARD_PORTS``: every shard's loopback port, comma separated
+- ``MEDNEXUS_SHARED_VITALS``: the shared memory vitals store to attach to
+
+A patient belongs to shard ``crc32(patient_id) % shards``. Only the owner
+writes a patient's vitals, so requests that write them are forwarded to
+it over loopback HTTP. Everything else is answered by whichever worker
+accepted the connection, reading vitals from the shared store. Image
+analysis jobs live in the worker that accepted them, and their IDs name
+it, so polls reaching another worker are forwarded too. Without
+these variables there is a single shard, which owns every patient.
+"""
+import http.client
+import os
+import threading
+import zlib
+
+import numpy as np
+
+from vitals_store import SharedVitalsStore, VitalsStore
+
+SHARDS = max(1, int(os.environ.get('MEDNEXUS_SHARDS', 1)))
+SHARD = int(os.environ.get('MEDNEXUS_SHARD', 0))
+PORTS = [int(port) for port in os.environ.get('MEDNEXUS_SHARD_PORTS', '').split(',') if port]
+SHARED_VITALS = os.environ.get('MEDNEXUS_SHARED_VITALS')
+# Set by serve.py when it replaces a worker that exited
+RESTARTED = os.environ.get('MEDNEXUS_SHARD_RESTARTED') == '1'
+ENABLED = SHARDS > 1
+
+# Marks requests forwarded by another shard, which are never forwarded again
+FORWARDED_HEADER = 'X-MedNexus-Forwarded'
+# Headers that describe a single connection rather than the message
+HOP_BY_HOP = frozenset((
+    'connection', 'content-length', 'host', 'keep-alive', 'proxy-connection', 'te', 'transfer-encoding', 'upgrade',
+))
+# Seconds to wait for another shard's response
+FORWARD_TIMEOUT = 60
+# What ``forward`` raises when another shard cannot be reached
+FORWARD_ERRORS = (OSError, http.client.HTTPException)
+
+
+def shard_of(patient_id):
+    return zlib.crc32(patient_id.encode()) % SHARDS
+
+
+def owns(patient_id):
+    return shard_of(patient_id) == SHARD
+
+
+def job_prefix():
+    """Prefix of the IDs of jobs this shard runs, so other shards can forward polls for them"""
+    return f"s{SHARD}-" if ENABLED else ''
+
+
+def shard_of_job(job_id):
+    """The shard running a job whose ID starts with ``job_prefix()``, or None"""
+    prefix, _, rest = job_id.partition('-')
+    if not rest or not prefix.startswith('s') or not prefix[1:].isdigit():
+        return None
+    shard = int(prefix[1:])
+    return shard if shard < SHARDS else None
+
+
+def shards_of(patient_ids):
+    """The owning shard of each of ``patient_ids``, as an array"""
+    return np.array([shard_of(pid) for pid in patient_ids], dtype=np.int64)
+
+
+def open_vitals_store():
+    """The shared vitals store when running under ``serve.py``, else a private one"""
+    if SHARED_VITALS:
+        return SharedVitalsStore.attach(SHARED_VITALS)
+    return VitalsStore()
+
+
+class OwnedRows:
+    """Store rows of the patients this shard owns, extended as patients are added"""
+
+    def __init__(self, store):
+        self.store = store
+        self._checked = 0
+        self._rows = []
+        self._array = np.zeros(0, dtype=np.int64)
+
+    def __call__(self):
+        patient_ids = self.store.patient_ids
+        if len(patient_ids) != self._checked:
+            n = len(patient_ids)
+            self._rows.extend(row for row in range(self._checked, n) if owns(patient_ids[row]))
+            self._checked = n
+            self._array = np.array(self._rows, dtype=np.int64)
+        return self._array
+
+
+# Keep-alive connections to the other shards, per thread
+_connections = threading.local()
+
+
+def forward(shard, method, path, body=None, headers=()):
+    """Send a request to another shard; returns ``(status, headers, body)``
+
+    A connection the other shard closed while idle is reopened once;
+    anything else that goes wrong raises one of ``FORWARD_ERRORS``.
+    """
+    pool = _connections.__dict__.setdefault('pool', {})
+    headers = {name: value for name, value in headers if name.lower() not in HOP_BY_HOP}
+    headers[FORWARDED_HEADER] = str(SHARD)
+    while True:
+        connection = pool.get(shard)
+        reused = connection is not None
+        if not reused:
+            connection = pool[shard] = http.client.HTTPConnection('127.0.0.1', PORTS[shard], timeout=FORWARD_TIMEOUT)
+        try:
+            connection.request(method, path, body=body, headers=headers)
+            response = connection.getresponse()
+            data = response.read()
+        except (http.client.RemoteDisconnected, ConnectionResetError, BrokenPipeError):
+            connection.close()
+            del pool[shard]
+            if not reused:
+                raise
+            continue
+        except FORWARD_ERRORS:
+            connection.close()
+            del pool[shard]
+            raise
+        if response.will_close:
+            connection.close()
+            del pool[shard]
+        return response.status, [(name, value) for name, value in response.getheaders() if name.lower() not in HOP_BY_HOP], data
@@ -0,0 +1,185 @@
+"""Vectorized whole-ward simulation of real-time vitals and alerts"""
+import threading
+import time
+
+import numpy as np
+
+from anomaly import render_alerts
+from metrics import timed
+
+# metric: (max step per tick, lower bound, upper bound)
+DRIFT = {
+    "heart_rate": (5.0, 40, 180),
+    "systolic": (5.0, 80, 200),
+    "diastolic": (3.0, 40, 120),
+    "temperature": (0.3, 95, 104),
+    "oxygen_saturation": (2.0, 80, 100),
+}
+
+# Normal resting vitals a patient without samples starts from, inside every alert bound
+BASELINE = {
+    "heart_rate": 75.0,
+    "systolic": 120.0,
+    "diastolic": 80.0,
+    "temperature": 98.6,
+    "oxygen_saturation": 98.0,
+}
+
+# Fraction of the gap to BASELINE the random walk closes every tick, so
+# vitals wander around normal values instead of drifting to a bound
+REVERSION = 0.5
+
+# Condition-specific anomalies: (condition, metric, probability, low, high)
+ANOMALIES = (
+    ("Hypertension", "systolic", 0.2, 5, 15),
+    ("Coronary Artery Disease", "heart_rate", 0.15, 10, 20),
+    ("Asthma", "oxygen_saturation", 0.1, -8, -3),
+)
+
+# Alert rules: (type, message, clauses); a rule fires when any clause holds
+ALERT_RULES = (
+    ("warning", "Elevated heart rate detected", (("heart_rate", ">", 100),)),
+    ("warning", "Low heart rate detected", (("heart_rate", "<", 60),)),
+    ("warning", "Elevated blood pressure detected", (("systolic", ">", 140), ("diastolic", ">", 90))),
+    ("warning", "Elevated temperature detected", (("temperature", ">", 99.5),)),
+    ("danger", "Low oxygen saturation detected", (("oxygen_saturation", "<", 95),)),
+)
+
+_OPS = {">": np.greater, "<": np.less, ">=": np.greater_equal, "<=": np.less_equal}
+
+
+def evaluate_alerts(values):
+    """Evaluate every alert rule at once; returns a ``(rows, rules)`` bool matrix"""
+    n = len(values["heart_rate"])
+    fired = np.zeros((n, len(ALERT_RULES)), dtype=bool)
+    for i, (_, _, clauses) in enumerate(ALERT_RULES):
+        for metric, op, threshold in clauses:
+            fired[:, i] |= _OPS[op](values[metric], threshold)
+    return fired
+
+
+class Tick:
+    """The samples produced for a set of rows by one simulation step"""
+
+    def __init__(self, rows, timestamp, values, alerts, trends=None):
+        self.rows = rows
+        self.timestamp = timestamp
+        self.values = values
+        self.alerts = alerts
+        # Anomaly detector flags per row, when a detector is attached
+        self.trends = trends
+
+    def payload(self, i):
+        """Render the i-th row in the /api/realtime JSON shape"""
+        values = self.values
+        return {
+            "timestamp": datetime_string(self.timestamp),
+            "heart_rate": round(float(values["heart_rate"][i]), 1),
+            "blood_pressure": f"{int(values['systolic'][i])}/{int(values['diastolic'][i])}",
+            "temperature": round(float(values["temperature"][i]), 1),
+            "oxygen_saturation": round(float(values["oxygen_saturation"][i]), 1),
+            "alerts": [
+                {"type": ALERT_RULES[j][0], "message": ALERT_RULES[j][1]}
+                for j in np.flatnonzero(self.alerts[i])
+            ] + (render_alerts(self.trends[i]) if self.trends is not None else []),
+        }
+
+
+def datetime_string(timestamp):
+    return time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(timestamp))
+
+
+class WardSimulator:
+    """Advance every patient's vitals in one batched NumPy step
+
+    Each tick reads the latest sample of the selected rows from the
+    ``VitalsStore`` (``BASELINE`` for rows without one), applies bounded random drift and condition-driven
+    anomalies as masks, evaluates all alert rules vectorized and writes the
+    new samples back. Anomalies only affect the sample written: the next
+    tick continues the walk from the value before them, unless another
+    sample has been appended to the row since.
+    """
+
+    def __init__(self, store, seed=None, detector=None):
+        self.store = store
+        self.detector = detector
+        self._rng = np.random.default_rng(seed)
+        self._conditions = np.zeros((0, len(ANOMALIES)), dtype=bool)
+        # Per row, the walk's value before anomalies and the store version its sample was written at
+        self._walk = np.zeros((0, len(DRIFT)))
+        self._written = np.zeros(0, dtype=np.int64)
+        self._thread = None
+
+    def set_conditions(self, patient_id, conditions):
+        row = self.store.add_patient(patient_id)
+        if row >= len(self._conditions):
+            grown = np.zeros((max(2 * len(self._conditions), row + 1), len(ANOMALIES)), dtype=bool)
+            grown[:len(self._conditions)] = self._conditions
+            self._conditions = grown
+        self._conditions[row] = [condition in conditions for condition, *_ in ANOMALIES]
+
+    @timed
+    def tick(self, rows=None, timestamp=None):
+        """Simulate and persist one sample for ``rows`` (default: every patient)"""
+        store = self.store
+        rows = np.arange(len(store)) if rows is None else np.asarray(rows, dtype=np.int64)
+        timestamp = time.time() if timestamp is None else timestamp
+        n = len(rows)
+        rng = self._rng
+
+        if n and rows.max() >= len(self._written):
+            size = max(2 * len(self._written), int(rows.max()) + 1)
+            walk = np.zeros((size, len(DRIFT)))
+            walk[:len(self._walk)] = self._walk
+            written = np.full(size, -1, dtype=np.int64)
+            written[:len(self._written)] = self._written
+            self._walk, self._written = walk, written
+
+        latest = store.latest_rows(rows)
+        empty = store.count[rows] == 0
+        if empty.any():
+            for metric, baseline in BASELINE.items():
+                latest[metric][empty] = baseline
+        # Rows whose newest sample is this simulator's continue from the walk
+        ours = self._written[rows] == store.version[rows]
+        walk = {}
+        for j, (metric, (step, low, high)) in enumerate(DRIFT.items()):
+            previous = np.where(ours, self._walk[rows, j], latest[metric])
+            previous = previous + REVERSION * (BASELINE[metric] - previous)
+            walk[metric] = np.clip(previous + rng.uniform(-step, step, n), low, high)
+
+        conditions = np.zeros((n, len(ANOMALIES)), dtype=bool)
+        known = rows < len(self._conditions)
+        conditions[known] = self._conditions[rows[known]]
+        values = {metric: series.copy() for metric, series in walk.items()}
+        for k, (_, metric, probability, low, high) in enumerate(ANOMALIES):
+            mask = conditions[:, k] & (rng.random(n) < probability)
+            values[metric][mask] += rng.uniform(low, high, int(mask.sum()))
+        for metric, (_, low, high) in DRIFT.items():
+            np.clip(values[metric], low, high, out=values[metric])
+
+        store.append_rows(rows, timestamp, values)
+        self._walk[rows] = np.column_stack([walk[metric] for metric in DRIFT])
+        self._written[rows] = store.version[rows]
+        trends = self.detector.flags(rows) if self.detector is not None else None
+        return Tick(rows, timestamp, values, evaluate_alerts(values), trends)
+
+    def start(self, interval, rows=None):
+        """Tick the whole ward every ``interval`` seconds on a background thread
+
+        ``rows``, if given, is called before each tick for the rows to advance.
+        """
+        if self._thread is not None:
+            return
+
+        def run():
+            while True:
+                started = time.monotonic()
+                try:
+                    self.tick(None if rows is None else rows())
+                except Exception as exc:
+                    print(f"Ward simulation failed: {exc}")
+                time.sleep(max(0.0, interval - (time.monotonic() - started)))
+
+        self._thread = threading.Thread(target=run, name='ward-simulator', daemon=True)
+        self._thread.start()
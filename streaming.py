@@ -0,0 +1,119 @@
+"""Server-Sent Events fan-out for real-time vitals"""
+import json
+import os
+import queue
+import threading
+import time
+
+DEFAULT_INTERVAL = float(os.environ.get('MEDNEXUS_STREAM_INTERVAL', 3.0))
+
+
+class Subscription:
+    """A bounded per-client queue of encoded events"""
+
+    def __init__(self, patient_ids, maxsize=16):
+        self.patient_ids = tuple(patient_ids)
+        self._queue = queue.Queue(maxsize=maxsize)
+
+    def push(self, event):
+        # Slow clients drop their oldest event rather than stall the producer
+        try:
+            self._queue.put_nowait(event)
+        except queue.Full:
+            try:
+                self._queue.get_nowait()
+            except queue.Empty:
+                pass
+            self._queue.put_nowait(event)
+
+    def get(self, timeout):
+        try:
+            return self._queue.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+
+class VitalsBroadcaster:
+    """Run one producer tick per interval and fan it out to all subscribers
+
+    ``produce`` is called with the list of patient IDs that currently have
+    subscribers and returns ``{patient_id: payload}``. Each payload is
+    serialized once per tick no matter how many clients receive it.
+    """
+
+    def __init__(self, produce, interval=DEFAULT_INTERVAL):
+        self._produce = produce
+        self.interval = interval
+        self._subscribers = {}
+        self._last_event = {}
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def subscribe(self, patient_ids):
+        sub = Subscription(patient_ids)
+        with self._lock:
+            for patient_id in sub.patient_ids:
+                self._subscribers.setdefault(patient_id, set()).add(sub)
+                # Give new clients the latest reading without waiting a tick
+                if patient_id in self._last_event:
+                    sub.push(self._last_event[patient_id])
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='vitals-broadcaster', daemon=True)
+                self._thread.start()
+        return sub
+
+    def unsubscribe(self, sub):
+        with self._lock:
+            for patient_id in sub.patient_ids:
+                subs = self._subscribers.get(patient_id)
+                if subs is None:
+                    continue
+                subs.discard(sub)
+                if not subs:
+                    del self._subscribers[patient_id]
+                    self._last_event.pop(patient_id, None)
+
+    @property
+    def subscriber_count(self):
+        with self._lock:
+            return len({sub for subs in self._subscribers.values() for sub in subs})
+
+    def tick(self):
+        """Produce one round of payloads and push them to subscribers"""
+        with self._lock:
+            patient_ids = list(self._subscribers)
+        if not patient_ids:
+            return
+        payloads = self._produce(patient_ids)
+        with self._lock:
+            for patient_id, payload in payloads.items():
+                subs = self._subscribers.get(patient_id)
+                if not subs:
+                    continue
+                event = encode_event(dict(payload, patient_id=patient_id))
+                self._last_event[patient_id] = event
+                for sub in subs:
+                    sub.push(event)
+
+    def _run(self):
+        while True:
+            started = time.monotonic()
+            try:
+                self.tick()
+            except Exception as exc:  # keep the stream alive for every other client
+                print(f"Vitals broadcaster tick failed: {exc}")
+            time.sleep(max(0.0, self.interval - (time.monotonic() - started)))
+
+    def stream(self, sub, heartbeat=15.0):
+        """Yield SSE bytes for a subscription until the client disconnects"""
+        try:
+            yield f"retry: {int(self.interval * 1000)}\n\n".encode()
+            while True:
+                event = sub.get(timeout=heartbeat)
+                yield event if event is not None else b": keep-alive\n\n"
+        finally:
+            self.unsubscribe(sub)
+
+
+def encode_event(payload):
+    return f"data: {json.dumps(payload, separators=(',', ':'))}\n\n".encode()
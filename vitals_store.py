@@ -0,0 +1,605 @@
+"""Columnar ring-buffer storage for patient vital signs
+
+``VitalsStore`` keeps its rows in process memory. ``SharedVitalsStore``
+keeps them in a ``multiprocessing.shared_memory`` segment, so that
+sharded worker processes can read any patient's vitals in place.
+"""
+import contextlib
+import fcntl
+import os
+import tempfile
+import threading
+import time
+from multiprocessing import resource_tracker, shared_memory
+
+import numpy as np
+
+# Stored metric columns; blood pressure is split into systolic/diastolic
+METRICS = ("heart_rate", "systolic", "diastolic", "temperature", "oxygen_saturation")
+
+DEFAULT_CAPACITY = int(os.environ.get('MEDNEXUS_VITALS_CAPACITY', 256))
+DEFAULT_SHARED_ROWS = int(os.environ.get('MEDNEXUS_SHARED_MAX_PATIENTS', 65536))
+# Rows whose samples ``replay`` hands to a listener at once
+REPLAY_ROWS = 4096
+
+
+class VitalsStore:
+    """Fixed-capacity per-metric ring buffers, one row per patient
+
+    Every metric lives in its own preallocated ``(rows, capacity)`` float32
+    array and timestamps in a float64 array of the same shape, so appending
+    a sample or reading the latest one is a handful of scalar writes/reads
+    with no allocation. Rows are grown geometrically as patients are added.
+    """
+
+    # Whether other processes read and write the same rows (see SharedVitalsStore)
+    shared = False
+
+    def __init__(self, capacity=DEFAULT_CAPACITY, initial_rows=64):
+        self.capacity = int(capacity)
+        self._rows = {}
+        self._ids = []
+        self._lock = threading.Lock()
+        self.columns = {m: np.zeros((initial_rows, self.capacity), dtype=np.float32) for m in METRICS}
+        self.timestamps = np.zeros((initial_rows, self.capacity), dtype=np.float64)
+        # Next slot to write and number of valid samples, per row
+        self.head = np.zeros(initial_rows, dtype=np.int64)
+        self.count = np.zeros(initial_rows, dtype=np.int64)
+        # Bumped on every append so readers can tell when a row changed
+        self.version = np.zeros(initial_rows, dtype=np.int64)
+        self._listeners = []
+
+    def __contains__(self, patient_id):
+        return patient_id in self._rows
+
+    def __len__(self):
+        return len(self._ids)
+
+    @property
+    def patient_ids(self):
+        return self._ids
+
+    def row(self, patient_id):
+        return self._rows[patient_id]
+
+    def rows_of(self, patient_ids):
+        """Return the rows of several patients, -1 for those without one"""
+        return np.array([self._rows.get(pid, -1) for pid in patient_ids], dtype=np.int64)
+
+    def version_of(self, patient_id):
+        return int(self.version[self._rows[patient_id]])
+
+    def add_patient(self, patient_id):
+        """Allocate a row for a patient (idempotent) and return its index"""
+        with self._lock:
+            row = self._rows.get(patient_id)
+            if row is None:
+                row = len(self._ids)
+                if row >= len(self.head):
+                    self._grow(max(2 * len(self.head), 1))
+                self._rows[patient_id] = row
+                self._ids.append(patient_id)
+            return row
+
+    def add_listener(self, listener):
+        """Call ``listener(rows, timestamps, values)`` with every batch of appended samples
+
+        ``rows`` and ``timestamps`` are per-sample arrays and ``values`` maps
+        each metric to a per-sample array, in append order.
+        """
+        self._listeners.append(listener)
+
+    def _notify(self, rows, timestamps, values):
+        if self._listeners:
+            rows = np.asarray(rows, dtype=np.int64)
+            timestamps = np.broadcast_to(np.asarray(timestamps, dtype=np.float64), rows.shape)
+            values = {m: np.asarray(values[m], dtype=np.float64) for m in METRICS}
+            for listener in self._listeners:
+                listener(rows, timestamps, values)
+
+    def _grow(self, n_rows):
+        def grown(arr):
+            out = np.zeros((n_rows,) + arr.shape[1:], dtype=arr.dtype)
+            out[:len(arr)] = arr
+            return out
+
+        self.columns = {m: grown(arr) for m, arr in self.columns.items()}
+        self.timestamps = grown(self.timestamps)
+        self.head = grown(self.head)
+        self.count = grown(self.count)
+        self.version = grown(self.version)
+
+    def _writing(self, rows, added):
+        """Context held while ``added`` samples are written to each of ``rows``"""
+        return self._lock
+
+    def append(self, patient_id, timestamp, heart_rate, systolic, diastolic, temperature, oxygen_saturation):
+        """Append one sample for a patient in O(1)"""
+        row = self._rows[patient_id]
+        with self._writing(row, 1):
+            slot = self.head[row]
+            columns = self.columns
+            columns["heart_rate"][row, slot] = heart_rate
+            columns["systolic"][row, slot] = systolic
+            columns["diastolic"][row, slot] = diastolic
+            columns["temperature"][row, slot] = temperature
+            columns["oxygen_saturation"][row, slot] = oxygen_saturation
+            self.timestamps[row, slot] = timestamp
+            self.head[row] = (slot + 1) % self.capacity
+            if self.count[row] < self.capacity:
+                self.count[row] += 1
+            self.version[row] += 1
+        if self._listeners:
+            self._notify([row], [timestamp], {
+                "heart_rate": [heart_rate], "systolic": [systolic], "diastolic": [diastolic],
+                "temperature": [temperature], "oxygen_saturation": [oxygen_saturation],
+            })
+
+    def append_rows(self, rows, timestamp, values):
+        """Append one sample to each of ``rows`` (unique) in a single batched write
+
+        ``timestamp`` is a scalar or per-row array and ``values`` maps every
+        metric name to a per-row array.
+        """
+        rows = np.asarray(rows, dtype=np.int64)
+        with self._writing(rows, 1):
+            slots = self.head[rows]
+            for metric, arr in self.columns.items():
+                arr[rows, slots] = values[metric]
+            self.timestamps[rows, slots] = timestamp
+            self.head[rows] = (slots + 1) % self.capacity
+            self.count[rows] = np.minimum(self.count[rows] + 1, self.capacity)
+            self.version[rows] += 1
+        self._notify(rows, timestamp, values)
+
+    def append_samples(self, rows, timestamps, values):
+        """Append many samples in one batched write; rows may repeat
+
+        Samples of the same row are appended in the order given, and only
+        the last ``capacity`` of them are kept.
+        """
+        rows = np.asarray(rows, dtype=np.int64)
+        order = np.argsort(rows, kind="stable")
+        rows = rows[order]
+        starts = np.flatnonzero(np.r_[True, rows[1:] != rows[:-1]])
+        lengths = np.diff(np.r_[starts, len(rows)])
+        unique_rows = rows[starts]
+        rank = np.arange(len(rows)) - np.repeat(starts, lengths)
+        keep = rank >= np.repeat(lengths, lengths) - self.capacity
+        source = order[keep]
+        with self._writing(unique_rows, lengths):
+            slots = (self.head[rows[keep]] + rank[keep]) % self.capacity
+            for metric, arr in self.columns.items():
+                arr[rows[keep], slots] = np.asarray(values[metric])[source]
+            self.timestamps[rows[keep], slots] = np.asarray(timestamps, dtype=np.float64)[source]
+            self.head[unique_rows] = (self.head[unique_rows] + lengths) % self.capacity
+            self.count[unique_rows] = np.minimum(self.count[unique_rows] + lengths, self.capacity)
+            self.version[unique_rows] += 1
+        if self._listeners:
+            self._notify(rows, np.asarray(timestamps)[order], {m: np.asarray(values[m])[order] for m in METRICS})
+
+    def extend(self, patient_id, timestamps, values):
+        """Append a patient's samples, oldest first, in one vectorized write
+
+        ``values`` maps every metric name to an array as long as ``timestamps``.
+        Only the last ``capacity`` samples are kept.
+        """
+        row = self.add_patient(patient_id)
+        timestamps = np.asarray(timestamps, dtype=np.float64)
+        n = len(timestamps)
+        if not n:
+            return
+        keep = min(n, self.capacity)
+        with self._writing(row, n):
+            slots = (self.head[row] + np.arange(n - keep, n)) % self.capacity
+            for metric, arr in self.columns.items():
+                arr[row, slots] = np.asarray(values[metric])[n - keep:]
+            self.timestamps[row, slots] = timestamps[n - keep:]
+            self.head[row] = (self.head[row] + n) % self.capacity
+            self.count[row] = min(self.count[row] + n, self.capacity)
+            self.version[row] += 1
+        self._notify(np.full(n, row), timestamps, values)
+
+    def latest_rows(self, rows):
+        """Return the latest sample of each row as per-metric float64 arrays"""
+        rows = np.asarray(rows, dtype=np.int64)
+        slots = (self.head[rows] - 1) % self.capacity
+        latest = {m: arr[rows, slots].astype(np.float64) for m, arr in self.columns.items()}
+        latest["timestamp"] = self.timestamps[rows, slots]
+        return latest
+
+    def latest(self, patient_id):
+        """Return the most recent sample as a dict of floats, or None"""
+        row = self._rows[patient_id]
+        if not self.count[row]:
+            return None
+        slot = (self.head[row] - 1) % self.capacity
+        sample = {m: round(float(arr[row, slot]), 1) for m, arr in self.columns.items()}
+        sample["timestamp"] = float(self.timestamps[row, slot])
+        return sample
+
+    def _order(self, row):
+        count = self.count[row]
+        return (self.head[row] - count + np.arange(count)) % self.capacity
+
+    def history(self, patient_id, metric):
+        """Return a metric's samples for a patient, oldest first"""
+        row = self._rows[patient_id]
+        source = self.timestamps if metric == "timestamp" else self.columns[metric]
+        return source[row, self._order(row)]
+
+    def snapshot(self, patient_id):
+        """Return every metric's history for a patient, oldest first"""
+        row = self._rows[patient_id]
+        order = self._order(row)
+        vitals = {m: arr[row, order] for m, arr in self.columns.items()}
+        vitals["timestamp"] = self.timestamps[row, order]
+        return vitals
+
+    def retained(self):
+        """Return ``(rows, timestamps, values)`` for every sample held, in no particular order"""
+        n = len(self._ids)
+        # Rows fill their ring from slot 0, so a row's first ``count`` slots are valid
+        held = np.arange(self.capacity)[None, :] < self.count[:n, None]
+        rows = np.nonzero(held)[0]
+        return rows, self.timestamps[:n][held], {m: arr[:n][held] for m, arr in self.columns.items()}
+
+    def replay(self, listener, chunk=REPLAY_ROWS):
+        """Call ``listener(rows, timestamps, values)`` with every sample held, ``chunk`` rows at a time
+
+        Each row's samples are given oldest first, as ``add_listener``
+        listeners would have heard them, so derived state can be rebuilt
+        in a few batched calls instead of one per patient.
+        """
+        n = len(self._ids)
+        for start in range(0, n, chunk):
+            held = np.arange(start, min(start + chunk, n))
+            count = self.count[held]
+            rows = np.repeat(held, count)
+            if not len(rows):
+                continue
+            offsets = np.arange(len(rows)) - np.repeat(np.cumsum(count) - count, count)
+            slots = (np.repeat(self.head[held] - count, count) + offsets) % self.capacity
+            values = {m: arr[rows, slots].astype(np.float64) for m, arr in self.columns.items()}
+            listener(rows, self.timestamps[rows, slots], values)
+
+    def load(self, patient_id, vitals, interval=60.0, end=None):
+        """Load legacy list-shaped vitals, spacing samples ``interval`` seconds apart
+
+        Returns the loaded samples as per-column arrays, timestamps included.
+        """
+        bp = np.array([reading.split('/') for reading in vitals["blood_pressure"]], dtype=np.float64).reshape(-1, 2)
+        n = len(vitals["heart_rate"])
+        end = time.time() if end is None else end
+        samples = {
+            "timestamp": end - (n - 1 - np.arange(n)) * interval,
+            "heart_rate": np.asarray(vitals["heart_rate"], dtype=np.float64),
+            "systolic": bp[:, 0],
+            "diastolic": bp[:, 1],
+            "temperature": np.asarray(vitals["temperature"], dtype=np.float64),
+            "oxygen_saturation": np.asarray(vitals["oxygen_saturation"], dtype=np.float64),
+        }
+        self.extend(patient_id, samples["timestamp"], samples)
+        return samples
+
+    def save(self, file, patient_ids=None):
+        """Write every row, or the rows of ``patient_ids``, to an ``.npz`` snapshot"""
+        if patient_ids is None:
+            ids = list(self.patient_ids)
+            rows = slice(0, len(ids))
+        else:
+            ids = [pid for pid in patient_ids if pid in self]
+            rows = self.rows_of(ids)
+        with self._lock:
+            arrays = {f"column_{m}": arr[rows] for m, arr in self.columns.items()}
+            np.savez(
+                file,
+                patient_ids=np.array(ids, dtype=str),
+                timestamps=self.timestamps[rows],
+                head=self.head[rows],
+                count=self.count[rows],
+                **arrays
+            )
+
+    def restore(self, file):
+        """Replace rows with those of a snapshot written by ``save``
+
+        Snapshots taken with a different capacity are re-laid out oldest first.
+        """
+        with np.load(file) as snapshot:
+            arrays = {name: snapshot[name] for name in snapshot.files}
+        capacity = arrays["timestamps"].shape[1]
+        for i, patient_id in enumerate(arrays["patient_ids"].tolist()):
+            count = int(arrays["count"][i])
+            order = (arrays["head"][i] - count + np.arange(count)) % capacity
+            values = {m: arrays[f"column_{m}"][i, order] for m in METRICS}
+            row = self.add_patient(patient_id)
+            with self._writing(row, 0):
+                self.head[row] = 0
+                self.count[row] = 0
+            self.extend(patient_id, arrays["timestamps"][i, order], values)
+
+    def as_dict(self, patient_id):
+        """Render a patient's vitals in the public JSON shape
+
+        Numeric series stay NumPy arrays, which ``serialization.encode``
+        writes without converting them to lists.
+        """
+        vitals = self.snapshot(patient_id)
+
+        def values(metric):
+            return np.round(vitals[metric].astype(np.float64), 1)
+
+        return {
+            "heart_rate": values("heart_rate"),
+            "blood_pressure": [
+                f"{s}/{d}" for s, d in zip(vitals["systolic"].astype(np.int64).tolist(),
+                                           vitals["diastolic"].astype(np.int64).tolist())
+            ],
+            "temperature": values("temperature"),
+            "oxygen_saturation": values("oxygen_saturation"),
+        }
+
+
+class SharedVitalsStore(VitalsStore):
+    """A ``VitalsStore`` whose arrays live in one shared memory segment
+
+    The segment holds a header, a table of patient IDs by row and every
+    per-row array. It is created once with ``create``, and each process
+    then ``attach``-es to it by name. Rows are allocated densely, in the
+    ID table, under a file lock, so every process agrees on them. The
+    segment cannot grow; it holds ``max_rows`` patients.
+
+    Each row must have a single writer, the process that owns the patient.
+    Every row also has a sequence counter, which is odd while the row is
+    being written. Readers copy a row and retry if its counter was odd or
+    moved while they copied it (a seqlock). This relies on stores becoming
+    visible in program order, as they do on x86-64.
+
+    Listeners only hear about appends made in their own process. ``sync``
+    replays to them the samples that other processes appended since the
+    previous call. Each row counts every sample ever appended to it, so
+    ``sync`` knows which samples are new.
+    """
+
+    shared = True
+
+    # Patient IDs are stored as fixed-width UTF-8
+    ID_BYTES = 64
+    # Header fields
+    _MAGIC, _CAPACITY, _MAX_ROWS, _N_ROWS, _LOADED = range(5)
+    _MAGIC_VALUE = 0x4D4E5856  # "MNXV"
+
+    def __init__(self, segment, lock_path):
+        self._segment = segment
+        self._lock_path = lock_path
+        header = np.ndarray(8, dtype=np.int64, buffer=segment.buf)
+        if header[self._MAGIC] != self._MAGIC_VALUE:
+            raise ValueError(f"Shared memory segment {segment.name} is not a vitals store")
+        self._header = header
+        self.capacity = int(header[self._CAPACITY])
+        self.max_rows = int(header[self._MAX_ROWS])
+        fields, _ = self._layout(self.capacity, self.max_rows)
+        arrays = {
+            name: np.ndarray(shape, dtype=dtype, buffer=segment.buf, offset=offset)
+            for name, dtype, shape, offset in fields
+        }
+        self._patient_ids = arrays.pop("patient_ids")
+        self._seq = arrays.pop("seq")
+        self.total = arrays.pop("total")
+        self.head = arrays.pop("head")
+        self.count = arrays.pop("count")
+        self.version = arrays.pop("version")
+        self.timestamps = arrays.pop("timestamps")
+        self.columns = arrays
+        self._rows = {}
+        self._ids = []
+        self._lock = threading.Lock()
+        self._listeners = []
+        # Per row, the samples this process's listeners have been told about
+        self._seen = np.zeros(self.max_rows, dtype=np.int64)
+        self._sync_lock = threading.Lock()
+        self._refresh()
+
+    @classmethod
+    def _layout(cls, capacity, max_rows):
+        # ``([(name, dtype, shape, offset)], size)`` of the arrays after the header
+        specs = [("patient_ids", np.dtype(f"S{cls.ID_BYTES}"), (max_rows,))]
+        specs += [(name, np.dtype(np.int64), (max_rows,)) for name in ("seq", "total", "head", "count", "version")]
+        specs += [("timestamps", np.dtype(np.float64), (max_rows, capacity))]
+        specs += [(metric, np.dtype(np.float32), (max_rows, capacity)) for metric in METRICS]
+        fields = []
+        offset = 64
+        for name, dtype, shape in specs:
+            fields.append((name, dtype, shape, offset))
+            # Each array starts on a cache line
+            offset += -(-int(np.prod(shape)) * dtype.itemsize // 64) * 64
+        return fields, offset
+
+    @classmethod
+    def create(cls, name=None, max_rows=DEFAULT_SHARED_ROWS, capacity=DEFAULT_CAPACITY):
+        """Create a new, empty segment; the caller should ``unlink`` it when done"""
+        segment = shared_memory.SharedMemory(name=name, create=True, size=cls._layout(capacity, max_rows)[1])
+        header = np.ndarray(8, dtype=np.int64, buffer=segment.buf)
+        header[cls._CAPACITY] = capacity
+        header[cls._MAX_ROWS] = max_rows
+        header[cls._MAGIC] = cls._MAGIC_VALUE
+        lock_path = os.path.join(tempfile.gettempdir(), f"{segment.name.lstrip('/')}.lock")
+        open(lock_path, 'a').close()
+        return cls(segment, lock_path)
+
+    @classmethod
+    def attach(cls, name):
+        """Attach to a segment made by ``create``, in this or another process"""
+        segment = shared_memory.SharedMemory(name=name)
+        # Only the creator may unlink the segment; the tracker would do so
+        # when this process exits
+        resource_tracker.unregister(segment._name, 'shared_memory')
+        return cls(segment, os.path.join(tempfile.gettempdir(), f"{name.lstrip('/')}.lock"))
+
+    @property
+    def name(self):
+        return self._segment.name
+
+    @property
+    def loaded(self):
+        """Whether the rows have been loaded from the repository (see ``mark_loaded``)"""
+        return bool(self._header[self._LOADED])
+
+    def mark_loaded(self):
+        self._header[self._LOADED] = 1
+
+    def close(self):
+        self._segment.close()
+
+    def unlink(self):
+        """Remove the segment; processes still attached keep their mapping"""
+        self._segment.unlink()
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(self._lock_path)
+
+    def _refresh(self):
+        # Learn the rows other processes allocated since the last call
+        n = int(self._header[self._N_ROWS])
+        for row in range(len(self._ids), n):
+            patient_id = self._patient_ids[row].decode()
+            self._rows[patient_id] = row
+            self._ids.append(patient_id)
+
+    def _refreshed(self):
+        if int(self._header[self._N_ROWS]) != len(self._ids):
+            with self._lock:
+                self._refresh()
+
+    def __contains__(self, patient_id):
+        if patient_id not in self._rows:
+            self._refreshed()
+        return patient_id in self._rows
+
+    def __len__(self):
+        self._refreshed()
+        return len(self._ids)
+
+    @property
+    def patient_ids(self):
+        self._refreshed()
+        return self._ids
+
+    def row(self, patient_id):
+        row = self._rows.get(patient_id)
+        if row is None:
+            self._refreshed()
+            row = self._rows[patient_id]
+        return row
+
+    def rows_of(self, patient_ids):
+        self._refreshed()
+        return super().rows_of(patient_ids)
+
+    def add_patient(self, patient_id):
+        """Allocate a row for a patient (idempotent) and return its index"""
+        row = self._rows.get(patient_id)
+        if row is not None:
+            return row
+        key = patient_id.encode()
+        if len(key) > self.ID_BYTES:
+            raise ValueError(f"Patient IDs are limited to {self.ID_BYTES} bytes")
+        with self._lock, open(self._lock_path, 'a') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            self._refresh()
+            row = self._rows.get(patient_id)
+            if row is None:
+                row = len(self._ids)
+                if row >= self.max_rows:
+                    raise RuntimeError(f"The shared vitals store is full ({self.max_rows} patients)")
+                self._patient_ids[row] = key
+                # Published after the ID, so readers never see an empty slot
+                self._header[self._N_ROWS] = row + 1
+                self._rows[patient_id] = row
+                self._ids.append(patient_id)
+        return row
+
+    def _grow(self, n_rows):
+        raise RuntimeError(f"The shared vitals store is full ({self.max_rows} patients)")
+
+    @contextlib.contextmanager
+    def _writing(self, rows, added):
+        with self._lock:
+            seen = self._seen[rows] == self.total[rows]
+            self._seq[rows] += 1
+            try:
+                yield
+            finally:
+                self.total[rows] += added
+                self._seq[rows] += 1
+                # The append is about to be announced to the listeners;
+                # without any, sync replays it later
+                if self._listeners:
+                    self._seen[rows] = np.where(seen, self.total[rows], self._seen[rows])
+
+    def _read(self, rows, read, *args):
+        while True:
+            before = np.array(self._seq[rows])
+            if not (before & 1).any():
+                result = read(*args)
+                if np.array_equal(self._seq[rows], before):
+                    return result
+            time.sleep(0)
+
+    def latest_rows(self, rows):
+        rows = np.asarray(rows, dtype=np.int64)
+        return self._read(rows, super().latest_rows, rows)
+
+    def latest(self, patient_id):
+        return self._read(self.row(patient_id), super().latest, patient_id)
+
+    def history(self, patient_id, metric):
+        return self._read(self.row(patient_id), super().history, patient_id, metric)
+
+    def snapshot(self, patient_id):
+        return self._read(self.row(patient_id), super().snapshot, patient_id)
+
+    def retained(self):
+        return self._read(slice(0, len(self)), super().retained)
+
+    def sync(self):
+        """Replay to the listeners the samples other processes appended; returns how many"""
+        n = len(self)
+        if not self._listeners or not n:
+            return 0
+        # Whoever syncs first replays for everyone
+        if not self._sync_lock.acquire(blocking=False):
+            return 0
+        try:
+            return self._sync(n)
+        finally:
+            self._sync_lock.release()
+
+    def _sync(self, n):
+        pending = np.flatnonzero(self.total[:n] != self._seen[:n])
+        parts = []
+        while len(pending):
+            before = self._seq[pending].copy()
+            total = self.total[pending].copy()
+            head = self.head[pending].copy()
+            new = np.minimum(total - self._seen[pending], self.count[pending])
+            # The ``new`` newest slots of each row, oldest first
+            rows = np.repeat(pending, new)
+            offsets = np.arange(len(rows)) - np.repeat(np.cumsum(new) - new, new)
+            slots = (np.repeat(head - new, new) + offsets) % self.capacity
+            sample = {m: arr[rows, slots] for m, arr in self.columns.items()}
+            sample["timestamp"] = self.timestamps[rows, slots]
+            consistent = ((before & 1) == 0) & (self._seq[pending] == before)
+            keep = np.repeat(consistent, new)
+            parts.append((rows[keep], {name: values[keep] for name, values in sample.items()}))
+            self._seen[pending[consistent]] = total[consistent]
+            # Rows written to meanwhile are read again
+            pending = pending[~consistent]
+            if len(pending):
+                time.sleep(0)
+        rows = np.concatenate([rows for rows, _ in parts]) if parts else ()
+        if not len(rows):
+            return 0
+        values = {m: np.concatenate([sample[m] for _, sample in parts]) for m in METRICS}
+        self._notify(rows, np.concatenate([sample["timestamp"] for _, sample in parts]), values)
+        return len(rows)